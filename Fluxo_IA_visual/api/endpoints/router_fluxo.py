@@ -1,20 +1,31 @@
-from concurrent.futures import ProcessPoolExecutor
 from fastapi.encoders import jsonable_encoder
-from fastapi import APIRouter, Query, UploadFile, File, HTTPException, BackgroundTasks
-from typing import Union, List
+from fastapi import APIRouter, Query, UploadFile, File, HTTPException, BackgroundTasks, Request, Header
+from typing import AsyncIterator, Dict, Tuple, Union, List
 import logging
+import json
+import time
 import asyncio
 import zipfile
 import uuid
 import io
+import os
 
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 
-from ...models.responses import AnalisisTPV, RespuestaProcesamientoIniciado
+from ...models.responses import AnalisisTPV, RespuestaProcesamientoIniciado, EstadoJob
+from ...core.config import settings
 from ...core.exceptions import PDFCifradoError
 from ...services.storage_service import obtener_ruta_archivo, guardar_excel_local, guardar_json_local, obtener_datos_json
 from ...utils.xlsx_converter import generar_excel_reporte
-from ...services.orchestators import obtener_y_procesar_portada, procesar_digital_worker_sync, procesar_ocr_worker_sync
+from ...services.orchestators import obtener_y_procesar_portada, procesar_cuenta_digital, procesar_cuenta_escaneada
+from ...services.ia_extractor import contadores_job, cache_imagenes
+from ...services.document_cache import calcular_hash_documento
+from ...services.llm_resiliencia import job_actual, EVENTO_CHUNKS_FALLIDOS
+from ...services.cola_trabajo import ejecutar_cpu
+from ...services.job_store import (
+    registro_jobs, EstadoJob as EstadoRegistroJob, InfoJob, ETAPA_DOCUMENTOS, ETAPA_PORTADAS, ETAPA_CUENTAS, ETAPA_REPORTE,
+    EVENTO_PORTADA_TERMINADA, EVENTO_REPORTE_LISTO, EVENTO_JOB_TERMINADO
+)
 from ...utils.helpers import total_depositos_verificacion
 from ...utils.helpers_texto_fluxo import prompt_base_fluxo
 
@@ -31,7 +42,8 @@ logger = logging.getLogger(__name__)
     )
 async def procesar_pdf_api(
     background_tasks: BackgroundTasks, # Inyección necesaria
-    archivos: List[UploadFile] = File(..., description="Uno o más archivos PDF o .ZIP a extraer transacciones TPV")
+    archivos: List[UploadFile] = File(..., description="Uno o más archivos PDF o .ZIP a extraer transacciones TPV"),
+    limite_segundos: Union[float, None] = Query(None, gt=0, description="Tiempo máximo del trabajo; al vencer se entrega lo que ya terminó (tope: JOB_LIMITE_SEGUNDOS).")
 ):
     """
     Sube uno o más archivos PDF. El sistema procesa todos en paralelo y devuelve resultados.
@@ -44,7 +56,6 @@ async def procesar_pdf_api(
     job_id = str(uuid.uuid4())
 
     # ------- listas a usar más adelante -------
-    tareas_analisis = []
     archivos_en_memoria = []
 
     # --- 0. Lógica para manejar los archivos individuales y .zip ---
@@ -85,253 +96,194 @@ async def procesar_pdf_api(
             status_code=400,
             detail="No subiste ningun archivo PDF válido."
         )
-    async def tarea_pesada_background(job_id: str, docs: list):
-        logger.info(f"Iniciando Job {job_id}")
-
-        # --- 1. ANÁLISIS DE LA PORTADA CON IA PARA DETERMINAR ENTRADAS Y SI ES DOCUMENTO ESCANEADO ---
-        logger.info("Analisis de Portada Inicializado para todos los documentos")
-        for doc in archivos_en_memoria:
-            # 'obtener_y_procesar_portada' solo hace el análisis inicial de IA y extracción de texto/posiciones
-            tarea = obtener_y_procesar_portada(prompt_base_fluxo, doc["content"])
-            tareas_analisis.append(tarea)    
-
-        try:
-            resultados_portada = await asyncio.gather(*tareas_analisis, return_exceptions=True)
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"Error crítico durante la Etapa 1 (Análisis IA): {str(e)}")
+    limite_job = min(limite_segundos or settings.JOB_LIMITE_SEGUNDOS, settings.JOB_LIMITE_SEGUNDOS)
 
-        logger.info("Etapa 1: Análisis de portada finalizado.")
+    async def ejecutar_job(job_id: str, docs: list, hashes: List[str]) -> Tuple[EstadoRegistroJob, Union[str, None]]:
+        logger.info(f"Iniciando Job {job_id} (límite de {limite_job:.0f}s)")
+        loop = asyncio.get_running_loop()
+        limite = loop.time() + limite_job
 
-        # --- 2. SEPARACIÓN DE DOCUMENTOS DIGITALES Y ESCANEADOS (Y CALCULOS TOTALES) ---
-        documentos_digitales = []
-        documentos_escaneados = []
-        
-        # Lista final con el tamaño de los archivos originales (se expandirá dinámicamente)
-        resultados_finales: List[Union[AnalisisTPV.ResultadoExtraccion, None]] = [None] * len(archivos_en_memoria)
+        # Cada documento (y cada cuenta digital) avanza a la extracción en cuanto su propia portada
+        # está lista. Solo hay dos barreras: la decisión de OCR, que depende de los depósitos de
+        # TODAS las portadas, y el ensamble final del ResultadoTotal.
+        portadas = [loop.create_future() for _ in docs]
 
-        # Nota: total_depositos_verificacion necesitará ajustes si recibe listas, 
-        # por ahora asumimos que no bloquea el flujo crítico.
-        total_depositos_calculado, es_mayor = total_depositos_verificacion(resultados_portada) # la primer variable puede ser usada en el futuro
+        def resultado_error(mensaje: str, datos_ia: Union[dict, None] = None) -> AnalisisTPV.ResultadoExtraccion:
+            return AnalisisTPV.ResultadoExtraccion(
+                AnalisisIA=datos_ia,
+                DetalleTransacciones=AnalisisTPV.ErrorRespuesta(error=mensaje)
+            )
 
-        logger.info("Empezando la separación de documentos y desglose de cuentas múltiples")
-        
-        for i, resultado_bruto in enumerate(resultados_portada):
-            filename = archivos_en_memoria[i]["filename"]
-            # VERIFICACIÓN 1: ¿La tarea falló por completo?
-            if isinstance(resultado_bruto, Exception):
-                # Verificamos si es nuestro error de contraseña
-                if isinstance(resultado_bruto, PDFCifradoError):
-                    logger.warning(f"Documento número {i} con contraseña")
-                    error_msg = "Documento con contraseña, imposible trabajar con este documento."
-                    resultados_finales[i] = AnalisisTPV.ResultadoExtraccion(
-                        AnalisisIA=None,
-                        DetalleTransacciones=AnalisisTPV.ErrorRespuesta(error=error_msg))
-                else:
-                    logger.error(f"Fallo en el procesamiento inicial de {filename}")
-                    # Para cualquier otro error inesperado en la etapa inicial
-                    error_msg = f"Fallo el procesamiento inicial de '{filename}': {str(resultado_bruto)}"
-                    resultados_finales[i] = AnalisisTPV.ResultadoExtraccion(
-                        AnalisisIA=None,
-                        DetalleTransacciones=AnalisisTPV.ErrorRespuesta(error=error_msg)
-                    )
-                continue # Pasamos al siguiente archivo
-            
-            # SI NO HUBO ERROR: Desempacamos. 
-            # Ahora desempacamos también 'rangos_detectados' (la lista de tuplas)
-            lista_cuentas_ia, es_digital, texto_inicial, movimientos_pagina, texto_por_pagina, rangos_detectados = resultado_bruto
-
-            # Intenta procesar este archivo, preparado para cualquier error
+        # Cuentas ya terminadas por documento: si el job se cancela o vence, se entregan estas
+        parciales: List[Dict[int, List[AnalisisTPV.ResultadoExtraccion]]] = [{} for _ in docs]
+
+        def guardar_parcial(i: int, cuenta_index: int, tarea: asyncio.Task) -> None:
+            if tarea.cancelled() or tarea.exception() is not None:
+                return
+            resultado = tarea.result()
+            if not isinstance(resultado, Exception):
+                parciales[i][cuenta_index] = resultado if isinstance(resultado, list) else [resultado]
+
+        async def decidir_ocr() -> Tuple[bool, str]:
+            """Barrera: espera todas las portadas y devuelve (procesar_ocr, motivo si no)."""
+            resultados_portada = await asyncio.gather(*portadas)
+            total_depositos_calculado, es_mayor = total_depositos_verificacion(resultados_portada)
+            cuentas_escaneadas = sum(
+                len(r[0]) for r in resultados_portada if not isinstance(r, Exception) and not r[1]
+            )
+            logger.info(f"Etapa 1: portadas finalizadas. Depósitos: {total_depositos_calculado:,.2f}, cuentas escaneadas: {cuentas_escaneadas}")
+
+            if cuentas_escaneadas > 15:
+                return False, "La cantidad de documentos escaneados supera el límite de 15."
+            if not es_mayor:
+                return False, "Este documento es escaneado y el total de depósitos no supera los $250,000."
+            if cuentas_escaneadas:
+                logger.info(f"Iniciando OCR de {cuentas_escaneadas} cuentas ({limite - loop.time():.0f}s restantes del job).")
+            return True, ""
+
+        decision_ocr = asyncio.create_task(decidir_ocr())
+        registro_jobs.avanzar(ETAPA_PORTADAS, completados=0, total=len(docs))
+
+        async def procesar_documento(i: int, doc: dict) -> List[AnalisisTPV.ResultadoExtraccion]:
+            filename = doc["filename"]
+            tareas_digitales: Dict[int, asyncio.Task] = {}
+
+            def lanzar_cuenta_digital(cuenta_index, datos_cuenta, rango, texto_rango, movimientos_rango):
+                # Los agentes de esta cuenta arrancan sin esperar a las demás cuentas ni documentos
+                tarea = asyncio.create_task(procesar_cuenta_digital(
+                    datos_cuenta, texto_rango, movimientos_rango, f"{filename} (Cta {cuenta_index + 1})", rango
+                ))
+                tarea.add_done_callback(lambda t, k=cuenta_index: guardar_parcial(i, k, t))
+                tareas_digitales[cuenta_index] = tarea
+
+            # --- 1. ANÁLISIS DE LA PORTADA (las cuentas digitales se lanzan conforme quedan listas) ---
             try:
-                for cuenta_index, datos_cuenta in enumerate(lista_cuentas_ia):
-                    # OBTENEMOS EL RANGO CORRESPONDIENTE A ESTA CUENTA
-                    # Como lista_cuentas_ia y rangos_detectados están alineados 1 a 1:
-                    rango_actual = rangos_detectados[cuenta_index] # Ejemplo: (1, 4)
-                    
-                    if es_digital:
-                        documentos_digitales.append({
-                            "index": i,
-                            "sub_index": cuenta_index,
-                            "filename": f"{filename} (Cta {cuenta_index + 1})",
-                            "ia_data": datos_cuenta,
-                            "texto_por_pagina": texto_por_pagina,
-                            "movimientos": movimientos_pagina,
-                            # "content": ... ya no lo pasamos si quitamos pdf_bytes del worker
-                            "rango_paginas": rango_actual # <--- AQUÍ PASAMOS LA TUPLA
-                        })
-                    else:
-                        documentos_escaneados.append({
-                            "index": i,
-                            "sub_index": cuenta_index,
-                            "filename": f"{filename} (Cta {cuenta_index + 1})",
-                            "content": archivos_en_memoria[i]["content"],
-                            "ia_data": datos_cuenta # <--- PASAMOS SOLO EL DICCIONARIO
-                        })
-
-            except Exception as e:
-                logger.error(f"Error al separar cuentas en '{filename}': {e}", exc_info=True)
-                resultados_finales[i] = AnalisisTPV.ErrorRespuesta(
-                    error=f"Error procesando cuentas internas en '{filename}'."
-                )
-
-        logger.info(f"Separación finalizada. Tareas Digitales: {len(documentos_digitales)}, Tareas Escaneadas: {len(documentos_escaneados)}")
-
-        # --- ETAPA 3: PROCESAMIENTO PRINCIPAL (CPU PESADO) ---
-        loop = asyncio.get_running_loop()
-
-        # Listas para guardar las tareas y sus índices originales
-        tareas_digitales = [] # (index, task)
-        tareas_ocr = []       # (index, task)
-
-        # Decisión de OCR
-        procesar_ocr = es_mayor and documentos_escaneados and len(documentos_escaneados) <= 15
-
-        logger.info(f"Etapa 3: Iniciando ProcessPoolExecutor. (Procesar OCR: {procesar_ocr})")
-
-        with ProcessPoolExecutor() as executor:
-            # 3.A - Despachar tareas de Agentes LLM (Digitales)
-            for doc_info in documentos_digitales:
-                tarea = loop.run_in_executor(
-                    executor,
-                    procesar_digital_worker_sync,
-                    doc_info["ia_data"],
-                    doc_info["texto_por_pagina"],
-                    doc_info["movimientos"],
-                    doc_info["filename"],
-                    # doc_info["content"], <--- Quitar si el worker ya no usa pdf_bytes
-                    doc_info["rango_paginas"] # Pasamos la tupla (start, end)
+                resultado_portada = await obtener_y_procesar_portada(prompt_base_fluxo, doc["content"], lanzar_cuenta_digital)
+            except BaseException as e:
+                for tarea in tareas_digitales.values():
+                    tarea.cancel()
+                if not isinstance(e, Exception):
+                    portadas[i].cancel()
+                    raise
+                portadas[i].set_result(e)
+                registro_jobs.avanzar(ETAPA_PORTADAS)
+                registro_jobs.evento(EVENTO_PORTADA_TERMINADA, {"archivo": filename, "error": str(e)})
+                if isinstance(e, PDFCifradoError):
+                    logger.warning(f"Documento número {i} con contraseña")
+                    return [resultado_error("Documento con contraseña, imposible trabajar con este documento.")]
+                logger.error(f"Fallo en el procesamiento inicial de {filename}: {e}")
+                return [resultado_error(f"Fallo el procesamiento inicial de '{filename}': {str(e)}")]
+            portadas[i].set_result(resultado_portada)
+
+            lista_cuentas_ia, es_digital = resultado_portada[0], resultado_portada[1]
+            registro_jobs.avanzar(ETAPA_PORTADAS)
+            registro_jobs.avanzar(ETAPA_CUENTAS, completados=0, total=len(lista_cuentas_ia))
+            registro_jobs.evento(EVENTO_PORTADA_TERMINADA, {
+                "archivo": filename, "cuentas": len(lista_cuentas_ia), "digital": es_digital, "error": None
+            })
+
+            # --- 2.A DIGITAL: solo se espera a las cuentas de ESTE documento ---
+            if es_digital:
+                resultados = await asyncio.gather(*(tareas_digitales[k] for k in sorted(tareas_digitales)), return_exceptions=True)
+                registro_jobs.avanzar(ETAPA_CUENTAS, len(resultados))
+                return [
+                    resultado_error(f"Fallo crítico en worker digital para '{filename}': {str(r)}") if isinstance(r, Exception) else r
+                    for r in resultados
+                ]
+
+            # --- 2.B ESCANEADO: espera la decisión de OCR (única barrera antes del ensamble) ---
+            procesar_ocr, motivo = await decision_ocr
+            if not procesar_ocr:
+                registro_jobs.avanzar(ETAPA_CUENTAS, len(lista_cuentas_ia))
+                return [resultado_error(motivo, datos_cuenta) for datos_cuenta in lista_cuentas_ia]
+
+            tareas_ocr = []
+            for cuenta_index, datos_cuenta in enumerate(lista_cuentas_ia):
+                tarea = asyncio.create_task(
+                    procesar_cuenta_escaneada(datos_cuenta, doc["content"], f"{filename} (Cta {cuenta_index + 1})")
                 )
-                tareas_digitales.append((doc_info["index"], tarea))
-
-            # 3.B - Despachar tareas de OCR (Escaneados)
-            if procesar_ocr:
-                for doc_info in documentos_escaneados:
-                    tarea = loop.run_in_executor(
-                        executor,
-                        procesar_ocr_worker_sync, # Worker para OCR
-                        doc_info["ia_data"],
-                        doc_info["content"],
-                        doc_info["filename"]
-                    )
-                    tareas_ocr.append((doc_info["index"], tarea))
-            else:
-                # 3.C - Manejo de OCR Omitidos (Tu lógica anterior)
-                if documentos_escaneados:
-                    if len(documentos_escaneados) > 15:
-                        error_msg = "La cantidad de documentos escaneados supera el límite de 15."
-                    elif not es_mayor:
-                        error_msg = "Este documento es escaneado y el total de depósitos no supera los $250,000."
-                    else:
-                        error_msg = "El procesamiento OCR fue omitido por seguridad."
-
-                    for doc_info in documentos_escaneados:
-                        error_obj = AnalisisTPV.ErrorRespuesta(error=error_msg)
-                        resultados_finales[doc_info["index"]] = AnalisisTPV.ResultadoExtraccion(
-                            AnalisisIA=doc_info["ia_data"],
-                            DetalleTransacciones=error_obj
-                        )
-
-            # 3.D - Esperar a que los workers terminen (EN DOS GRUPOS SEPARADOS)
-            # Grupo 1: Digitales (sin timeout)
-            resultados_brutos_digitales = []
-            if tareas_digitales:
-                logger.info(f"Esperando que {len(tareas_digitales)} tareas digitales terminen...")
-                resultados_brutos_digitales = await asyncio.gather(*[t[1] for t in tareas_digitales], return_exceptions=True)
-                logger.info("Tareas digitales finalizadas.")
-
-            # Grupo 2: OCR (CON timeout)
-            resultados_brutos_ocr = []
-            ocr_timed_out = False
-            if tareas_ocr:
-                OCR_TIMEOUT_SECONDS = 13 * 60  # 13 minutos
-                logger.info(f"Iniciando {len(tareas_ocr)} tareas de OCR con un límite de {OCR_TIMEOUT_SECONDS}s.")
-                try:
-                    # Ejecutamos las tareas de OCR en paralelo CON TIMEOUT
-                    resultados_brutos_ocr = await asyncio.wait_for(
-                        asyncio.gather(*[t[1] for t in tareas_ocr], return_exceptions=True),
-                        timeout=OCR_TIMEOUT_SECONDS
-                    )
-                    logger.info("Tareas OCR finalizadas.")
-
-                except asyncio.TimeoutError:
-                    ocr_timed_out = True
-                    logger.warning(f"El procesamiento OCR superó el límite de {OCR_TIMEOUT_SECONDS}s y fue cancelado.")
-
-                    error_msg = f"El procesamiento OCR fue cancelado por exceder el límite de {OCR_TIMEOUT_SECONDS} segundos."
-                    error_obj = AnalisisTPV.ErrorRespuesta(error=error_msg)
-
-                    # Llenamos los resultados finales con los datos iniciales de la IA y el error de timeout
-                    for index, _ in tareas_ocr:
-                        # Buscamos el doc_info original que corresponde a esta tarea
-                        doc_info = next(doc for doc in documentos_escaneados if doc["index"] == index)
-                        resultados_finales[index] = AnalisisTPV.ResultadoExtraccion(
-                            AnalisisIA=doc_info["ia_data"],
-                            DetalleTransacciones=error_obj
-                        )
-        logger.info("Etapa 3: Todos los procesos han terminado.")
-
-        # --- 4. RECOLECTAR RESULTADOS (ESTO ES LO QUE FALTABA) ---
-        logger.info("Etapa 4: Procesando resultados crudos de los workers...")
-
-        # Una lista temporal para aplanar todos los resultados (cuentas y sub-cuentas)
-        resultados_acumulados = [] 
-
-        # --- A. Procesar Resultados Digitales ---
-        if tareas_digitales:
-            for i, (index_original, _) in enumerate(tareas_digitales):
-                resultado = resultados_brutos_digitales[i]
-                filename = archivos_en_memoria[index_original]["filename"]
-
+                tarea.add_done_callback(lambda t, k=cuenta_index: guardar_parcial(i, k, t))
+                tareas_ocr.append(tarea)
+            # El límite del job (y su cancelación) lo vigila 'esperar_documentos'
+            resultados = await asyncio.gather(*tareas_ocr, return_exceptions=True)
+            registro_jobs.avanzar(ETAPA_CUENTAS, len(resultados))
+            acumulados = []
+            for resultado in resultados:
                 if isinstance(resultado, Exception):
-                    # Falló el worker completo
-                    error_msg = f"Fallo crítico en worker digital para '{filename}': {str(resultado)}"
-                    resultados_acumulados.append(AnalisisTPV.ResultadoExtraccion(
-                        AnalisisIA=None,
-                        DetalleTransacciones=AnalisisTPV.ErrorRespuesta(error=error_msg)
-                    ))
+                    acumulados.append(resultado_error(f"Fallo crítico en worker OCR para '{filename}': {str(resultado)}"))
                 elif isinstance(resultado, list):
-                    # El worker devolvió una LISTA de resultados (Multicuenta o normal)
-                    # Los agregamos todos a la lista final
-                    resultados_acumulados.extend(resultado)
+                    acumulados.extend(resultado)
                 else:
-                    # Caso raro (por si acaso devuelve un objeto único)
-                    resultados_acumulados.append(resultado)
-
-        # --- B. Procesar Resultados OCR ---
-        if tareas_ocr:
-            if ocr_timed_out:
-                # Si hubo timeout, ya llenamos resultados_finales en el bloque 'except',
-                # pero necesitamos pasarlos a nuestra lista acumulada.
-                for index, _ in tareas_ocr:
-                    if resultados_finales[index]: # Si ya tiene el error de timeout asignado
-                        resultados_acumulados.append(resultados_finales[index])
+                    acumulados.append(resultado)
+            return acumulados
+
+        # --- PIPELINE POR DOCUMENTO ---
+        logger.info(f"Procesando {len(docs)} documentos en pipeline (portada -> extracción por documento y cuenta)")
+        async def procesar_y_contar(i: int, doc: dict) -> List[AnalisisTPV.ResultadoExtraccion]:
+            try:
+                return await procesar_documento(i, doc)
+            finally:
+                registro_jobs.avanzar(ETAPA_DOCUMENTOS)
+
+        async def esperar_documentos(tareas: List[asyncio.Task]) -> Union[Tuple[EstadoRegistroJob, str], None]:
+            """
+            Espera los documentos hasta que terminen, venza el límite del job o alguien pida cancelarlo
+            (desde cualquier proceso). Devuelve (estado, motivo) si hubo que detenerlos.
+            """
+            pendientes = set(tareas)
+            while pendientes:
+                restante = limite - loop.time()
+                if restante <= 0:
+                    return EstadoRegistroJob.PARCIAL, f"Se alcanzó el límite de {limite_job:.0f} segundos del trabajo."
+                _, pendientes = await asyncio.wait(pendientes, timeout=min(restante, settings.JOBS_EVENTOS_INTERVALO_SEGUNDOS))
+                motivo = await asyncio.to_thread(registro_jobs.cancelacion_solicitada, job_id)
+                if motivo:
+                    return EstadoRegistroJob.CANCELADO, motivo
+            return None
+
+        tareas_documentos = [asyncio.create_task(procesar_y_contar(i, doc)) for i, doc in enumerate(docs)]
+        parada = await esperar_documentos(tareas_documentos)
+        if parada is not None:
+            # Cancelar propaga a las llamadas LLM en curso, a las tareas del pool que no empezaron
+            # y a las unidades de la cola; lo ya terminado queda en 'parciales'
+            logger.warning(f"Job {job_id} detenido: {parada[1]}")
+            for tarea in tareas_documentos:
+                tarea.cancel()
+            await asyncio.gather(*tareas_documentos, return_exceptions=True)
+            # Solo las páginas que ningún otro job en curso está usando (el mismo PDF puede estar en varios)
+            liberados = sum(
+                cache_imagenes.descartar_documento(hash_documento, reservas_propias=hashes.count(hash_documento))
+                for hash_documento in set(hashes)
+            )
+            logger.info(f"Job {job_id}: {liberados / 1024 / 1024:.1f} MB de páginas rasterizadas liberadas.")
+        if not decision_ocr.done():
+            decision_ocr.cancel()
+
+        def resultados_parciales(i: int, motivo: str) -> List[AnalisisTPV.ResultadoExtraccion]:
+            """Las cuentas del documento que alcanzaron a terminar y un error por cada una que no."""
+            if not portadas[i].done() or portadas[i].cancelled() or isinstance(portadas[i].result(), Exception):
+                return [resultado_error(f"'{docs[i]['filename']}': {motivo}")]
+            cuentas = portadas[i].result()[0]
+            acumulados = []
+            for cuenta_index, datos_cuenta in enumerate(cuentas):
+                acumulados.extend(parciales[i].get(cuenta_index) or [resultado_error(motivo, datos_cuenta)])
+            return acumulados
+
+        # --- ENSAMBLE: resultados en orden de documento y de cuenta ---
+        resultados_validos: List[AnalisisTPV.ResultadoExtraccion] = []
+        for i, (doc, tarea) in enumerate(zip(docs, tareas_documentos)):
+            if tarea.cancelled():
+                resultados_validos.extend(resultados_parciales(i, parada[1]))
+                continue
+            resultado = tarea.exception() or tarea.result()
+            if isinstance(resultado, Exception):
+                logger.error(f"Error procesando '{doc['filename']}': {resultado}", exc_info=resultado)
+                resultados_validos.append(resultado_error(f"Error procesando cuentas internas en '{doc['filename']}'."))
             else:
-                for i, (index_original, _) in enumerate(tareas_ocr):
-                    resultado = resultados_brutos_ocr[i]
-                    filename = archivos_en_memoria[index_original]["filename"]
-
-                    if isinstance(resultado, Exception):
-                        error_msg = f"Fallo crítico en worker OCR para '{filename}': {str(resultado)}"
-                        resultados_acumulados.append(AnalisisTPV.ResultadoExtraccion(
-                            AnalisisIA=None,
-                            DetalleTransacciones=AnalisisTPV.ErrorRespuesta(error=error_msg)
-                        ))
-                    elif isinstance(resultado, list):
-                        resultados_acumulados.extend(resultado)
-                    else:
-                        resultados_acumulados.append(resultado)
-
-        # --- C. Agregar los que se saltaron OCR (Omitidos) ---
-        # Buscamos en resultados_finales aquellos que ya tengan un error asignado (paso 3.C)
-        # y que no hayan sido procesados por las tareas anteriores.
-        indices_procesados = {t[0] for t in tareas_digitales} | {t[0] for t in tareas_ocr}
-
-        for i, res in enumerate(resultados_finales):
-            if i not in indices_procesados and res is not None:
-                resultados_acumulados.append(res)
-
-        # --- 5. ENSAMBLE FINAL ---
-        resultados_validos = [res for res in resultados_acumulados if res is not None]
-        
+                resultados_validos.extend(res for res in resultado if res is not None)
+        logger.info(f"Todos los documentos terminaron. Resultados individuales: {len(resultados_validos)}")
+
+        # --- ENSAMBLE FINAL ---
         resultados_generales = [
             res.AnalisisIA for res in resultados_validos 
             if res.AnalisisIA is not None
@@ -352,61 +304,224 @@ async def procesar_pdf_api(
         )
 
         # 1. Convertir a Excel (Bytes)
+        registro_jobs.avanzar(ETAPA_REPORTE, completados=0, total=1)
         datos_dict = jsonable_encoder(respuesta_final)
-        excel_bytes = generar_excel_reporte(datos_dict)
+        excel_bytes = await ejecutar_cpu(generar_excel_reporte, datos_dict)
         
         # 2. Guardar JSON (Opcional, útil para debug/frontend)
         guardar_json_local(datos_dict, job_id)
 
         # 3. Guardar Excel
         guardar_excel_local(excel_bytes, job_id)
+        registro_jobs.avanzar(ETAPA_REPORTE)
+        registro_jobs.evento(EVENTO_REPORTE_LISTO, {"resultados": len(resultados_validos)})
         
-        logger.info(f"Job {job_id} finalizado. Excel generado.")
+        eventos_llm = await asyncio.to_thread(contadores_job.obtener, job_id)
+        logger.info(f"Job {job_id} finalizado. Excel generado. Eventos LLM: {eventos_llm}")
+        errores = sum(isinstance(res.DetalleTransacciones, AnalisisTPV.ErrorRespuesta) for res in resultados_validos)
+        # Un fragmento fallido deja su cuenta incompleta aunque el resto de sus transacciones sí llegara
+        chunks_fallidos = eventos_llm.get(EVENTO_CHUNKS_FALLIDOS, 0)
+        faltantes = f" {chunks_fallidos} fragmentos de transacciones fallaron." if chunks_fallidos else ""
+        if parada is not None:
+            estado, motivo = parada
+            return estado, f"{motivo} {errores} de {len(resultados_validos)} resultados sin terminar o con error.{faltantes}"
+        if errores or chunks_fallidos:
+            return EstadoRegistroJob.PARCIAL, f"{errores} de {len(resultados_validos)} resultados con error.{faltantes}"
+        return EstadoRegistroJob.TERMINADO, None
 
-    # 4. LANZAR AL FONDO Y RESPONDER INMEDIATAMENTE
+    async def tarea_pesada_background(job_id: str, docs: list):
+        # Las llamadas LLM de este job (portadas incluidas) suman a sus contadores de reintentos/coberturas
+        job_actual.set(job_id)
+        registro_jobs.iniciar(job_id)
+        hashes: List[str] = []
+        try:
+            # Mientras el job corre, su cancelación no le quita las páginas a otro job con el mismo PDF
+            hashes = await asyncio.to_thread(lambda: [calcular_hash_documento(doc["content"]) for doc in docs])
+            for hash_documento in hashes:
+                cache_imagenes.reservar_documento(hash_documento)
+            estado_final, resumen_errores = await ejecutar_job(job_id, docs, hashes)
+        except asyncio.CancelledError:
+            # Apagado del servidor o tarea cancelada: el job no queda 'procesando' para siempre
+            logger.warning(f"Job {job_id} cancelado antes de terminar.")
+            registro_jobs.terminar(job_id, EstadoRegistroJob.CANCELADO, "El procesamiento se interrumpió antes de terminar.")
+            raise
+        except Exception as e:
+            logger.error(f"Job {job_id} falló: {e}", exc_info=True)
+            registro_jobs.fallar(job_id, f"{type(e).__name__}: {e}")
+            return
+        finally:
+            for hash_documento in hashes:
+                cache_imagenes.soltar_documento(hash_documento)
+        registro_jobs.terminar(job_id, estado_final, resumen_errores)
+
+    # 4. REGISTRAR, LANZAR AL FONDO Y RESPONDER INMEDIATAMENTE
+    await asyncio.to_thread(
+        registro_jobs.crear, job_id, documentos=len(archivos_en_memoria), archivos=[doc["filename"] for doc in archivos_en_memoria]
+    )
     background_tasks.add_task(tarea_pesada_background, job_id, archivos_en_memoria)
 
     return RespuestaProcesamientoIniciado(
         mensaje="El procesamiento ha comenzado. Usa el job_id para descargar el resultado en unos minutos.",
         job_id=job_id,
-        estatus="procesando"
+        estatus=EstadoRegistroJob.EN_COLA.value
     )
 
+def _info_job_legado(job_id: str) -> Union[InfoJob, None]:
+    """
+    Jobs anteriores al registro durable: no tienen fila en la base, pero si su resultado está en
+    disco se reportan terminados (como respondía antes la descarga). Lee el disco: usar asyncio.to_thread.
+    """
+    ruta_archivo = obtener_ruta_archivo(job_id)
+    if ruta_archivo is None and obtener_datos_json(job_id) is None:
+        return None
+    momento = os.path.getmtime(ruta_archivo) if ruta_archivo else time.time()
+    return InfoJob(job_id=job_id, estado=EstadoRegistroJob.TERMINADO, creado=momento, actualizado=momento, terminado=momento)
+
+async def _info_job_o_404(job_id: str) -> InfoJob:
+    info = await asyncio.to_thread(registro_jobs.obtener, job_id)
+    if info is None:
+        info = await asyncio.to_thread(_info_job_legado, job_id)
+    if info is None:
+        raise HTTPException(status_code=404, detail="El ID de trabajo no existe.")
+    return info
+
+async def _estado_respuesta(info: InfoJob) -> EstadoJob:
+    return EstadoJob(
+        job_id=info.job_id,
+        estatus=info.estado.value,
+        creado=info.creado,
+        actualizado=info.actualizado,
+        iniciado=info.iniciado,
+        terminado=info.terminado,
+        error=info.error,
+        progreso=info.progreso,
+        eventos_llm=await asyncio.to_thread(contadores_job.obtener, info.job_id)
+    )
+
+@router.get(
+        "/fluxo/estado/{job_id}",
+        response_model=EstadoJob,
+        summary="Estado, avance por etapa y errores de un trabajo de Fluxo."
+    )
+async def estado_job(
+    job_id: str,
+    esperar: float = Query(0, ge=0, description="Long-poll: segundos a esperar a que el trabajo termine antes de responder (0 = responder ya).")
+):
+    """
+    Consulta barata del trabajo (no lee el resultado): estado (en_cola, procesando, parcial,
+    terminado, cancelado, fallido), avance por etapa (completados / total), marcas de tiempo y resumen de errores.
+    Con 'esperar' la respuesta llega en cuanto el trabajo termina, o al vencer la espera con el avance actual.
+    """
+    info = await _info_job_o_404(job_id)
+    loop = asyncio.get_running_loop()
+    limite = loop.time() + min(esperar, settings.JOBS_ESPERA_MAXIMA_SEGUNDOS)
+    while info.activo and loop.time() < limite:
+        await asyncio.sleep(min(settings.JOBS_EVENTOS_INTERVALO_SEGUNDOS, max(0.0, limite - loop.time())))
+        info = await asyncio.to_thread(registro_jobs.obtener, job_id) or info
+    return await _estado_respuesta(info)
+
+def _mensaje_sse(evento: str, datos: dict, id_evento: Union[int, None] = None) -> str:
+    lineas = [f"id: {id_evento}"] if id_evento is not None else []
+    lineas += [f"event: {evento}", f"data: {json.dumps(datos, default=str)}"]
+    return "\n".join(lineas) + "\n\n"
+
+# Sin eventos nuevos, un comentario cada tantos segundos evita que proxies cierren la conexión
+SSE_KEEPALIVE_SEGUNDOS = 15.0
+MAX_EVENTOS_POR_LECTURA = 500
+
+@router.get("/fluxo/eventos/{job_id}", summary="Stream (SSE) de los eventos y el avance de un trabajo de Fluxo.")
+async def eventos_job(job_id: str, request: Request, last_event_id: Union[int, None] = Header(None)):
+    """
+    Server-sent events del trabajo: documentos aceptados, portada terminada por archivo, chunks
+    terminados (texto y OCR, con sus páginas), reporte listo y trabajo terminado. Después de cada
+    tanda de eventos manda un evento 'progreso' con el avance por etapa (completados / total).
+    El stream se cierra al terminar el trabajo; al reconectar, el cliente retoma desde Last-Event-ID.
+    """
+    await _info_job_o_404(job_id)
+
+    async def transmitir() -> AsyncIterator[str]:
+        loop = asyncio.get_running_loop()
+        ultimo_id = last_event_id or 0
+        ultimo_envio = loop.time()
+        while not await request.is_disconnected():
+            # Primero el estado y luego los eventos: si el job ya terminó, su evento final ya está escrito
+            info = await asyncio.to_thread(registro_jobs.obtener, job_id)
+            if info is None:
+                # Job anterior al registro durable: solo se sabe que terminó
+                if not ultimo_id:
+                    yield _mensaje_sse(EVENTO_JOB_TERMINADO, {"estatus": EstadoRegistroJob.TERMINADO.value, "error": None})
+                return
+            eventos = await asyncio.to_thread(registro_jobs.eventos, job_id, ultimo_id, MAX_EVENTOS_POR_LECTURA)
+            for evento in eventos:
+                yield _mensaje_sse(evento.tipo, {**evento.datos, "momento": evento.momento}, evento.id)
+                ultimo_id = evento.id
+            if eventos:
+                yield _mensaje_sse("progreso", {"estatus": info.estado.value, "progreso": info.progreso})
+                ultimo_envio = loop.time()
+            elif loop.time() - ultimo_envio >= SSE_KEEPALIVE_SEGUNDOS:
+                yield ": keepalive\n\n"
+                ultimo_envio = loop.time()
+            if len(eventos) == MAX_EVENTOS_POR_LECTURA:
+                continue # Quedan eventos atrasados por mandar
+            if not info.activo:
+                return
+            await asyncio.sleep(settings.JOBS_EVENTOS_INTERVALO_SEGUNDOS)
+
+    return StreamingResponse(
+        transmitir(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post(
+        "/fluxo/cancelar/{job_id}",
+        response_model=EstadoJob,
+        status_code=202,
+        summary="Cancela un trabajo de Fluxo en curso."
+    )
+async def cancelar_job(job_id: str):
+    """
+    Pide detener el trabajo: las llamadas LLM, el OCR y las tareas del pool en curso se cancelan y el
+    trabajo queda 'cancelado' con las cuentas que alcanzaron a terminar (descargables como siempre).
+    La cancelación es asíncrona: sigue el estado en /fluxo/estado o /fluxo/eventos.
+    """
+    await _info_job_o_404(job_id)
+    if not await asyncio.to_thread(registro_jobs.solicitar_cancelacion, job_id):
+        raise HTTPException(status_code=409, detail="El trabajo ya terminó; no hay nada que cancelar.")
+    return await _estado_respuesta(await asyncio.to_thread(registro_jobs.obtener, job_id))
+
 @router.get("/fluxo/descargar-resultado/{job_id}")
 async def descargar_resultado(
     job_id: str,
     formato: str = Query("excel", enum=["excel", "json"], description="El formato de respuesta deseado: 'excel' para descargar archivo, 'json' para ver datos.")
 ):
     """
-    Consulta el estado del trabajo. Si terminó, devuelve:
+    Devuelve el resultado de un trabajo terminado (o parcial / cancelado, con lo que alcanzó a terminar):
     1. El objeto JSON completo del análisis.
-    2. El contenido del CSV en formato string para descarga en frontend.
+    2. El Excel del reporte para descarga en frontend.
+    Mientras el trabajo sigue en cola o procesando responde 202 con su estado; si falló, 500 con el error.
     """
+    info = await _info_job_o_404(job_id)
+    if info.estado in (EstadoRegistroJob.EN_COLA, EstadoRegistroJob.PROCESANDO):
+        return JSONResponse(
+            status_code=202,
+            content={"job_id": job_id, "estatus": info.estado.value, "detalle": "El trabajo sigue en proceso. Consulta /fluxo/estado (o /fluxo/eventos) para ver su avance."}
+        )
+    if info.estado == EstadoRegistroJob.FALLIDO:
+        raise HTTPException(status_code=500, detail=f"El trabajo falló: {info.error}")
+
     if formato == "json":
         datos = obtener_datos_json(job_id)
         if datos:
             return datos # FastAPI lo convierte a JSON response automáticamente
-        else:
-            # Si no hay JSON, revisamos si sigue procesando o falló
-            raise HTTPException(
-                status_code=404, 
-                detail="Los datos no están listos aún o el ID es incorrecto."
-            )
-    else:
-        ruta_archivo = obtener_ruta_archivo(job_id)
-        if ruta_archivo:
-            return FileResponse(
-                path=ruta_archivo, 
-                filename=f"Reporte_Analisis_{job_id}.xlsx", # Extensión .xlsx
-                # MIME type oficial para Excel .xlsx
-                media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-            )
-
-        else:
-            # Si no existe aún, asumimos que sigue procesando (o falló/no existe)
-            # En un sistema real usaríamos una DB para diferenciar "procesando" de "falló",
-            # pero para esto, un 404 o 202 es suficiente.
-            raise HTTPException(
-                status_code=404, 
-                detail="El archivo no está listo aún o el ID es incorrecto. Intenta de nuevo en unos momentos."
-            )
\ No newline at end of file
+        raise HTTPException(status_code=404, detail="El trabajo terminó pero no se encontró su resultado.")
+
+    ruta_archivo = obtener_ruta_archivo(job_id)
+    if ruta_archivo:
+        return FileResponse(
+            path=ruta_archivo, 
+            filename=f"Reporte_Analisis_{job_id}.xlsx", # Extensión .xlsx
+            # MIME type oficial para Excel .xlsx
+            media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+        )
+    raise HTTPException(status_code=404, detail="El trabajo terminó pero no se encontró su reporte.")
@@ -1,6 +1,6 @@
 import logging
 from enum import Enum
-from typing import List
+from typing import Dict, List, Optional
 
 from dotenv import load_dotenv
 from pydantic import field_validator, ValidationError, SecretStr
@@ -54,6 +54,81 @@ class Settings(BaseSettings):
     MAX_FILE_SIZE_MB: int = 10
     UPLOAD_DIR: str = "uploads"
     ALLOWED_EXTENSION: List[str] = [".pdf"]
+
+    # Cache de imágenes para los modelos de visión
+    IMAGE_CACHE_MAX_MB: int = 256
+
+    # Perfiles de codificación de imágenes por tipo de documento (ver services/perfiles_imagen.py)
+    IMAGE_PROFILE_FLUXO: str = "estado_cuenta"
+    IMAGE_PROFILE_OCR_VISION: str = "ocr_vision"
+    IMAGE_PROFILE_NOMI: str = "nomina"
+
+    # Transporte HTTP compartido por los clientes LLM (ver services/llm_clients.py)
+    LLM_MAX_CONNECTIONS: int = 100
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = 20
+    LLM_KEEPALIVE_EXPIRY_SECONDS: float = 60.0
+    LLM_HTTP2: bool = True # Solo aplica si el paquete 'h2' está instalado
+    LLM_MAX_RETRIES: int = 3 # Reintentos propios con backoff (ver services/llm_resiliencia.py); el SDK no reintenta
+    LLM_RETRY_BASE_SECONDS: float = 1.0
+    LLM_RETRY_MAX_SECONDS: float = 30.0
+    LLM_CONNECT_TIMEOUT_SECONDS: float = 10.0
+    LLM_TIMEOUT_SECONDS: float = 300.0 # Llamadas de texto (agentes TPV, CSF)
+    LLM_TIMEOUT_VISION_SECONDS: float = 180.0 # Llamadas con imágenes (portadas, OCR-Visión, NomiFlash)
+
+    # Cache persistente de respuestas LLM (ver services/llm_cache.py)
+    LLM_CACHE_ENABLED: bool = True
+    LLM_CACHE_PATH: str = "cache/llm_respuestas.sqlite3"
+    LLM_CACHE_TTL_HOURS: float = 24 * 7
+    LLM_CACHE_MAX_MB: int = 512
+
+    # Gobernador global de concurrencia LLM (ver services/llm_governor.py)
+    # Límites por cliente: en vuelo, solicitudes/minuto y tokens/minuto de cada API key
+    LLM_GOVERNOR_ENABLED: bool = True
+    LLM_GOVERNOR_PATH: str = "cache/llm_gobernador.sqlite3"
+    LLM_GOVERNOR_LIMITS: Dict[str, Dict[str, int]] = {
+        "fluxo": {"concurrentes": 16, "rpm": 500, "tpm": 800000},
+        "nomi": {"concurrentes": 8, "rpm": 500, "tpm": 800000},
+        "openrouter": {"concurrentes": 16, "rpm": 300, "tpm": 1000000},
+    }
+
+    # Portadas: si el regex ya resolvió banco, RFC, comisiones y depósitos, se consulta a un solo
+    # modelo por los campos faltantes y solo se escala a GPT + Qwen si hay huecos o desacuerdos
+    PORTADA_MODO_ADAPTATIVO: bool = True
+
+    # Transacciones de estados digitales: los bancos con plantilla se extraen localmente por posiciones
+    # (ver services/transacciones_locales.py); el LLM solo recibe las páginas que no validan
+    EXTRACCION_LOCAL_ENABLED: bool = True
+
+    # Chunks de los agentes TPV (ver services/planificador_chunks.py): páginas empacadas hasta un
+    # presupuesto de tokens; la superposición son solo las últimas líneas de la página anterior
+    CHUNK_PRESUPUESTO_TOKENS: int = 8000
+    CHUNK_LINEAS_SUPERPOSICION: int = 8
+
+    # Cobertura (hedging) de los agentes por chunk: si la llamada pasa del p95 de latencia,
+    # se manda un duplicado al proveedor alterno y gana la primera respuesta válida
+    LLM_HEDGE_ENABLED: bool = True
+    LLM_HEDGE_DEFAULT_SECONDS: float = 120.0 # Umbral mientras no haya muestras suficientes para el p95
+    LLM_HEDGE_MIN_SECONDS: float = 20.0 # Nunca cubrir antes de este tiempo aunque el p95 sea menor
+    LLM_HEDGE_MIN_SAMPLES: int = 20
+    LLM_METRICS_PATH: str = "cache/llm_metricas.sqlite3" # Contadores de reintentos/coberturas por job
+    JOBS_DB_PATH: str = "cache/jobs.sqlite3" # Estado y avance durable de los jobs (ver services/job_store.py)
+    JOBS_EVENTOS_INTERVALO_SEGUNDOS: float = 0.5 # Cada cuánto revisan el stream SSE y el long-poll si hay novedades
+    JOBS_ESPERA_MAXIMA_SEGUNDOS: float = 60.0 # Tope del long-poll de /fluxo/estado
+    JOBS_RETENCION_HORAS: float = 24 * 7 # Los jobs terminados (estado, avance y eventos) se borran pasado este tiempo
+    JOB_LIMITE_SEGUNDOS: float = 20 * 60 # Límite de cada job de Fluxo; al vencer se entrega lo que ya terminó
+
+    # Pool de procesos worker compartido por todos los jobs (ver services/pool_workers.py)
+    POOL_WORKERS_MAX: Optional[int] = None # None = número de CPUs
+    POOL_WORKERS_DRENADO_SEGUNDOS: float = 120.0 # Espera máxima a las tareas en vuelo al apagar la app
+
+    # Cola de unidades de trabajo para workers fuera de la API (ver services/cola_trabajo.py y worker.py)
+    COLA_TRABAJO_HABILITADA: bool = False # True = rasterizado, agentes TPV y reporte los ejecutan los workers
+    COLA_TRABAJO_PATH: str = "cache/cola_trabajo.sqlite3" # En un disco compartido por la API y los workers
+    COLA_LEASE_SEGUNDOS: float = 120.0 # Si un worker no renueva en este tiempo, otro retoma la unidad
+    COLA_MAX_INTENTOS: int = 3
+    COLA_INTERVALO_SONDEO_SEGUNDOS: float = 0.25
+    COLA_WORKER_CONCURRENCIA: int = 16 # Unidades simultáneas por proceso worker (las de CPU van a su pool local)
+    COLA_PURGA_INTERVALO_SEGUNDOS: float = 3600.0 # Cada cuánto un worker borra de la cola las unidades que nadie va a leer
     
     class Config:
         env_file = ".env"
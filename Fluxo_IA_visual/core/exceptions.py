@@ -2,4 +2,16 @@
 # Clase de excepción
 class PDFCifradoError(Exception):
     """Excepción personalizada para PDFs protegidos por contraseña."""
-    pass
\ No newline at end of file
+    pass
+
+class OCRTiempoExcedidoError(Exception):
+    """Excepción para cuando el OCR de un documento supera su tiempo límite."""
+    pass
+
+class PoolWorkersCerradoError(Exception):
+    """Excepción para tareas enviadas al pool de workers mientras la aplicación se apaga."""
+    pass
+
+class UnidadTrabajoError(Exception):
+    """Excepción para unidades de la cola de trabajo que fallaron en el worker."""
+    pass
@@ -1,7 +1,13 @@
 from .core.config import settings
 from .api.endpoints import router_fluxo, router_csf, router_nomi
+from .services.llm_clients import registro_clientes_llm
+from .services.pool_workers import pool_workers
+from .services.ocr_engine import obtener_motor_ocr
+from .services.job_store import registro_jobs
+from .services.ia_extractor import gobernador_llm, contadores_job
 
 import sys
+import asyncio
 import logging
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
@@ -25,10 +31,28 @@ async def lifespan(app: FastAPI):
     logger.info(f"Iniciando {settings.PROJECT_NAME} v{settings.APP_VERSION}")
     logger.info(f"Modo Debug: {settings.DEBUG}")
     logger.info(f"Creado por: {settings.DEV_NAME}")
+
+    # Clientes LLM de larga vida (pool de conexiones compartido) ligados al loop de la app
+    registro_clientes_llm.iniciar()
+    # Pool de procesos compartido por los jobs (los workers precargan módulos y clientes LLM)
+    pool_workers.iniciar()
+    # Los jobs que quedaron 'procesando' por un reinicio ya no van a terminar: se marcan como fallidos
+    registro_jobs.recuperar_interrumpidos()
+    # Retención: estado, avance y eventos de jobs viejos (después se repite cada hora)
+    await asyncio.to_thread(registro_jobs.purgar)
+    # Permisos LLM de una ejecución anterior (PIDs que el reinicio pudo reutilizar) no esperan a vencer
+    await asyncio.to_thread(gobernador_llm.limpiar_arranques_anteriores)
         
     yield
     # Código de apagado
     logger.info("Cerrando la aplicación.")
+    # Drena las tareas en vuelo sin bloquear el event loop
+    await asyncio.to_thread(pool_workers.cerrar)
+    await asyncio.to_thread(obtener_motor_ocr().cerrar)
+    await registro_clientes_llm.cerrar()
+    # Estado final de los jobs que terminaron durante el drenado
+    await asyncio.to_thread(registro_jobs.vaciar)
+    await asyncio.to_thread(contadores_job.vaciar)
 
 # Inicialización de la aplicación FastAPI
 app = FastAPI(
@@ -1,10 +1,27 @@
-from typing import List, Optional, Self, Union
+from typing import Dict, List, Optional, Self, Union
+from datetime import datetime
 from pydantic import BaseModel, Field, field_validator, model_validator
 
 class RespuestaProcesamientoIniciado(BaseModel):
     mensaje: str
     job_id: str
     estatus: str
+
+class ProgresoEtapa(BaseModel):
+    completados: int = 0
+    total: int = 0
+
+class EstadoJob(BaseModel):
+    """Estado de un job de Fluxo sin su resultado (en_cola, procesando, parcial, terminado, cancelado o fallido)."""
+    job_id: str
+    estatus: str
+    creado: datetime
+    actualizado: datetime
+    iniciado: Optional[datetime] = None
+    terminado: Optional[datetime] = None
+    error: Optional[str] = None
+    progreso: Dict[str, ProgresoEtapa] = {}
+    eventos_llm: Dict[str, int] = {}
     
 # ---- Modelos base reutilizables ----
 class ErrorRespuestaBase(BaseModel):
@@ -0,0 +1,258 @@
+# Cola durable de unidades de trabajo (SQLite): los nodos de la API encolan el trabajo pesado
+# de un job (rasterizado, agentes TPV por chunk, reporte) y cualquier número de procesos
+# 'python -m Fluxo_IA_visual.worker' lo reclaman y ejecutan
+from ..core.config import settings
+from ..core.exceptions import UnidadTrabajoError
+from .pool_workers import pool_workers
+from .llm_resiliencia import job_actual
+
+from dataclasses import dataclass
+from enum import Enum
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import threading
+import sqlite3
+import asyncio
+import logging
+import pickle
+import socket
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Tipos de unidad (el worker tiene un manejador por tipo, ver worker.py)
+TIPO_CPU = "cpu" # (funcion, *args) de módulo: rasterizado de páginas, reporte Excel
+TIPO_AGENTE_TPV = "agente_tpv" # (banco, texto_chunk, paginas): un chunk para el agente TPV
+
+class EstadoUnidad(str, Enum):
+    PENDIENTE = "pendiente"
+    EN_CURSO = "en_curso"
+    HECHA = "hecha"
+    FALLIDA = "fallida"
+    CANCELADA = "cancelada"
+
+ESTADOS_FINALES = (EstadoUnidad.HECHA, EstadoUnidad.FALLIDA)
+
+@dataclass
+class UnidadTrabajo:
+    """Una unidad reclamada por un worker: qué ejecutar y con qué argumentos."""
+    id: int
+    job_id: Optional[str]
+    tipo: str
+    argumentos: Tuple
+    intentos: int
+
+def propietario_worker() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+class ColaTrabajo:
+    """
+    Cola de unidades sobre SQLite (WAL). Del lado de la API, 'ejecutar' encola y espera el resultado;
+    un solo sondeo por proceso revisa en lote todas las unidades pendientes de respuesta.
+    Del lado del worker, 'reclamar' toma la siguiente unidad con un lease que se renueva mientras
+    corre; si el worker muere, el lease vence y otro la retoma (hasta COLA_MAX_INTENTOS).
+    El archivo debe vivir en un disco compartido por la API y los workers con bloqueos POSIX funcionales.
+    """
+    def __init__(
+        self,
+        ruta: str,
+        habilitada: bool = False,
+        lease_segundos: Optional[float] = None,
+        max_intentos: Optional[int] = None,
+        intervalo_sondeo: Optional[float] = None
+    ):
+        self.ruta = ruta
+        self.habilitada = habilitada
+        self.lease_segundos = lease_segundos or settings.COLA_LEASE_SEGUNDOS
+        self.max_intentos = max_intentos or settings.COLA_MAX_INTENTOS
+        self.intervalo_sondeo = intervalo_sondeo or settings.COLA_INTERVALO_SONDEO_SEGUNDOS
+        self._local = threading.local()
+        self._esperando: Dict[int, asyncio.Future] = {}
+        self._sondeo: Optional[asyncio.Task] = None
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión SQLite no debe cruzar un fork ni compartirse entre hilos
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self.ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS unidades (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT,
+                    tipo TEXT NOT NULL,
+                    argumentos BLOB NOT NULL,
+                    estado TEXT NOT NULL,
+                    prioridad INTEGER NOT NULL DEFAULT 0,
+                    intentos INTEGER NOT NULL DEFAULT 0,
+                    propietario TEXT,
+                    lease_hasta REAL,
+                    resultado BLOB,
+                    error TEXT,
+                    creado REAL NOT NULL
+                )"""
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_unidades_estado ON unidades (estado, prioridad DESC, id)")
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    # ----- Lado de la API -----
+    def encolar(self, tipo: str, *argumentos: Any, job_id: Optional[str] = None, prioridad: int = 0) -> int:
+        datos = pickle.dumps(argumentos, protocol=pickle.HIGHEST_PROTOCOL)
+        cursor = self._conexion().execute(
+            "INSERT INTO unidades (job_id, tipo, argumentos, estado, prioridad, creado) VALUES (?, ?, ?, ?, ?, ?)",
+            (job_id, tipo, datos, EstadoUnidad.PENDIENTE.value, prioridad, time.time())
+        )
+        return cursor.lastrowid
+
+    def cancelar(self, unidad_id: int) -> None:
+        """
+        Saca una unidad de la cola; si ya corre, el worker la suelta en su siguiente renovación de lease.
+        Si ya había terminado, su resultado no lo va a leer nadie: se borra.
+        """
+        conexion = self._conexion()
+        conexion.execute(
+            "UPDATE unidades SET estado = ?, argumentos = X'' WHERE id = ? AND estado IN (?, ?)",
+            (EstadoUnidad.CANCELADA.value, unidad_id, EstadoUnidad.PENDIENTE.value, EstadoUnidad.EN_CURSO.value)
+        )
+        conexion.execute(
+            "DELETE FROM unidades WHERE id = ? AND estado IN (?, ?)", (unidad_id, *(e.value for e in ESTADOS_FINALES))
+        )
+
+    def _leer_terminadas(self, ids: List[int]) -> List[Tuple[int, str, Optional[bytes], Optional[str]]]:
+        conexion = self._conexion()
+        marcadores = ",".join("?" * len(ids))
+        filas = conexion.execute(
+            f"SELECT id, estado, resultado, error FROM unidades WHERE id IN ({marcadores}) AND estado IN (?, ?)",
+            (*ids, *(e.value for e in ESTADOS_FINALES))
+        ).fetchall()
+        if filas:
+            # El resultado ya se leyó: la fila no se necesita más
+            terminadas = [fila[0] for fila in filas]
+            conexion.execute(f"DELETE FROM unidades WHERE id IN ({','.join('?' * len(terminadas))})", terminadas)
+        return filas
+
+    async def _sondear(self) -> None:
+        while self._esperando:
+            await asyncio.sleep(self.intervalo_sondeo)
+            ids = [i for i, futuro in self._esperando.items() if not futuro.done()]
+            if not ids:
+                continue
+            try:
+                filas = await asyncio.to_thread(self._leer_terminadas, ids)
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudo consultar la cola de trabajo: {e}")
+                continue
+            for unidad_id, estado, resultado, error in filas:
+                futuro = self._esperando.get(unidad_id)
+                if futuro is None or futuro.done():
+                    continue
+                if estado == EstadoUnidad.HECHA.value:
+                    futuro.set_result(pickle.loads(resultado))
+                else:
+                    futuro.set_exception(UnidadTrabajoError(f"La unidad {unidad_id} falló en el worker: {error}"))
+
+    async def ejecutar(self, tipo: str, *argumentos: Any, prioridad: int = 0) -> Any:
+        """Encola la unidad (con el job del contexto) y espera su resultado; al cancelarse, la cancela en la cola."""
+        unidad_id = await asyncio.to_thread(self.encolar, tipo, *argumentos, job_id=job_actual.get(), prioridad=prioridad)
+        futuro = asyncio.get_running_loop().create_future()
+        self._esperando[unidad_id] = futuro
+        if self._sondeo is None or self._sondeo.done():
+            self._sondeo = asyncio.create_task(self._sondear())
+        try:
+            return await futuro
+        except asyncio.CancelledError:
+            await asyncio.to_thread(self.cancelar, unidad_id)
+            raise
+        finally:
+            self._esperando.pop(unidad_id, None)
+
+    # ----- Lado del worker -----
+    def reclamar(self, tipos: List[str], propietario: str) -> Optional[UnidadTrabajo]:
+        """Toma la siguiente unidad pendiente (o con lease vencido) de alguno de los 'tipos'."""
+        conexion = self._conexion()
+        ahora = time.time()
+        marcadores = ",".join("?" * len(tipos))
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            # Las que ya agotaron sus intentos con un worker caído no se vuelven a repartir
+            conexion.execute(
+                "UPDATE unidades SET estado = ?, error = ? WHERE estado = ? AND lease_hasta < ? AND intentos >= ?",
+                (EstadoUnidad.FALLIDA.value, "El worker dejó de responder en todos los intentos.",
+                 EstadoUnidad.EN_CURSO.value, ahora, self.max_intentos)
+            )
+            fila = conexion.execute(
+                f"""SELECT id, job_id, tipo, argumentos, intentos FROM unidades
+                    WHERE tipo IN ({marcadores}) AND (estado = ? OR (estado = ? AND lease_hasta < ?))
+                    ORDER BY prioridad DESC, id LIMIT 1""",
+                (*tipos, EstadoUnidad.PENDIENTE.value, EstadoUnidad.EN_CURSO.value, ahora)
+            ).fetchone()
+            if fila is not None:
+                conexion.execute(
+                    "UPDATE unidades SET estado = ?, propietario = ?, lease_hasta = ?, intentos = intentos + 1 WHERE id = ?",
+                    (EstadoUnidad.EN_CURSO.value, propietario, ahora + self.lease_segundos, fila[0])
+                )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+        if fila is None:
+            return None
+        unidad_id, job_id, tipo, argumentos, intentos = fila
+        return UnidadTrabajo(id=unidad_id, job_id=job_id, tipo=tipo, argumentos=pickle.loads(argumentos), intentos=intentos + 1)
+
+    def renovar(self, unidad_id: int, propietario: str) -> bool:
+        """Extiende el lease; False si la unidad ya no es de este worker (cancelada o retomada por otro)."""
+        cursor = self._conexion().execute(
+            "UPDATE unidades SET lease_hasta = ? WHERE id = ? AND estado = ? AND propietario = ?",
+            (time.time() + self.lease_segundos, unidad_id, EstadoUnidad.EN_CURSO.value, propietario)
+        )
+        return cursor.rowcount == 1
+
+    def completar(self, unidad_id: int, propietario: str, resultado: Any) -> None:
+        self._conexion().execute(
+            "UPDATE unidades SET estado = ?, resultado = ?, argumentos = X'' WHERE id = ? AND estado = ? AND propietario = ?",
+            (EstadoUnidad.HECHA.value, pickle.dumps(resultado, protocol=pickle.HIGHEST_PROTOCOL),
+             unidad_id, EstadoUnidad.EN_CURSO.value, propietario)
+        )
+
+    def fallar(self, unidad_id: int, propietario: str, error: str, reintentar: bool = False) -> None:
+        """Marca la unidad fallida, o la devuelve a la cola si 'reintentar' y le quedan intentos."""
+        conexion = self._conexion()
+        if reintentar:
+            cursor = conexion.execute(
+                "UPDATE unidades SET estado = ?, propietario = NULL, lease_hasta = NULL, error = ? WHERE id = ? AND estado = ? AND propietario = ? AND intentos < ?",
+                (EstadoUnidad.PENDIENTE.value, error, unidad_id, EstadoUnidad.EN_CURSO.value, propietario, self.max_intentos)
+            )
+            if cursor.rowcount:
+                return
+        conexion.execute(
+            "UPDATE unidades SET estado = ?, error = ?, argumentos = X'' WHERE id = ? AND estado = ? AND propietario = ?",
+            (EstadoUnidad.FALLIDA.value, error, unidad_id, EstadoUnidad.EN_CURSO.value, propietario)
+        )
+
+    def purgar(self, antiguedad_segundos: float = 24 * 3600) -> int:
+        """
+        Borra las canceladas y las terminadas que nadie recogió (la API que las esperaba ya no existe).
+        Los workers la corren al arrancar y cada COLA_PURGA_INTERVALO_SEGUNDOS.
+        """
+        cursor = self._conexion().execute(
+            "DELETE FROM unidades WHERE estado = ? OR (estado IN (?, ?) AND creado < ?)",
+            (EstadoUnidad.CANCELADA.value, *(e.value for e in ESTADOS_FINALES), time.time() - antiguedad_segundos)
+        )
+        return cursor.rowcount
+
+cola_trabajo = ColaTrabajo(ruta=settings.COLA_TRABAJO_PATH, habilitada=settings.COLA_TRABAJO_HABILITADA)
+
+async def ejecutar_cpu(funcion: Callable[..., Any], *args: Any) -> Any:
+    """
+    Trabajo de CPU de un job: en la cola de trabajo si está habilitada (lo ejecuta cualquier worker),
+    si no en el pool de procesos local. 'funcion' debe ser importable a nivel de módulo.
+    """
+    if cola_trabajo.habilitada:
+        return await cola_trabajo.ejecutar(TIPO_CPU, funcion, *args)
+    return await pool_workers.ejecutar(funcion, *args)
@@ -0,0 +1,311 @@
+# Sesión y cache de extracción por documento: cada PDF se abre y cada página se parsea UNA sola vez con fitz
+from ..core.exceptions import PDFCifradoError
+from .perfiles_imagen import PerfilImagen, PERFIL_ORIGINAL, codificar_pagina
+
+from collections import OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+import hashlib
+import threading
+import logging
+import fitz
+
+logger = logging.getLogger(__name__)
+
+# Número máximo de documentos que se mantienen parseados en memoria por proceso
+MAX_DOCUMENTOS_EN_CACHE = 8
+
+# Documentos más largos que esto se recorren en streaming sin guardarse en cache,
+# para que la memoria se mantenga plana con PDFs multicuenta de cientos de páginas
+MAX_PAGINAS_EN_CACHE = 250
+
+def calcular_hash_documento(pdf_bytes: bytes) -> str:
+    """Devuelve el hash SHA-256 del contenido del PDF (llave de todas las caches por documento)."""
+    return hashlib.sha256(pdf_bytes).hexdigest()
+
+@dataclass
+class ExtraccionDocumento:
+    """
+    Resultado de parsear un PDF una sola vez.
+    Todas las etapas de una petición (portada, detección de escaneado, RFC/CURP, CSF)
+    leen de aquí en lugar de volver a abrir el documento.
+    """
+    hash_documento: str
+    total_paginas: int
+    texto_por_pagina: Dict[int, str] = field(default_factory=dict)             # get_text("text") en minúsculas
+    palabras_por_pagina: Dict[int, List[Tuple]] = field(default_factory=dict)  # get_text("words") sin modificar
+    texto_ordenado_por_pagina: Dict[int, str] = field(default_factory=dict)    # get_text(sort=True) en minúsculas
+
+    def texto_ordenado(self, num_paginas: Optional[int] = None) -> str:
+        """
+        Concatena el texto ordenado de las primeras 'n' páginas (o de todas si es None),
+        con el mismo formato que devolvía 'extraer_texto_de_pdf'.
+        """
+        paginas = sorted(self.texto_ordenado_por_pagina)
+        if num_paginas is not None and num_paginas > 0:
+            paginas = paginas[:num_paginas]
+
+        texto_extraido = ''
+        for num_pagina in paginas:
+            texto_pagina = self.texto_ordenado_por_pagina[num_pagina]
+            if texto_pagina:
+                texto_extraido += texto_pagina + '\n'
+        return texto_extraido
+
+    def texto_completo(self) -> str:
+        """Une el texto plano de todas las páginas (el que usa la verificación de escaneado)."""
+        return "\n".join(self.texto_por_pagina.values())
+
+def parsear_pagina(pagina: fitz.Page) -> Tuple[str, List[Tuple], str]:
+    """
+    Parsea una página con un único TextPage y devuelve (texto, palabras, texto_ordenado).
+    El TextPage se crea con las mismas banderas que 'get_text' usa sin él (TEXTFLAGS_TEXT): con
+    las de omisión (0) los tabuladores salen como U+FFFD y las palabras vecinas se pegan.
+    """
+    textpage = pagina.get_textpage(flags=fitz.TEXTFLAGS_TEXT)
+    texto = pagina.get_text("text", textpage=textpage).lower()
+    palabras = pagina.get_text("words", textpage=textpage)
+    texto_ordenado = pagina.get_text("text", sort=True, textpage=textpage).lower()
+    return texto, palabras, texto_ordenado
+
+class CacheExtracciones:
+    """
+    Cache LRU (por proceso) de documentos ya parseados, indexada por hash de contenido.
+    Es segura para usarse desde los hilos del executor.
+    """
+    def __init__(self, max_documentos: int = MAX_DOCUMENTOS_EN_CACHE):
+        self.max_documentos = max_documentos
+        self._entradas: "OrderedDict[str, ExtraccionDocumento]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.aciertos = 0
+        self.fallos = 0
+
+    def obtener(self, hash_documento: str) -> Optional[ExtraccionDocumento]:
+        with self._lock:
+            extraccion = self._entradas.get(hash_documento)
+            if extraccion is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(hash_documento)
+            self.aciertos += 1
+            return extraccion
+
+    def guardar(self, extraccion: ExtraccionDocumento) -> None:
+        with self._lock:
+            self._entradas[extraccion.hash_documento] = extraccion
+            self._entradas.move_to_end(extraccion.hash_documento)
+            while len(self._entradas) > self.max_documentos:
+                self._entradas.popitem(last=False)
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._entradas.clear()
+
+    def __len__(self) -> int:
+        return len(self._entradas)
+
+cache_extracciones = CacheExtracciones()
+
+class SesionDocumento:
+    """
+    Sesión sobre UN PDF abierto una sola vez con fitz durante una petición.
+    - Texto, palabras e imágenes de cada página se obtienen bajo demanda y se memorizan.
+    - Todo acceso al fitz.Document pasa por un RLock, así que puede compartirse entre
+      los hilos del executor (MuPDF no admite uso concurrente del mismo documento).
+    - Se cierra de forma determinista con 'with' o con 'cerrar()'.
+    - No se puede enviar a otro proceso: para el ProcessPoolExecutor se usa 'pdf_bytes'.
+    """
+    def __init__(self, pdf_bytes: bytes, hash_documento: Optional[str] = None):
+        self.pdf_bytes = pdf_bytes
+        self._hash = hash_documento
+        self._lock = threading.RLock()
+        # Lanza la excepción de fitz si el contenido no es un PDF válido
+        self._documento: Optional[fitz.Document] = fitz.open(stream=pdf_bytes, filetype="pdf")
+        self.total_paginas = len(self._documento)
+        self.esta_cifrado = self._documento.is_encrypted
+        self._paginas: Dict[int, Tuple[str, List[Tuple], str]] = {}
+        self._extraccion: Optional[ExtraccionDocumento] = None
+        self._cache_consultada = False
+
+    @property
+    def hash_documento(self) -> str:
+        if self._hash is None:
+            self._hash = calcular_hash_documento(self.pdf_bytes)
+        return self._hash
+
+    @property
+    def cerrada(self) -> bool:
+        return self._documento is None
+
+    @contextmanager
+    def usar(self) -> Iterator[fitz.Document]:
+        """Da acceso exclusivo al fitz.Document (para renderizar, leer imágenes incrustadas, etc.)."""
+        with self._lock:
+            if self._documento is None:
+                raise ValueError("La sesión del documento ya está cerrada.")
+            yield self._documento
+
+    @property
+    def metadatos(self) -> Dict[str, Any]:
+        with self.usar() as documento:
+            return dict(documento.metadata or {})
+
+    def _extraccion_en_cache(self) -> Optional[ExtraccionDocumento]:
+        """Si otra etapa ya parseó este documento, la sesión lee de ahí en lugar de volver a parsear."""
+        with self._lock:
+            if not self._cache_consultada:
+                self._extraccion = cache_extracciones.obtener(self.hash_documento)
+                self._cache_consultada = True
+            return self._extraccion
+
+    def pagina_parseada(self, num_pagina: int, memorizar: bool = True) -> Tuple[str, List[Tuple], str]:
+        """Devuelve (texto, palabras, texto_ordenado) de una página 1-indexada."""
+        if self.esta_cifrado:
+            raise PDFCifradoError("El documento está protegido por contraseña.")
+        if not 1 <= num_pagina <= self.total_paginas:
+            raise IndexError(f"Página {num_pagina} fuera de rango (1-{self.total_paginas}).")
+
+        extraccion = self._extraccion_en_cache()
+        if extraccion is not None:
+            return (
+                extraccion.texto_por_pagina[num_pagina],
+                extraccion.palabras_por_pagina[num_pagina],
+                extraccion.texto_ordenado_por_pagina[num_pagina],
+            )
+
+        with self._lock:
+            parseada = self._paginas.get(num_pagina)
+            if parseada is None:
+                with self.usar() as documento:
+                    parseada = parsear_pagina(documento.load_page(num_pagina - 1))
+                if memorizar:
+                    self._paginas[num_pagina] = parseada
+            return parseada
+
+    def texto_pagina(self, num_pagina: int) -> str:
+        return self.pagina_parseada(num_pagina)[0]
+
+    def palabras_pagina(self, num_pagina: int) -> List[Tuple]:
+        return self.pagina_parseada(num_pagina)[1]
+
+    def texto_ordenado_pagina(self, num_pagina: int) -> str:
+        return self.pagina_parseada(num_pagina)[2]
+
+    def texto_ordenado(self, num_paginas: Optional[int] = None) -> str:
+        """Igual que ExtraccionDocumento.texto_ordenado, pero solo parsea las páginas que pide."""
+        limite = self.total_paginas
+        if num_paginas is not None and num_paginas > 0:
+            limite = min(num_paginas, self.total_paginas)
+
+        texto_extraido = ''
+        for num_pagina in range(1, limite + 1):
+            texto_pagina = self.texto_ordenado_pagina(num_pagina)
+            if texto_pagina:
+                texto_extraido += texto_pagina + '\n'
+        return texto_extraido
+
+    def extraccion(self) -> ExtraccionDocumento:
+        """Parsea las páginas que falten y guarda el documento completo en la cache del proceso."""
+        extraccion = self._extraccion_en_cache()
+        if extraccion is not None:
+            return extraccion
+
+        extraccion = ExtraccionDocumento(hash_documento=self.hash_documento, total_paginas=self.total_paginas)
+        for num_pagina in range(1, self.total_paginas + 1):
+            texto, palabras, texto_ordenado = self.pagina_parseada(num_pagina)
+            extraccion.texto_por_pagina[num_pagina] = texto
+            extraccion.palabras_por_pagina[num_pagina] = palabras
+            extraccion.texto_ordenado_por_pagina[num_pagina] = texto_ordenado
+
+        cache_extracciones.guardar(extraccion)
+        with self._lock:
+            self._extraccion = extraccion
+            self._paginas.clear()
+        logger.debug(f"Documento {self.hash_documento[:12]} parseado ({self.total_paginas} páginas).")
+        return extraccion
+
+    def iterar_paginas(self) -> Iterator[Tuple[int, int, str, List[Tuple]]]:
+        """
+        Genera (num_pagina, total_paginas, texto, palabras) conforme se parsea cada página.
+        Los documentos de más de MAX_PAGINAS_EN_CACHE páginas no se memorizan ni se cachean.
+        """
+        memorizar = self.total_paginas <= MAX_PAGINAS_EN_CACHE
+        for num_pagina in range(1, self.total_paginas + 1):
+            texto, palabras, _ = self.pagina_parseada(num_pagina, memorizar=memorizar)
+            yield num_pagina, self.total_paginas, texto, palabras
+
+        if memorizar:
+            self.extraccion() # Todas las páginas ya están memorizadas: solo arma y guarda
+
+    def codificar_pagina(self, num_pagina: int, perfil: PerfilImagen = PERFIL_ORIGINAL) -> bytes:
+        """Rasteriza y codifica una página 1-indexada con el perfil indicado."""
+        with self.usar() as documento:
+            return codificar_pagina(documento.load_page(num_pagina - 1), perfil)
+
+    def cerrar(self) -> None:
+        with self._lock:
+            if self._documento is not None:
+                self._documento.close()
+                self._documento = None
+            self._paginas.clear()
+
+    def __enter__(self) -> "SesionDocumento":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.cerrar()
+
+# Las funciones de servicios aceptan los bytes del PDF o una sesión ya abierta
+FuenteDocumento = Union[bytes, SesionDocumento]
+
+@contextmanager
+def abrir_sesion(fuente: FuenteDocumento) -> Iterator[SesionDocumento]:
+    """
+    Reutiliza la sesión si ya se recibió una (y NO la cierra: es de quien la abrió);
+    si se recibieron bytes, abre una sesión temporal y la cierra al salir.
+    """
+    if isinstance(fuente, SesionDocumento):
+        yield fuente
+    else:
+        with SesionDocumento(fuente) as sesion:
+            yield sesion
+
+def obtener_extraccion(fuente: FuenteDocumento) -> ExtraccionDocumento:
+    """
+    Devuelve la extracción del documento, parseándolo solo si no está en cache.
+    - Lanza PDFCifradoError si el documento está protegido con contraseña.
+    - Propaga los errores de fitz si el contenido no es un PDF válido.
+    """
+    if isinstance(fuente, SesionDocumento):
+        return fuente.extraccion()
+
+    # Con bytes consultamos la cache antes de abrir el PDF
+    hash_documento = calcular_hash_documento(fuente)
+    extraccion = cache_extracciones.obtener(hash_documento)
+    if extraccion is not None:
+        return extraccion
+
+    with SesionDocumento(fuente, hash_documento) as sesion:
+        return sesion.extraccion()
+
+def iterar_paginas_extraidas(fuente: FuenteDocumento) -> Iterator[Tuple[int, int, str, List[Tuple]]]:
+    """
+    Versión en streaming de 'obtener_extraccion': genera (num_pagina, total_paginas, texto, palabras)
+    conforme se parsea cada página, sin esperar al final del documento.
+    - Si el documento ya está en cache, recorre la cache.
+    - Si no, lo parsea y lo guarda en cache al terminar (solo si no supera MAX_PAGINAS_EN_CACHE).
+    """
+    if isinstance(fuente, SesionDocumento):
+        yield from fuente.iterar_paginas()
+        return
+
+    hash_documento = calcular_hash_documento(fuente)
+    extraccion = cache_extracciones.obtener(hash_documento)
+    if extraccion is not None:
+        for num_pagina in range(1, extraccion.total_paginas + 1):
+            yield num_pagina, extraccion.total_paginas, extraccion.texto_por_pagina[num_pagina], extraccion.palabras_por_pagina[num_pagina]
+        return
+
+    with SesionDocumento(fuente, hash_documento) as sesion:
+        yield from sesion.iterar_paginas()
@@ -1,43 +1,318 @@
-from .pdf_processor import convertir_pdf_a_imagenes
+from .image_cache import CacheImagenes, ImagenRenderizada, construir_data_url, renderizar_paginas_con_cache
+from .perfiles_imagen import PerfilImagen, obtener_perfil
+from .document_cache import FuenteDocumento
+from .llm_cache import CacheRespuestasLLM, calcular_llave
+from .llm_governor import (
+    GobernadorLLM, LimitesProveedor, estimar_tokens, PRIORIDAD_PORTADA, PRIORIDAD_CHUNK_DIGITAL, PRIORIDAD_OCR_VISION
+)
+from .llm_resiliencia import (
+    ContadoresJob, PoliticaReintentos, RegistroLatencias, ejecutar_con_cobertura, ejecutar_con_reintentos,
+    transmitir_con_cobertura, transmitir_con_reintentos, EVENTO_LLAMADA, EVENTO_ACIERTO_CACHE, EVENTO_REINTENTO, EVENTO_COBERTURA, EVENTO_COBERTURA_GANADA, EVENTO_FALLO
+)
+from .llm_clients import (
+    registro_clientes_llm, timeout_llamada, CLIENTE_FLUXO, CLIENTE_NOMI, CLIENTE_OPENROUTER
+)
 from ..core.config import settings
-from ..utils.helpers import _crear_prompt_agente_unificado, parsear_respuesta_toon
+from ..utils.helpers import _crear_prompt_agente_unificado, ParserToonIncremental
 
 from fastapi import HTTPException
-from openai import AsyncOpenAI
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Tuple, AsyncIterator
+from contextlib import aclosing
 from io import BytesIO
+import asyncio
 import json
+import time
 import re
-import base64
 import logging
 
-nomi_api = settings.OPENAI_API_KEY_NOMI.get_secret_value()
+logger = logging.getLogger(__name__)
+
+MODELO_GPT = "gpt-5"
+MODELO_QWEN_VL = "qwen/qwen3-vl-235b-a22b-instruct" # CAMBIAR AL MODELO QUE SE QUIERA USAR (OpenRouter)
 
-def get_fluxo_client():
-    return AsyncOpenAI(api_key=settings.OPENAI_API_KEY_FLUXO.get_secret_value())
+# Proveedor alterno de cada agente por chunk para la cobertura: (cliente, parámetros propios del modelo)
+ALTERNO_AGENTE_TPV = (CLIENTE_OPENROUTER, {"model": MODELO_QWEN_VL})
+ALTERNO_AGENTE_OCR = (CLIENTE_FLUXO, {"model": MODELO_GPT})
 
-openrouter_api = settings.OPENROUTER_API_KEY.get_secret_value()
+# GPT-5 es de razonamiento: rechaza (400) los parámetros de muestreo y 'max_tokens'.
+# Los demás modelos no conocen 'reasoning_effort'.
+MODELOS_RAZONAMIENTO = {MODELO_GPT}
+PARAMETROS_MUESTREO = ("temperature", "top_p", "presence_penalty", "frequency_penalty")
 
-logger = logging.getLogger(__name__)
+def _parametros_para_modelo(parametros: Dict[str, Any]) -> Dict[str, Any]:
+    """Traduce una solicitud al modelo de parametros['model'] (p. ej. la del proveedor alterno de la cobertura)."""
+    adaptados = dict(parametros)
+    if adaptados["model"] in MODELOS_RAZONAMIENTO:
+        for llave in PARAMETROS_MUESTREO:
+            adaptados.pop(llave, None)
+        if "max_tokens" in adaptados:
+            adaptados["max_completion_tokens"] = adaptados.pop("max_tokens")
+    else:
+        adaptados.pop("reasoning_effort", None)
+        if "max_completion_tokens" in adaptados:
+            adaptados["max_tokens"] = adaptados.pop("max_completion_tokens")
+    return adaptados
+
+def _tokens_salida(parametros: Dict[str, Any]) -> Optional[int]:
+    return parametros.get("max_tokens", parametros.get("max_completion_tokens"))
+
+# Cache de páginas rasterizadas compartida por GPT, Qwen y el agente OCR-Visión
+cache_imagenes = CacheImagenes(max_bytes=settings.IMAGE_CACHE_MAX_MB * 1024 * 1024)
 
-client_gpt_nomi = AsyncOpenAI(
-    api_key=nomi_api
+# Perfiles de codificación por tipo de documento (un nombre inválido falla al arrancar)
+PERFIL_FLUXO = obtener_perfil(settings.IMAGE_PROFILE_FLUXO)
+PERFIL_OCR_VISION = obtener_perfil(settings.IMAGE_PROFILE_OCR_VISION)
+PERFIL_NOMI = obtener_perfil(settings.IMAGE_PROFILE_NOMI)
+
+# Cache en disco de respuestas: los reenvíos del mismo documento no se vuelven a pagar
+cache_respuestas_llm = CacheRespuestasLLM(
+    ruta=settings.LLM_CACHE_PATH,
+    ttl_segundos=settings.LLM_CACHE_TTL_HOURS * 3600,
+    max_bytes=settings.LLM_CACHE_MAX_MB * 1024 * 1024,
+    habilitada=settings.LLM_CACHE_ENABLED,
 )
 
+# Límites compartidos con los procesos worker: todos los jobs se forman en la misma fila por proveedor
+gobernador_llm = GobernadorLLM(
+    ruta=settings.LLM_GOVERNOR_PATH,
+    limites={nombre: LimitesProveedor(**limites) for nombre, limites in settings.LLM_GOVERNOR_LIMITS.items()},
+    habilitado=settings.LLM_GOVERNOR_ENABLED,
+)
 
-client_openrouter = AsyncOpenAI(
-    api_key=openrouter_api,
-    base_url=settings.OPENROUTER_BASE_URL,
-    default_headers={
-        "HTTP-Referer": "https://github.com/Asfilcnx3", 
-        "X-Title": "Fluxo IA Test", 
-    },
+politica_reintentos = PoliticaReintentos(
+    max_reintentos=settings.LLM_MAX_RETRIES,
+    base_segundos=settings.LLM_RETRY_BASE_SECONDS,
+    max_segundos=settings.LLM_RETRY_MAX_SECONDS,
 )
+latencias_llm = RegistroLatencias(min_muestras=settings.LLM_HEDGE_MIN_SAMPLES)
+# Reintentos, coberturas y fallos por job (los workers escriben en la misma base)
+contadores_job = ContadoresJob(ruta=settings.LLM_METRICS_PATH)
+
+async def _llamar_modelo(nombre_cliente: str, prioridad: int, parametros: Dict[str, Any]) -> str:
+    """Un solo intento: permiso del gobernador + llamada + registro de latencia."""
+    tokens_estimados = estimar_tokens(parametros["messages"], _tokens_salida(parametros))
+    async with gobernador_llm.permiso(nombre_cliente, prioridad, tokens_estimados) as permiso:
+        contadores_job.incrementar(EVENTO_LLAMADA)
+        inicio = time.monotonic()
+        response = await registro_clientes_llm.obtener(nombre_cliente).chat.completions.create(**parametros)
+        latencias_llm.registrar(nombre_cliente, parametros["model"], time.monotonic() - inicio)
+        if getattr(response, "usage", None) is not None:
+            permiso.registrar_uso(response.usage.total_tokens)
+    return response.choices[0].message.content
+
+async def _llamar_con_reintentos(nombre_cliente: str, prioridad: int, parametros: Dict[str, Any]) -> str:
+    def al_reintentar(intento: int, error: BaseException, espera: float) -> None:
+        contadores_job.incrementar(EVENTO_REINTENTO)
+        logger.warning(f"{parametros['model']}: error transitorio ({type(error).__name__}), reintento {intento} en {espera:.1f}s.")
+
+    return await ejecutar_con_reintentos(
+        lambda: _llamar_modelo(nombre_cliente, prioridad, parametros), politica_reintentos, al_reintentar
+    )
+
+async def _transmitir_modelo(nombre_cliente: str, prioridad: int, parametros: Dict[str, Any]) -> AsyncIterator[str]:
+    """
+    Un solo intento en streaming: entrega el texto de cada fragmento conforme llega.
+    El permiso del gobernador se mantiene hasta que el stream termina o se cierra.
+    """
+    tokens_estimados = estimar_tokens(parametros["messages"], _tokens_salida(parametros))
+    opciones: Dict[str, Any] = {"stream": True}
+    if nombre_cliente != CLIENTE_OPENROUTER:
+        # El uso real llega en el último fragmento (OpenRouter lo manda sin pedirlo)
+        opciones["stream_options"] = {"include_usage": True}
+
+    async with gobernador_llm.permiso(nombre_cliente, prioridad, tokens_estimados) as permiso:
+        contadores_job.incrementar(EVENTO_LLAMADA)
+        inicio = time.monotonic()
+        primer_fragmento = True
+        stream = await registro_clientes_llm.obtener(nombre_cliente).chat.completions.create(**parametros, **opciones)
+        async with stream:
+            async for fragmento in stream:
+                if getattr(fragmento, "usage", None) is not None:
+                    permiso.registrar_uso(fragmento.usage.total_tokens)
+                if not fragmento.choices or not fragmento.choices[0].delta.content:
+                    continue
+                if primer_fragmento:
+                    primer_fragmento = False
+                    latencias_llm.registrar(nombre_cliente, f"{parametros['model']}:primer_fragmento", time.monotonic() - inicio)
+                yield fragmento.choices[0].delta.content
+        latencias_llm.registrar(nombre_cliente, parametros["model"], time.monotonic() - inicio)
+
+def _transmitir_con_reintentos(nombre_cliente: str, prioridad: int, parametros: Dict[str, Any]) -> AsyncIterator[str]:
+    def al_reintentar(intento: int, error: BaseException, espera: float) -> None:
+        contadores_job.incrementar(EVENTO_REINTENTO)
+        logger.warning(f"{parametros['model']} (stream): error transitorio ({type(error).__name__}), reintento {intento} en {espera:.1f}s.")
+
+    return transmitir_con_reintentos(
+        lambda: _transmitir_modelo(nombre_cliente, prioridad, parametros), politica_reintentos, al_reintentar
+    )
+
+def _umbral_cobertura(nombre_cliente: str, modelo: str) -> float:
+    p95 = latencias_llm.p95(nombre_cliente, modelo)
+    return max(p95 if p95 is not None else settings.LLM_HEDGE_DEFAULT_SECONDS, settings.LLM_HEDGE_MIN_SECONDS)
+
+async def _completar_chat(
+        nombre_cliente: str,
+        prioridad: int,
+        alterno: Optional[Tuple[str, Dict[str, Any]]] = None,
+        **parametros
+    ) -> str:
+    """
+    Punto único de llamada a chat.completions: consulta la cache antes de llamar al modelo
+    y guarda la respuesta después. Solo se cachean respuestas no vacías (nunca errores).
+    Las llamadas reales pasan por el gobernador con la prioridad indicada y se reintentan
+    ante errores transitorios. Con 'alterno', si la llamada pasa del p95 (o falla) se manda
+    un duplicado a ese proveedor y gana la primera respuesta válida.
+    """
+    extras = {k: v for k, v in parametros.items() if k not in ("model", "messages")}
+    llave = calcular_llave(parametros["model"], parametros["messages"], **extras)
+    respuesta = await asyncio.to_thread(cache_respuestas_llm.obtener, llave)
+    if respuesta is not None:
+        logger.debug(f"Cache LLM: acierto para {parametros['model']}.")
+        contadores_job.incrementar(EVENTO_ACIERTO_CACHE)
+        return respuesta
+
+    try:
+        if alterno is None or not settings.LLM_HEDGE_ENABLED:
+            respuesta = await _llamar_con_reintentos(nombre_cliente, prioridad, parametros)
+        else:
+            cliente_alterno, propios = alterno
+            # Misma solicitud con el modelo del proveedor alterno y solo los parámetros que ese modelo acepta
+            parametros_alternos = _parametros_para_modelo({**parametros, **propios})
+
+            def al_cubrir() -> None:
+                contadores_job.incrementar(EVENTO_COBERTURA)
+                logger.info(f"{parametros['model']} sin respuesta válida a tiempo: cobertura con {parametros_alternos['model']}.")
+
+            respuesta, gano_alterno = await ejecutar_con_cobertura(
+                lambda: _llamar_con_reintentos(nombre_cliente, prioridad, parametros),
+                lambda: _llamar_con_reintentos(cliente_alterno, prioridad, parametros_alternos),
+                _umbral_cobertura(nombre_cliente, parametros["model"]),
+                al_cubrir=al_cubrir
+            )
+            if gano_alterno:
+                contadores_job.incrementar(EVENTO_COBERTURA_GANADA)
+    except Exception:
+        contadores_job.incrementar(EVENTO_FALLO)
+        raise
+
+    if respuesta:
+        await asyncio.to_thread(cache_respuestas_llm.guardar, llave, parametros["model"], respuesta)
+    return respuesta
+
+async def _transmitir_chat(
+        nombre_cliente: str,
+        prioridad: int,
+        alterno: Optional[Tuple[str, Dict[str, Any]]] = None,
+        **parametros
+    ) -> AsyncIterator[str]:
+    """
+    Versión en streaming de '_completar_chat' (misma cache, gobernador, reintentos y cobertura).
+    Un acierto de cache se entrega como un solo fragmento. Solo se cachean respuestas
+    recibidas completas: si el consumidor corta el stream (p. ej. SIN_DATOS) no se guarda nada.
+    La cobertura se decide con el p95 del PRIMER fragmento, no de la respuesta completa.
+    """
+    extras = {k: v for k, v in parametros.items() if k not in ("model", "messages")}
+    llave = calcular_llave(parametros["model"], parametros["messages"], **extras)
+    respuesta = await asyncio.to_thread(cache_respuestas_llm.obtener, llave)
+    if respuesta is not None:
+        logger.debug(f"Cache LLM: acierto para {parametros['model']}.")
+        contadores_job.incrementar(EVENTO_ACIERTO_CACHE)
+        yield respuesta
+        return
+
+    if alterno is None or not settings.LLM_HEDGE_ENABLED:
+        flujo = _transmitir_con_reintentos(nombre_cliente, prioridad, parametros)
+    else:
+        cliente_alterno, propios = alterno
+        # Misma solicitud con el modelo del proveedor alterno y solo los parámetros que ese modelo acepta
+        parametros_alternos = _parametros_para_modelo({**parametros, **propios})
+
+        def al_cubrir() -> None:
+            contadores_job.incrementar(EVENTO_COBERTURA)
+            logger.info(f"{parametros['model']} sin primer fragmento a tiempo: cobertura con {parametros_alternos['model']}.")
+
+        flujo = transmitir_con_cobertura(
+            lambda: _transmitir_con_reintentos(nombre_cliente, prioridad, parametros),
+            lambda: _transmitir_con_reintentos(cliente_alterno, prioridad, parametros_alternos),
+            _umbral_cobertura(nombre_cliente, f"{parametros['model']}:primer_fragmento"),
+            al_cubrir=al_cubrir,
+            al_ganar_alterna=lambda: contadores_job.incrementar(EVENTO_COBERTURA_GANADA)
+        )
+
+    partes: List[str] = []
+    try:
+        async with aclosing(flujo) as fragmentos:
+            async for fragmento in fragmentos:
+                partes.append(fragmento)
+                yield fragmento
+    except Exception:
+        contadores_job.incrementar(EVENTO_FALLO)
+        raise
+
+    respuesta = "".join(partes)
+    if respuesta:
+        await asyncio.to_thread(cache_respuestas_llm.guardar, llave, parametros["model"], respuesta)
+
+async def _transmitir_transacciones(nombre_agente: str, flujo: AsyncIterator[str]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """
+    Pasa el texto del stream por el parser TOON incremental y entrega lotes de transacciones
+    en cuanto cada línea se completa. Si la respuesta es SIN_DATOS se corta el stream.
+    Ante un error los lotes ya entregados se conservan y el error se propaga: el chunk queda
+    marcado como fallido en lugar de perder sus transacciones sin dejar rastro.
+    """
+    parser = ParserToonIncremental()
+    try:
+        async with aclosing(flujo) as fragmentos:
+            async for fragmento in fragmentos:
+                lote = parser.alimentar(fragmento)
+                if parser.sin_datos:
+                    logger.debug(f"{nombre_agente}: SIN_DATOS, se corta el stream.")
+                    return
+                if lote:
+                    yield lote
+        lote = parser.terminar()
+        if lote:
+            yield lote
+        logger.debug(f"{nombre_agente}: TOON parseado, {parser.total_transacciones} transacciones encontradas.")
+    except Exception as e:
+        logger.error(
+            f"Error crítico en {nombre_agente} ({parser.total_transacciones} transacciones recibidas antes del error): {e}",
+            exc_info=True
+        )
+        raise
+
+def _construir_contenido_vision(
+        texto: str,
+        fuente: FuenteDocumento,
+        paginas: List[int],
+        detalle: str = "high",
+        perfil: PerfilImagen = PERFIL_FLUXO,
+        imagenes: Optional[List[ImagenRenderizada]] = None
+    ) -> List[Dict[str, Any]]:
+    """
+    Arma el payload multimodal (texto + imágenes) con las imágenes recibidas o, si no se
+    recibieron, con las páginas ya renderizadas y codificadas en la cache. Devuelve [] si no hubo imágenes.
+    """
+    if imagenes is None:
+        imagenes = renderizar_paginas_con_cache(cache_imagenes, fuente, paginas, perfil)
+    if not imagenes:
+        return []
+
+    content = [{"type": "text", "text": texto}]
+    for imagen in imagenes:
+        content.append({
+            "type": "image_url",
+            "image_url": {
+                "url": imagen.data_url,
+                "detail": detalle
+                },
+            })
+    return content
 ## ANALISIS DE FLUXO
 # Función para enviar el prompt + imagen a GPT-5
 async def analizar_gpt_fluxo(
         prompt: str, 
-        pdf_bytes: bytes,
+        fuente: FuenteDocumento,
         paginas_a_procesar: List[int],
         razonamiento: str = "low", 
         detalle: str = "high"
@@ -45,65 +320,45 @@ async def analizar_gpt_fluxo(
     """
     Se hace la llamada al modelo GPT-5 con razonamiento bajo y detalle de imagen alto
     """
-    imagen_buffers = convertir_pdf_a_imagenes(pdf_bytes, paginas = paginas_a_procesar)
-    if not imagen_buffers:
+    content = _construir_contenido_vision(prompt, fuente, paginas_a_procesar, detalle)
+    if not content:
         return # ya retorna el error que dió dentro de la función
-    
-    content = [{"type": "text", "text": prompt}]
-    # Hacemos encode a los datos de la imagen a base64
-    for buffer in imagen_buffers:
-        encoded_image = base64.b64encode(buffer.read()).decode('utf-8')
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{encoded_image}",
-                "detail": detalle
-                },
-            })
-    client = get_fluxo_client()
-    response = await client.chat.completions.create(
-        model="gpt-5",
+
+    return await _completar_chat(
+        CLIENTE_FLUXO,
+        PRIORIDAD_PORTADA,
+        model=MODELO_GPT,
         messages=[{"role": "user","content": content}],
-        reasoning_effort=razonamiento
+        reasoning_effort=razonamiento,
+        timeout=timeout_llamada(settings.LLM_TIMEOUT_VISION_SECONDS)
     )
 
-    return response.choices[0].message.content
-
 # Función para enviar el prompt + imagen a modelo de preferencia
-async def analizar_gemini_fluxo(prompt: str, pdf_bytes: bytes, paginas_a_procesar: List[int]) -> str:
+async def analizar_gemini_fluxo(prompt: str, fuente: FuenteDocumento, paginas_a_procesar: List[int]) -> str:
     """
     Se hace la llamada al modelo de preferencia
     """
-    imagen_buffers = convertir_pdf_a_imagenes(pdf_bytes, paginas = paginas_a_procesar)
-    if not imagen_buffers:
+    content = _construir_contenido_vision(prompt, fuente, paginas_a_procesar, "high")
+    if not content:
         return # ya retorna el error que dió dentro de la función
-    
-    content = [{"type": "text", "text": prompt}]
-    # Hacemos encode a los datos de la imagen a base64
-    for buffer in imagen_buffers:
-        encoded_image = base64.b64encode(buffer.read()).decode('utf-8')
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{encoded_image}",
-                "detail": "high"
-                },
-            })
-    response = await client_openrouter.chat.completions.create(
-        model="qwen/qwen3-vl-235b-a22b-instruct", # CAMBIAR AL MODELO QUE SE QUIERA USAR
+
+    return await _completar_chat(
+        CLIENTE_OPENROUTER,
+        PRIORIDAD_PORTADA,
+        model=MODELO_QWEN_VL,
         messages=[{"role": "user","content": content}],
+        timeout=timeout_llamada(settings.LLM_TIMEOUT_VISION_SECONDS)
     )
 
-    return response.choices[0].message.content
-
-async def llamar_agente_tpv(
+async def transmitir_agente_tpv(
     banco: str, 
     texto_chunk: str, 
     paginas: List[int]
-) -> List[Dict[str, Any]]:
+) -> AsyncIterator[List[Dict[str, Any]]]:
     """
     Llama a un agente LLM experto con un prompt de texto específico
-    para extraer transacciones de un chunk de texto.
+    para extraer transacciones de un chunk de texto. La respuesta llega en streaming
+    y las transacciones se entregan por lotes conforme se completa cada línea TOON.
     """
     logger.info(f"Agente TPV: Procesando {banco} (Páginas: {paginas[0]}-{paginas[-1]})")
 
@@ -117,116 +372,112 @@ async def llamar_agente_tpv(
     ---FIN DEL FRAGMENTO---
     """
 
-    try:
-        # 2. Llamar al LLM (modo texto)
-        client = get_fluxo_client()
-        response = await client.chat.completions.create(
-            model="gpt-5", # O tu modelo de texto preferido
-            messages=[
-                {"role": "system", "content": prompt_sistema},
-                {"role": "user", "content": prompt_usuario}
-            ],
-            # Si el modelo soporta JSON mode, es altamente recomendado:
-            # response_format={"type": "json_object"} 
-        )
-        
-        respuesta_str = response.choices[0].message.content
-
-        if "SIN_DATOS" in respuesta_str:
-            return []
+    # 2. Llamar al LLM (modo texto) y parsear conforme llega
+    flujo = _transmitir_chat(
+        CLIENTE_FLUXO,
+        PRIORIDAD_CHUNK_DIGITAL,
+        ALTERNO_AGENTE_TPV,
+        model=MODELO_GPT, # O tu modelo de texto preferido
+        messages=[
+            {"role": "system", "content": prompt_sistema},
+            {"role": "user", "content": prompt_usuario}
+        ],
+        timeout=timeout_llamada(settings.LLM_TIMEOUT_SECONDS),
+        # Si el modelo soporta JSON mode, es altamente recomendado:
+        # response_format={"type": "json_object"} 
+    )
+    async with aclosing(_transmitir_transacciones(f"Agente TPV ({banco}, págs {paginas[0]}-{paginas[-1]})", flujo)) as lotes:
+        async for lote in lotes:
+            yield lote
 
-        transacciones = parsear_respuesta_toon(respuesta_str)
-        
-        logger.debug(f"Agente TPV ({banco}): TOON parseado, {len(transacciones)} transacciones encontradas.")
-        return transacciones
-        
-    except Exception as e:
-        logger.error(f"Error crítico llamando al Agente TPV para {banco} (págs {paginas[0]}-{paginas[-1]}): {e}", exc_info=True)
-        return [] # Devuelve lista vacía en caso de cualquier error
+async def llamar_agente_tpv(
+    banco: str, 
+    texto_chunk: str, 
+    paginas: List[int]
+) -> List[Dict[str, Any]]:
+    """Versión no incremental de 'transmitir_agente_tpv': devuelve todas las transacciones del chunk."""
+    return [trx async for lote in transmitir_agente_tpv(banco, texto_chunk, paginas) for trx in lote]
 
 ## ANALISIS DE NOMIFLASH
 async def analizar_gpt_nomi(
         prompt: str, 
         imagen_buffers: List[BytesIO], 
         razonamiento: str = "low", 
-        detalle: str = "high"
+        detalle: str = "high",
+        formato: str = PERFIL_NOMI.formato
     ) -> str:
+    """
+    'formato' debe coincidir con el perfil con el que se generaron los buffers
+    (convertir_pdf_a_imagenes(..., perfil=PERFIL_NOMI)).
+    """
     if not imagen_buffers:
         return None
 
     content = [{"type": "text", "text": prompt}]
     for buffer in imagen_buffers:
         buffer.seek(0)
-        encoded_image = base64.b64encode(buffer.read()).decode('utf-8')
         content.append({
             "type": "image_url",
-            "image_url": {"url": f"data:image/png;base64,{encoded_image}", "detail": detalle}
+            "image_url": {"url": construir_data_url(buffer.read(), formato), "detail": detalle}
         })
     try:
-        response = await client_gpt_nomi.chat.completions.create(
-            model="gpt-5",
+        return await _completar_chat(
+            CLIENTE_NOMI,
+            PRIORIDAD_PORTADA, # NomiFlash es interactivo: misma clase que las portadas
+            model=MODELO_GPT,
             messages=[{"role": "user", "content": content}],
-            reasoning_effort=razonamiento
+            reasoning_effort=razonamiento,
+            timeout=timeout_llamada(settings.LLM_TIMEOUT_VISION_SECONDS)
         )
-        return response.choices[0].message.content  
     
     except Exception as e:
         raise HTTPException(status_code=503, detail=f"El servicio de IA no está disponible: {e}")
 
-async def llamar_agente_ocr_vision(
+async def transmitir_agente_ocr_vision(
         banco: str, 
-        pdf_bytes: bytes, 
-        paginas: List[int] 
-    ) -> List[Dict[str, Any]]: 
-    """ Llama a un agente LLM multimodal (Qwen-VL) con las imágenes de las páginas de un PDF para extraer transacciones. """ 
+        fuente: FuenteDocumento, 
+        paginas: List[int],
+        imagenes: Optional[List[ImagenRenderizada]] = None
+    ) -> AsyncIterator[List[Dict[str, Any]]]: 
+    """
+    Llama a un agente LLM multimodal (Qwen-VL) con las imágenes de las páginas de un PDF y entrega las transacciones por lotes conforme llegan.
+    Si ya se rasterizaron (p. ej. en el pool de procesos), llegan en 'imagenes' y no se renderiza nada aquí.
+    """
     logger.info(f"Agente OCR-Visión: Procesando {banco} (Páginas: {paginas[0]}-{paginas[-1]})")
 
     # 1. Crear el prompt de texto
     prompt_sistema_texto = _crear_prompt_agente_unificado(banco, tipo="vision")
 
-    # 2. Convertir las páginas de este chunk a imágenes
-    # (Reutilizamos la función que ya tenías para el análisis de portada)
-    imagen_buffers = convertir_pdf_a_imagenes(pdf_bytes, paginas=paginas)
-    if not imagen_buffers:
+    # 2 y 3. Payload multimodal (texto + imágenes). Las páginas compartidas entre
+    # ventanas superpuestas salen de la cache en lugar de renderizarse otra vez.
+    # 'high' es crucial para que el OCR lea el texto
+    content = _construir_contenido_vision(prompt_sistema_texto, fuente, paginas, "high", PERFIL_OCR_VISION, imagenes)
+    if not content:
         logger.warning(f"No se pudieron generar imágenes para las páginas {paginas} de {banco}")
-        return []
+        return
 
-    # 3. Construir el payload multimodal (texto + imágenes)
-    content = [{"type": "text", "text": prompt_sistema_texto}]
-    for buffer in imagen_buffers:
-        encoded_image = base64.b64encode(buffer.read()).decode('utf-8')
-        content.append({
-            "type": "image_url",
-            "image_url": {
-                "url": f"data:image/png;base64,{encoded_image}",
-                "detail": "high" # 'high' es crucial para que el OCR lea el texto
-            },
-        })
-
-    try:
-        # 4. Llamar al modelo Qwen-VL vía OpenRouter
-        response = await client_openrouter.chat.completions.create(
-            model="qwen/qwen3-vl-235b-a22b-instruct", # Tu modelo de OpenRouter
-            messages=[{"role": "user", "content": content}],
-            temperature=0.1, # Casi 0 para máxima consistencia
-            max_tokens=4000, # Asegurar espacio para JSONs largos
-        )
-
-        respuesta_str = response.choices[0].message.content
-        logger.debug(f"Agente OCR ({banco}) RAW TOON: {respuesta_str[:100]}...") # Loguear inicio para ver formato
-
-        # --- PARSEO TOON ---
-        if "SIN_DATOS" in respuesta_str:
-            return []
-
-        transacciones = parsear_respuesta_toon(respuesta_str)
-        
-        logger.debug(f"Agente OCR ({banco}): TOON parseado, {len(transacciones)} transacciones encontradas.")
-        return transacciones
+    # 4. Llamar al modelo Qwen-VL vía OpenRouter (TOON parseado conforme llega)
+    flujo = _transmitir_chat(
+        CLIENTE_OPENROUTER,
+        PRIORIDAD_OCR_VISION,
+        ALTERNO_AGENTE_OCR,
+        model=MODELO_QWEN_VL, # Tu modelo de OpenRouter
+        messages=[{"role": "user", "content": content}],
+        timeout=timeout_llamada(settings.LLM_TIMEOUT_VISION_SECONDS),
+        temperature=0.1, # Casi 0 para máxima consistencia
+        max_tokens=4000, # Asegurar espacio para JSONs largos
+    )
+    async with aclosing(_transmitir_transacciones(f"Agente OCR ({banco}, págs {paginas[0]}-{paginas[-1]})", flujo)) as lotes:
+        async for lote in lotes:
+            yield lote
 
-    except Exception as e:
-        logger.error(f"Error crítico llamando al Agente OCR-Visión para {banco}: {e}", exc_info=True)
-        return []
+async def llamar_agente_ocr_vision(
+        banco: str, 
+        fuente: FuenteDocumento, 
+        paginas: List[int] 
+    ) -> List[Dict[str, Any]]: 
+    """Versión no incremental de 'transmitir_agente_ocr_vision': devuelve todas las transacciones de la ventana."""
+    return [trx async for lote in transmitir_agente_ocr_vision(banco, fuente, paginas) for trx in lote]
 
 async def _extraer_datos_con_ia(texto: str) -> Dict:
     """
@@ -240,12 +491,14 @@ async def _extraer_datos_con_ia(texto: str) -> Dict:
     {texto[:4000]}
     """
     try:
-        client = get_fluxo_client()
-        response = await client.chat.completions.create(
-            model="gpt-5",
+        respuesta = await _completar_chat(
+            CLIENTE_FLUXO,
+            PRIORIDAD_PORTADA, # Fallback interactivo de CSF
+            model=MODELO_GPT,
             messages=[{"role": "user", "content": prompt_ia}],
+            timeout=timeout_llamada(settings.LLM_TIMEOUT_SECONDS),
             # response_format={"type": "json_object"}
         )
-        return json.loads(response.choices[0].message.content)
+        return json.loads(respuesta)
     except Exception as e:
         return e
@@ -0,0 +1,205 @@
+# Cache de páginas rasterizadas y de sus data URLs (base64) listas para enviar a los modelos de visión
+from .document_cache import FuenteDocumento, SesionDocumento, abrir_sesion, calcular_hash_documento
+from .perfiles_imagen import PerfilImagen, PERFIL_ORIGINAL
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+import threading
+import base64
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Presupuesto por defecto de la cache (bytes de imagen + bytes del data URL)
+MAX_BYTES_POR_DEFECTO = 256 * 1024 * 1024
+
+# (hash del pdf, página, perfil de codificación)
+LlaveImagen = Tuple[str, int, PerfilImagen]
+
+MIME_POR_FORMATO = {
+    "png": "image/png",
+    "jpeg": "image/jpeg",
+    "jpg": "image/jpeg",
+    "webp": "image/webp",
+}
+
+@dataclass(frozen=True)
+class ImagenRenderizada:
+    """Una página ya rasterizada y codificada."""
+    contenido: bytes
+    data_url: str
+
+    @property
+    def tamano(self) -> int:
+        return len(self.contenido) + len(self.data_url)
+
+def construir_data_url(contenido: bytes, formato: str) -> str:
+    """Codifica la imagen en base64 con el MIME correspondiente al formato."""
+    mime = MIME_POR_FORMATO.get(formato.lower(), f"image/{formato.lower()}")
+    encoded_image = base64.b64encode(contenido).decode('utf-8')
+    return f"data:{mime};base64,{encoded_image}"
+
+class CacheImagenes:
+    """
+    Cache LRU acotada por bytes. Cada página se renderiza y se codifica en base64
+    una sola vez aunque la pidan varios modelos o varias ventanas de chunks.
+    """
+    def __init__(self, max_bytes: int = MAX_BYTES_POR_DEFECTO):
+        self.max_bytes = max_bytes
+        self._entradas: "OrderedDict[LlaveImagen, ImagenRenderizada]" = OrderedDict()
+        self._lock = threading.Lock()
+        # Jobs en curso por documento: sus páginas no se descartan mientras otro job las use
+        self._reservas: Dict[str, int] = {}
+        self.bytes_actuales = 0
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+
+    def obtener(self, llave: LlaveImagen) -> Optional[ImagenRenderizada]:
+        with self._lock:
+            imagen = self._entradas.get(llave)
+            if imagen is None:
+                self.fallos += 1
+                return None
+            self._entradas.move_to_end(llave)
+            self.aciertos += 1
+            return imagen
+
+    def contiene(self, llave: LlaveImagen) -> bool:
+        """Consulta sin efectos: no cuenta acierto/fallo ni cambia el orden LRU."""
+        with self._lock:
+            return llave in self._entradas
+
+    def guardar(self, llave: LlaveImagen, imagen: ImagenRenderizada) -> None:
+        with self._lock:
+            # Una imagen más grande que todo el presupuesto no se cachea
+            if imagen.tamano > self.max_bytes:
+                return
+
+            anterior = self._entradas.pop(llave, None)
+            if anterior is not None:
+                self.bytes_actuales -= anterior.tamano
+
+            self._entradas[llave] = imagen
+            self.bytes_actuales += imagen.tamano
+
+            while self.bytes_actuales > self.max_bytes and self._entradas:
+                _, expulsada = self._entradas.popitem(last=False)
+                self.bytes_actuales -= expulsada.tamano
+                self.expulsiones += 1
+
+    def estadisticas(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entradas": len(self._entradas),
+                "bytes": self.bytes_actuales,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+            }
+
+    def reservar_documento(self, hash_documento: str) -> None:
+        """Marca el documento como en uso por un job (una reserva por cada vez que el job lo trae)."""
+        with self._lock:
+            self._reservas[hash_documento] = self._reservas.get(hash_documento, 0) + 1
+
+    def soltar_documento(self, hash_documento: str) -> None:
+        with self._lock:
+            restantes = self._reservas.get(hash_documento, 0) - 1
+            if restantes > 0:
+                self._reservas[hash_documento] = restantes
+            else:
+                self._reservas.pop(hash_documento, None)
+
+    def descartar_documento(self, hash_documento: str, reservas_propias: int = 0) -> int:
+        """
+        Saca de la cache todas las páginas de un documento (job cancelado); devuelve los bytes liberados.
+        Si otro job lo tiene reservado (más reservas que las 'reservas_propias' de quien descarta), no toca nada.
+        """
+        with self._lock:
+            if self._reservas.get(hash_documento, 0) > reservas_propias:
+                return 0
+            llaves = [llave for llave in self._entradas if llave[0] == hash_documento]
+            liberados = 0
+            for llave in llaves:
+                liberados += self._entradas.pop(llave).tamano
+            self.bytes_actuales -= liberados
+            return liberados
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._entradas.clear()
+            self.bytes_actuales = 0
+
+def renderizar_paginas_con_cache(
+    cache: CacheImagenes,
+    fuente: FuenteDocumento,
+    paginas: List[int],
+    perfil: PerfilImagen = PERFIL_ORIGINAL
+) -> List[ImagenRenderizada]:
+    """
+    Devuelve las páginas pedidas (1-indexadas) rasterizadas con el perfil indicado y en base64.
+    Solo abre el PDF (o usa la sesión recibida) si alguna página no está en cache.
+    Las páginas fuera de rango se omiten con una advertencia.
+    """
+    if isinstance(fuente, SesionDocumento):
+        hash_documento = fuente.hash_documento
+    else:
+        hash_documento = calcular_hash_documento(fuente)
+    resultados: Dict[int, ImagenRenderizada] = {}
+    faltantes = []
+
+    for num_pagina in paginas:
+        imagen = cache.obtener((hash_documento, num_pagina, perfil))
+        if imagen is not None:
+            resultados[num_pagina] = imagen
+        else:
+            faltantes.append(num_pagina)
+
+    if faltantes:
+        try:
+            with abrir_sesion(fuente) as sesion:
+                for num_pagina in faltantes:
+                    if 1 <= num_pagina <= sesion.total_paginas:
+                        contenido = sesion.codificar_pagina(num_pagina, perfil)
+                        imagen = ImagenRenderizada(contenido=contenido, data_url=construir_data_url(contenido, perfil.formato))
+                        cache.guardar((hash_documento, num_pagina, perfil), imagen)
+                        resultados[num_pagina] = imagen
+                    else:
+                        logger.warning(f"Advertencia: Página {num_pagina} fuera de rango.")
+        except Exception as e:
+            # Mismo contrato que convertir_pdf_a_imagenes
+            raise ValueError(f"No se pudo procesar el archivo como PDF: {e}")
+
+    logger.debug(f"Cache de imágenes: {cache.estadisticas()}")
+    # Respetamos el orden de la petición
+    return [resultados[p] for p in paginas if p in resultados]
+
+def paginas_sin_cache(cache: CacheImagenes, hash_documento: str, paginas: List[int], perfil: PerfilImagen) -> List[int]:
+    """Páginas que todavía no están rasterizadas con ese perfil."""
+    return [p for p in paginas if not cache.contiene((hash_documento, p, perfil))]
+
+def codificar_paginas_pdf(pdf_bytes: bytes, paginas: List[int], perfil: PerfilImagen = PERFIL_ORIGINAL) -> Dict[int, bytes]:
+    """
+    Rasteriza y codifica las páginas pedidas sin pasar por la cache.
+    Es el trabajo de CPU del flujo de visión: se manda al pool de procesos y el resultado
+    se guarda en la cache del proceso principal con 'guardar_paginas_codificadas'.
+    """
+    with SesionDocumento(pdf_bytes) as sesion:
+        return {p: sesion.codificar_pagina(p, perfil) for p in paginas if 1 <= p <= sesion.total_paginas}
+
+def guardar_paginas_codificadas(
+    cache: CacheImagenes,
+    hash_documento: str,
+    perfil: PerfilImagen,
+    paginas: Dict[int, bytes]
+) -> Dict[int, ImagenRenderizada]:
+    """Guarda en la cache páginas que se rasterizaron en otro proceso y las devuelve ya codificadas."""
+    imagenes = {}
+    for num_pagina, contenido in paginas.items():
+        imagen = ImagenRenderizada(contenido=contenido, data_url=construir_data_url(contenido, perfil.formato))
+        cache.guardar((hash_documento, num_pagina, perfil), imagen)
+        imagenes[num_pagina] = imagen
+    return imagenes
@@ -0,0 +1,398 @@
+# Registro durable de jobs de Fluxo: estado, avance por etapa, marcas de tiempo y errores en SQLite
+from ..core.config import settings
+from .llm_resiliencia import job_actual
+from .llm_governor import HOST, _arranque_actual, _proceso_vivo
+
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, List, Optional, Tuple
+import threading
+import json
+import sqlite3
+import logging
+import queue
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+class EstadoJob(str, Enum):
+    EN_COLA = "en_cola"
+    PROCESANDO = "procesando"
+    PARCIAL = "parcial" # Terminó, pero alguna cuenta o documento quedó con error
+    TERMINADO = "terminado"
+    FALLIDO = "fallido"
+    CANCELADO = "cancelado" # Detenido a pedido del cliente; conserva lo que ya había terminado
+
+ESTADOS_ACTIVOS = (EstadoJob.EN_COLA, EstadoJob.PROCESANDO)
+
+# Etapas con contador de avance (completados / total)
+ETAPA_DOCUMENTOS = "documentos"
+ETAPA_PORTADAS = "portadas"
+ETAPA_CUENTAS = "cuentas"
+ETAPA_CHUNKS = "chunks"
+ETAPA_CHUNKS_OCR = "chunks_ocr"
+ETAPA_REPORTE = "reporte"
+
+# Eventos del job (los transmite el endpoint SSE en orden)
+EVENTO_DOCUMENTOS_ACEPTADOS = "documentos_aceptados"
+EVENTO_JOB_INICIADO = "job_iniciado"
+EVENTO_PORTADA_TERMINADA = "portada_terminada"
+EVENTO_CHUNK_TERMINADO = "chunk_terminado"
+EVENTO_REPORTE_LISTO = "reporte_listo"
+EVENTO_CANCELACION_SOLICITADA = "cancelacion_solicitada"
+EVENTO_JOB_TERMINADO = "job_terminado"
+
+# Cuántas escrituras pendientes aplica el hilo escritor en una sola transacción
+MAX_ESCRITURAS_POR_LOTE = 200
+
+# Cada cuánto el hilo escritor borra los jobs que pasaron la retención
+INTERVALO_PURGA_SEGUNDOS = 3600
+
+@dataclass
+class InfoJob:
+    """Fotografía del estado de un job (lo que devuelve el endpoint de estado)."""
+    job_id: str
+    estado: EstadoJob
+    creado: float
+    actualizado: float
+    iniciado: Optional[float] = None
+    terminado: Optional[float] = None
+    error: Optional[str] = None
+    progreso: Dict[str, Dict[str, int]] = field(default_factory=dict)
+
+    @property
+    def activo(self) -> bool:
+        return self.estado in ESTADOS_ACTIVOS
+
+@dataclass
+class EventoJob:
+    id: int # Creciente: el cliente SSE lo manda como Last-Event-ID para retomar
+    tipo: str
+    datos: Dict[str, Any]
+    momento: float
+
+def _propietario() -> str:
+    # host:pid:token de arranque; el token distingue un PID reutilizado tras reiniciar el contenedor
+    return f"{HOST}:{os.getpid()}:{_arranque_actual()}"
+
+def _separar_propietario(propietario: Optional[str]) -> Tuple[str, Optional[int], Optional[str]]:
+    """(host, pid, arranque); los jobs anteriores al token guardaron solo 'host:pid' y su arranque es None."""
+    host, _, resto = (propietario or "").partition(":")
+    pid, _, arranque = resto.partition(":")
+    return host, int(pid) if pid.isdigit() else None, arranque or None
+
+class RegistroJobs:
+    """
+    Estado durable de los jobs. Las actualizaciones (avance, estado) se encolan y las aplica un
+    hilo escritor en lotes, así el event loop nunca espera al disco; 'crear' y las lecturas son directas.
+    Usa WAL, de modo que el endpoint de estado lee sin bloquear al escritor.
+    """
+    def __init__(self, ruta: str, habilitado: bool = True, retencion_segundos: float = 7 * 24 * 3600):
+        self.ruta = ruta
+        self.habilitado = habilitado
+        self.retencion_segundos = retencion_segundos
+        self._ultima_purga = 0.0
+        self._local = threading.local()
+        self._cola: "queue.SimpleQueue[Any]" = queue.SimpleQueue()
+        self._hilo: Optional[threading.Thread] = None
+        self._pid_hilo: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión SQLite no debe cruzar un fork ni compartirse entre hilos
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self.ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    estado TEXT NOT NULL,
+                    propietario TEXT,
+                    creado REAL NOT NULL,
+                    iniciado REAL,
+                    terminado REAL,
+                    actualizado REAL NOT NULL,
+                    error TEXT
+                )"""
+            )
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS progreso_job (
+                    job_id TEXT NOT NULL,
+                    etapa TEXT NOT NULL,
+                    completados INTEGER NOT NULL DEFAULT 0,
+                    total INTEGER NOT NULL DEFAULT 0,
+                    PRIMARY KEY (job_id, etapa)
+                )"""
+            )
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS eventos_job (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    job_id TEXT NOT NULL,
+                    tipo TEXT NOT NULL,
+                    datos TEXT NOT NULL,
+                    momento REAL NOT NULL
+                )"""
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_eventos_job ON eventos_job (job_id, id)")
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS cancelaciones (
+                    job_id TEXT PRIMARY KEY,
+                    motivo TEXT NOT NULL,
+                    momento REAL NOT NULL
+                )"""
+            )
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    # ----- Escritura asíncrona -----
+    def _asegurar_escritor(self) -> None:
+        with self._lock:
+            if self._hilo is None or not self._hilo.is_alive() or self._pid_hilo != os.getpid():
+                self._cola = queue.SimpleQueue()
+                self._hilo = threading.Thread(target=self._escritor, name="registro-jobs", daemon=True)
+                self._pid_hilo = os.getpid()
+                self._hilo.start()
+
+    def _encolar(self, sql: str, parametros: Tuple) -> None:
+        if not self.habilitado:
+            return
+        self._asegurar_escritor()
+        self._cola.put((sql, parametros))
+
+    def _escritor(self) -> None:
+        while True:
+            lote = [self._cola.get()]
+            while len(lote) < MAX_ESCRITURAS_POR_LOTE:
+                try:
+                    lote.append(self._cola.get_nowait())
+                except queue.Empty:
+                    break
+            escrituras = [item for item in lote if isinstance(item, tuple)]
+            if escrituras:
+                conexion = None
+                try:
+                    conexion = self._conexion()
+                    conexion.execute("BEGIN")
+                    for sql, parametros in escrituras:
+                        conexion.execute(sql, parametros)
+                    conexion.execute("COMMIT")
+                except sqlite3.Error as e:
+                    logger.warning(f"No se pudieron registrar {len(escrituras)} actualizaciones de jobs: {e}")
+                    if conexion is not None and conexion.in_transaction:
+                        conexion.execute("ROLLBACK")
+            # Los eventos son marcas de 'vaciar': se liberan cuando todo lo anterior ya está en disco
+            for item in lote:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if time.time() - self._ultima_purga > INTERVALO_PURGA_SEGUNDOS:
+                try:
+                    self.purgar()
+                except sqlite3.Error as e:
+                    logger.warning(f"No se pudieron purgar los jobs viejos: {e}")
+
+    def vaciar(self, timeout: Optional[float] = 5.0) -> bool:
+        """Espera a que se apliquen las actualizaciones pendientes (apagado, pruebas)."""
+        if not self.habilitado or self._hilo is None:
+            return True
+        listo = threading.Event()
+        self._cola.put(listo)
+        return listo.wait(timeout)
+
+    # ----- Ciclo de vida del job -----
+    def crear(self, job_id: str, documentos: int, archivos: Optional[List[str]] = None) -> None:
+        """Registra el job EN_COLA (escritura directa: el cliente puede consultar su estado de inmediato)."""
+        if not self.habilitado:
+            return
+        ahora = time.time()
+        conexion = self._conexion()
+        conexion.execute(
+            "INSERT INTO eventos_job (job_id, tipo, datos, momento) VALUES (?, ?, ?, ?)",
+            (job_id, EVENTO_DOCUMENTOS_ACEPTADOS, json.dumps({"documentos": documentos, "archivos": archivos or []}), ahora)
+        )
+        conexion.execute(
+            "INSERT OR REPLACE INTO jobs (job_id, estado, propietario, creado, actualizado) VALUES (?, ?, ?, ?, ?)",
+            (job_id, EstadoJob.EN_COLA.value, _propietario(), ahora, ahora)
+        )
+        conexion.execute(
+            "INSERT OR REPLACE INTO progreso_job (job_id, etapa, completados, total) VALUES (?, ?, 0, ?)",
+            (job_id, ETAPA_DOCUMENTOS, documentos)
+        )
+
+    def iniciar(self, job_id: str) -> None:
+        ahora = time.time()
+        self._encolar(
+            "UPDATE jobs SET estado = ?, propietario = ?, iniciado = ?, actualizado = ? WHERE job_id = ?",
+            (EstadoJob.PROCESANDO.value, _propietario(), ahora, ahora, job_id)
+        )
+        self.evento(EVENTO_JOB_INICIADO, job_id=job_id)
+
+    def avanzar(self, etapa: str, completados: int = 1, total: int = 0, job_id: Optional[str] = None) -> None:
+        """Suma 'completados' y 'total' a la etapa del job indicado o, si no se indica, al del contexto."""
+        job_id = job_id or job_actual.get()
+        if not job_id or (not completados and not total):
+            return
+        self._encolar(
+            """INSERT INTO progreso_job (job_id, etapa, completados, total) VALUES (?, ?, ?, ?)
+               ON CONFLICT (job_id, etapa) DO UPDATE SET
+                   completados = completados + excluded.completados, total = total + excluded.total""",
+            (job_id, etapa, completados, total)
+        )
+        self._encolar("UPDATE jobs SET actualizado = ? WHERE job_id = ?", (time.time(), job_id))
+
+    def evento(self, tipo: str, datos: Optional[Dict[str, Any]] = None, job_id: Optional[str] = None) -> None:
+        """Agrega un evento al job indicado o, si no se indica, al del contexto."""
+        job_id = job_id or job_actual.get()
+        if not job_id:
+            return
+        self._encolar(
+            "INSERT INTO eventos_job (job_id, tipo, datos, momento) VALUES (?, ?, ?, ?)",
+            (job_id, tipo, json.dumps(datos or {}, default=str), time.time())
+        )
+
+    def solicitar_cancelacion(self, job_id: str, motivo: str = "Cancelado por el cliente.") -> bool:
+        """
+        Pide detener un job activo (escritura directa). El proceso que lo ejecuta, sea cual sea,
+        lo ve en su siguiente revisión. Devuelve False si el job ya no está activo.
+        """
+        info = self.obtener(job_id)
+        if info is None or not info.activo:
+            return False
+        ahora = time.time()
+        conexion = self._conexion()
+        with conexion:
+            conexion.execute("BEGIN")
+            conexion.execute(
+                "INSERT OR IGNORE INTO cancelaciones (job_id, motivo, momento) VALUES (?, ?, ?)", (job_id, motivo, ahora)
+            )
+            conexion.execute(
+                "INSERT INTO eventos_job (job_id, tipo, datos, momento) VALUES (?, ?, ?, ?)",
+                (job_id, EVENTO_CANCELACION_SOLICITADA, json.dumps({"motivo": motivo}), ahora)
+            )
+        return True
+
+    def cancelacion_solicitada(self, job_id: str) -> Optional[str]:
+        """Motivo de la cancelación pedida para el job, o None si nadie la pidió."""
+        if not self.habilitado:
+            return None
+        fila = self._conexion().execute("SELECT motivo FROM cancelaciones WHERE job_id = ?", (job_id,)).fetchone()
+        return fila[0] if fila else None
+
+    def terminar(self, job_id: str, estado: EstadoJob = EstadoJob.TERMINADO, error: Optional[str] = None) -> None:
+        """Cierra el job con su estado final (TERMINADO, PARCIAL, CANCELADO o FALLIDO) y un resumen de errores."""
+        ahora = time.time()
+        self._encolar(
+            "UPDATE jobs SET estado = ?, terminado = ?, actualizado = ?, error = ? WHERE job_id = ?",
+            (estado.value, ahora, ahora, error, job_id)
+        )
+        # Va en el mismo lote que el estado: quien ve el job terminado ya ve también este evento
+        self.evento(EVENTO_JOB_TERMINADO, {"estatus": estado.value, "error": error}, job_id=job_id)
+
+    def fallar(self, job_id: str, error: str) -> None:
+        self.terminar(job_id, EstadoJob.FALLIDO, error)
+
+    # ----- Lecturas -----
+    def obtener(self, job_id: str) -> Optional[InfoJob]:
+        """Estado y avance del job sin tocar su resultado; None si el ID no existe."""
+        if not self.habilitado:
+            return None
+        conexion = self._conexion()
+        fila = conexion.execute(
+            "SELECT estado, creado, actualizado, iniciado, terminado, error FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        if fila is None:
+            return None
+        progreso = {
+            etapa: {"completados": completados, "total": total}
+            for etapa, completados, total in conexion.execute(
+                "SELECT etapa, completados, total FROM progreso_job WHERE job_id = ? ORDER BY etapa", (job_id,)
+            )
+        }
+        estado, creado, actualizado, iniciado, terminado, error = fila
+        return InfoJob(
+            job_id=job_id, estado=EstadoJob(estado), creado=creado, actualizado=actualizado,
+            iniciado=iniciado, terminado=terminado, error=error, progreso=progreso
+        )
+
+    def eventos(self, job_id: str, despues_de: int = 0, limite: int = 500) -> List[EventoJob]:
+        """Eventos del job con id mayor a 'despues_de', en orden."""
+        if not self.habilitado:
+            return []
+        filas = self._conexion().execute(
+            "SELECT id, tipo, datos, momento FROM eventos_job WHERE job_id = ? AND id > ? ORDER BY id LIMIT ?",
+            (job_id, despues_de, limite)
+        ).fetchall()
+        return [EventoJob(id=i, tipo=tipo, datos=json.loads(datos), momento=momento) for i, tipo, datos, momento in filas]
+
+    def recuperar_interrumpidos(self) -> List[str]:
+        """
+        Al arrancar: los jobs activos de ESTE host cuyo proceso ya no existe (reinicio, caída), o es
+        otro que reutilizó el PID, se marcan FALLIDO en lugar de quedarse 'procesando' para siempre.
+        """
+        if not self.habilitado:
+            return []
+        interrumpidos = []
+        conexion = self._conexion()
+        filas = conexion.execute(
+            f"SELECT job_id, propietario FROM jobs WHERE estado IN ({','.join('?' * len(ESTADOS_ACTIVOS))})",
+            tuple(e.value for e in ESTADOS_ACTIVOS)
+        ).fetchall()
+        for job_id, propietario in filas:
+            host_job, pid, arranque = _separar_propietario(propietario)
+            # Al arrancar ningún job activo puede ser de este proceso, aunque un reinicio le haya dado el mismo PID
+            if host_job == HOST and pid is not None and pid != os.getpid() and _proceso_vivo(pid, arranque):
+                continue
+            if host_job and host_job != HOST:
+                continue
+            ahora = time.time()
+            error = "El servidor se reinició mientras el job estaba en proceso."
+            with conexion: # Estado y evento final en la misma transacción
+                conexion.execute("BEGIN")
+                conexion.execute(
+                    "UPDATE jobs SET estado = ?, terminado = ?, actualizado = ?, error = ? WHERE job_id = ?",
+                    (EstadoJob.FALLIDO.value, ahora, ahora, error, job_id)
+                )
+                conexion.execute(
+                    "INSERT INTO eventos_job (job_id, tipo, datos, momento) VALUES (?, ?, ?, ?)",
+                    (job_id, EVENTO_JOB_TERMINADO, json.dumps({"estatus": EstadoJob.FALLIDO.value, "error": error}), ahora)
+                )
+            interrumpidos.append(job_id)
+        if interrumpidos:
+            logger.warning(f"{len(interrumpidos)} jobs interrumpidos por un reinicio quedaron como fallidos.")
+        return interrumpidos
+
+    def purgar(self) -> int:
+        """
+        Retención: borra los jobs terminados hace más de 'retencion_segundos' junto con su avance,
+        eventos y cancelaciones. Corre al arrancar y desde el hilo escritor cada INTERVALO_PURGA_SEGUNDOS.
+        Devuelve cuántos jobs se borraron.
+        """
+        if not self.habilitado:
+            return 0
+        ahora = time.time()
+        self._ultima_purga = ahora
+        limite = ahora - self.retencion_segundos
+        activos = tuple(e.value for e in ESTADOS_ACTIVOS)
+        conexion = self._conexion()
+        with conexion:
+            conexion.execute("BEGIN")
+            borrados = conexion.execute(
+                f"DELETE FROM jobs WHERE estado NOT IN ({','.join('?' * len(activos))}) AND actualizado < ?",
+                (*activos, limite)
+            ).rowcount
+            # Lo que quedó sin job: lo de los recién borrados y lo de jobs que nunca llegaron a registrarse
+            conexion.execute("DELETE FROM progreso_job WHERE job_id NOT IN (SELECT job_id FROM jobs)")
+            conexion.execute("DELETE FROM cancelaciones WHERE job_id NOT IN (SELECT job_id FROM jobs)")
+            conexion.execute(
+                "DELETE FROM eventos_job WHERE momento < ? AND job_id NOT IN (SELECT job_id FROM jobs)", (limite,)
+            )
+        if borrados:
+            logger.info(f"{borrados} jobs terminados hace más de {self.retencion_segundos / 3600:.0f} horas purgados.")
+        return borrados
+
+registro_jobs = RegistroJobs(ruta=settings.JOBS_DB_PATH, retencion_segundos=settings.JOBS_RETENCION_HORAS * 3600)
@@ -0,0 +1,180 @@
+# Cache persistente (SQLite) de respuestas de los modelos: si el mismo documento vuelve a
+# subirse con el mismo prompt y modelo, la respuesta sale de disco en lugar de pagarse otra vez
+from typing import Any, Dict, Iterable, List, Optional
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Parámetros de la llamada que cambian la respuesta (el resto, como el timeout, no forma parte de la llave)
+PARAMETROS_EN_LLAVE = ("reasoning_effort", "temperature", "max_tokens", "response_format")
+
+def _sha256(texto: str) -> str:
+    return hashlib.sha256(texto.encode("utf-8")).hexdigest()
+
+def calcular_llave(modelo: str, messages: List[Dict[str, Any]], **parametros) -> str:
+    """
+    Llave = hash de (modelo, hash del prompt de sistema, hash del contenido de usuario, hashes de imágenes,
+    parámetros de muestreo). Los prompts viajan completos dentro de los mensajes, así que cambiar
+    un prompt (p. ej. en helpers_texto_fluxo) produce llaves nuevas y las entradas viejas dejan de usarse.
+    """
+    sistema: List[str] = []
+    usuario: List[str] = []
+    imagenes: List[str] = []
+
+    for mensaje in messages:
+        destino = sistema if mensaje.get("role") == "system" else usuario
+        contenido = mensaje.get("content")
+        partes: Iterable = [{"type": "text", "text": contenido}] if isinstance(contenido, str) else (contenido or [])
+        for parte in partes:
+            if parte.get("type") == "image_url":
+                imagenes.append(_sha256(parte["image_url"]["url"]))
+            else:
+                destino.append(_sha256(parte.get("text", "")))
+
+    material = {
+        "modelo": modelo,
+        "sistema": _sha256("|".join(sistema)),
+        "usuario": _sha256("|".join(usuario)),
+        "imagenes": imagenes,
+        "parametros": {k: parametros[k] for k in PARAMETROS_EN_LLAVE if parametros.get(k) is not None},
+    }
+    return _sha256(json.dumps(material, sort_keys=True, default=str))
+
+class CacheRespuestasLLM:
+    """
+    Cache en SQLite con TTL y tamaño máximo (expulsa por último acceso).
+    Puede compartirse entre la API y los procesos worker: SQLite serializa las escrituras
+    (modo WAL) y cada hilo usa su propia conexión.
+    """
+    def __init__(self, ruta: str, ttl_segundos: float, max_bytes: int, habilitada: bool = True):
+        self.ruta = ruta
+        self.ttl_segundos = ttl_segundos
+        self.max_bytes = max_bytes
+        self.habilitada = habilitada
+        self.aciertos = 0
+        self.fallos = 0
+        self.expulsiones = 0
+        self._local = threading.local()
+        self._lock_contadores = threading.Lock()
+        self._esquema_creado = False
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión SQLite no debe cruzar un fork: tras fork() el proceso hijo abre la suya
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self.ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute("PRAGMA synchronous=NORMAL")
+            if not self._esquema_creado:
+                conexion.execute(
+                    """CREATE TABLE IF NOT EXISTS respuestas (
+                        llave TEXT PRIMARY KEY,
+                        modelo TEXT NOT NULL,
+                        respuesta TEXT NOT NULL,
+                        tamano INTEGER NOT NULL,
+                        creado REAL NOT NULL,
+                        ultimo_acceso REAL NOT NULL
+                    )"""
+                )
+                conexion.execute("CREATE INDEX IF NOT EXISTS idx_respuestas_acceso ON respuestas (ultimo_acceso)")
+                self._esquema_creado = True
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    def _contar(self, acierto: bool) -> None:
+        with self._lock_contadores:
+            if acierto:
+                self.aciertos += 1
+            else:
+                self.fallos += 1
+
+    def obtener(self, llave: str) -> Optional[str]:
+        """Devuelve la respuesta guardada o None si no existe o ya expiró."""
+        if not self.habilitada:
+            return None
+        try:
+            conexion = self._conexion()
+            fila = conexion.execute("SELECT respuesta, creado FROM respuestas WHERE llave = ?", (llave,)).fetchone()
+            ahora = time.time()
+            if fila is None or ahora - fila[1] > self.ttl_segundos:
+                if fila is not None:
+                    conexion.execute("DELETE FROM respuestas WHERE llave = ?", (llave,))
+                self._contar(False)
+                return None
+            conexion.execute("UPDATE respuestas SET ultimo_acceso = ? WHERE llave = ?", (ahora, llave))
+            self._contar(True)
+            return fila[0]
+        except sqlite3.Error as e:
+            # La cache nunca debe tumbar una petición: sin cache se llama al modelo
+            logger.warning(f"Cache LLM no disponible para lectura: {e}")
+            self._contar(False)
+            return None
+
+    def guardar(self, llave: str, modelo: str, respuesta: str) -> None:
+        if not self.habilitada or not respuesta:
+            return
+        ahora = time.time()
+        tamano = len(respuesta.encode("utf-8"))
+        if tamano > self.max_bytes:
+            return
+        try:
+            conexion = self._conexion()
+            conexion.execute(
+                "INSERT OR REPLACE INTO respuestas (llave, modelo, respuesta, tamano, creado, ultimo_acceso) VALUES (?, ?, ?, ?, ?, ?)",
+                (llave, modelo, respuesta, tamano, ahora, ahora)
+            )
+            self._expulsar(conexion, ahora)
+        except sqlite3.Error as e:
+            logger.warning(f"Cache LLM no disponible para escritura: {e}")
+
+    def _expulsar(self, conexion: sqlite3.Connection, ahora: float) -> None:
+        """Borra lo expirado y, si aún se excede el tamaño, lo menos usado recientemente."""
+        conexion.execute("DELETE FROM respuestas WHERE creado < ?", (ahora - self.ttl_segundos,))
+        total = conexion.execute("SELECT COALESCE(SUM(tamano), 0) FROM respuestas").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+
+        exceso = total - self.max_bytes
+        liberado = 0
+        llaves = []
+        for llave, tamano in conexion.execute("SELECT llave, tamano FROM respuestas ORDER BY ultimo_acceso ASC"):
+            llaves.append(llave)
+            liberado += tamano
+            if liberado >= exceso:
+                break
+        conexion.executemany("DELETE FROM respuestas WHERE llave = ?", [(llave,) for llave in llaves])
+        with self._lock_contadores:
+            self.expulsiones += len(llaves)
+
+    def estadisticas(self) -> Dict[str, Any]:
+        entradas, total = 0, 0
+        if self.habilitada:
+            try:
+                entradas, total = self._conexion().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(tamano), 0) FROM respuestas"
+                ).fetchone()
+            except sqlite3.Error:
+                pass
+        with self._lock_contadores:
+            return {
+                "habilitada": self.habilitada,
+                "entradas": entradas,
+                "bytes": total,
+                "max_bytes": self.max_bytes,
+                "aciertos": self.aciertos,
+                "fallos": self.fallos,
+                "expulsiones": self.expulsiones,
+            }
+
+    def limpiar(self) -> None:
+        self._conexion().execute("DELETE FROM respuestas")
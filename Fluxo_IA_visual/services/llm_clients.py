@@ -0,0 +1,118 @@
+# Registro de clientes LLM de larga vida: un solo transporte HTTP (pool de conexiones + TLS)
+# compartido por todos los clientes del proceso
+from ..core.config import settings
+
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, Timeout
+from typing import Any, Dict, Optional
+import importlib.util
+import asyncio
+import logging
+import httpx
+
+logger = logging.getLogger(__name__)
+
+# Nombres de los clientes registrados
+CLIENTE_FLUXO = "fluxo"
+CLIENTE_NOMI = "nomi"
+CLIENTE_OPENROUTER = "openrouter"
+
+def http2_disponible() -> bool:
+    """httpx solo negocia HTTP/2 si el paquete 'h2' está instalado (httpx[http2])."""
+    return importlib.util.find_spec("h2") is not None
+
+def timeout_llamada(segundos: float) -> Timeout:
+    """Timeout explícito para UNA llamada: 'segundos' para leer la respuesta y el connect configurado."""
+    return Timeout(segundos, connect=settings.LLM_CONNECT_TIMEOUT_SECONDS)
+
+class RegistroClientesLLM:
+    """
+    Crea los clientes AsyncOpenAI una sola vez sobre un httpx.AsyncClient compartido.
+    - En la API lo abre y lo cierra el lifespan de FastAPI.
+    - Todas las llamadas LLM corren en ese mismo loop (los procesos worker solo hacen CPU).
+    Las conexiones de httpx pertenecen al event loop en el que se crearon: si el registro se usa
+    desde otro loop, los clientes se recrean en lugar de reutilizar conexiones de un loop ajeno.
+    """
+    def __init__(self):
+        self._http: Optional[httpx.AsyncClient] = None
+        self._clientes: Dict[str, AsyncOpenAI] = {}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _crear_transporte(self) -> httpx.AsyncClient:
+        usar_http2 = settings.LLM_HTTP2 and http2_disponible()
+        if settings.LLM_HTTP2 and not usar_http2:
+            logger.info("HTTP/2 no disponible (falta el paquete 'h2'); los clientes LLM usarán HTTP/1.1.")
+
+        return DefaultAsyncHttpxClient(
+            http2=usar_http2,
+            limits=httpx.Limits(
+                max_connections=settings.LLM_MAX_CONNECTIONS,
+                max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY_SECONDS,
+            ),
+            timeout=timeout_llamada(settings.LLM_TIMEOUT_SECONDS),
+        )
+
+    def _crear_clientes(self) -> None:
+        self._http = self._crear_transporte()
+        # Los reintentos los maneja ia_extractor (backoff + Retry-After + contadores por job),
+        # así que el SDK no reintenta por su cuenta (evita multiplicar los intentos)
+        comunes: Dict[str, Any] = {"http_client": self._http, "max_retries": 0}
+        self._clientes = {
+            CLIENTE_FLUXO: AsyncOpenAI(api_key=settings.OPENAI_API_KEY_FLUXO.get_secret_value(), **comunes),
+            CLIENTE_NOMI: AsyncOpenAI(api_key=settings.OPENAI_API_KEY_NOMI.get_secret_value(), **comunes),
+            CLIENTE_OPENROUTER: AsyncOpenAI(
+                api_key=settings.OPENROUTER_API_KEY.get_secret_value(),
+                base_url=settings.OPENROUTER_BASE_URL,
+                default_headers={
+                    "HTTP-Referer": "https://github.com/Asfilcnx3",
+                    "X-Title": "Fluxo IA Test",
+                },
+                **comunes
+            ),
+        }
+
+    def iniciar(self) -> None:
+        """Crea los clientes ligados al event loop actual (se llama desde el lifespan)."""
+        loop = asyncio.get_running_loop()
+        if self._loop is loop and self._clientes:
+            return
+        if self._clientes:
+            self._descartar_transporte()
+        self._crear_clientes()
+        self._loop = loop
+
+    def _descartar_transporte(self) -> None:
+        """
+        Suelta el transporte ligado a otro event loop. Si ese loop sigue vivo, el cierre se agenda
+        en él; si ya terminó, sus sockets no se pueden cerrar desde aquí y se avisa (fuga de conexiones).
+        """
+        http, loop_anterior = self._http, self._loop
+        self._http, self._clientes = None, {}
+        if http is None:
+            return
+        if loop_anterior is not None and loop_anterior.is_running():
+            asyncio.run_coroutine_threadsafe(http.aclose(), loop_anterior)
+            logger.info("Event loop distinto: se recrean los clientes LLM (el transporte anterior se cierra en su loop).")
+        else:
+            logger.warning(
+                "Event loop distinto: se recrean los clientes LLM; el loop anterior terminó sin llamar a "
+                "'cerrar' y sus conexiones abiertas no se pueden cerrar."
+            )
+
+    def obtener(self, nombre: str) -> AsyncOpenAI:
+        """Devuelve el cliente registrado con ese nombre (creándolos la primera vez)."""
+        self.iniciar()
+        try:
+            return self._clientes[nombre]
+        except KeyError:
+            raise ValueError(f"Cliente LLM desconocido: '{nombre}'. Opciones: {sorted(self._clientes)}")
+
+    async def cerrar(self) -> None:
+        """Cierra el transporte compartido (y con él todas las conexiones abiertas)."""
+        if self._http is not None and self._loop is asyncio.get_running_loop():
+            await self._http.aclose()
+        self._http = None
+        self._clientes = {}
+        self._loop = None
+
+registro_clientes_llm = RegistroClientesLLM()
@@ -0,0 +1,375 @@
+# Gobernador global de concurrencia LLM: limita solicitudes en vuelo, solicitudes/minuto y
+# tokens/minuto por proveedor, compartido por la API y todos los procesos worker (estado en SQLite)
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
+import os
+import time
+import uuid
+import random
+import socket
+import sqlite3
+import asyncio
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Clases de prioridad (menor número = pasa primero)
+PRIORIDAD_PORTADA = 0         # Metadatos de portada y endpoints interactivos (NomiFlash, CSF)
+PRIORIDAD_CHUNK_DIGITAL = 1   # Agentes TPV sobre texto
+PRIORIDAD_OCR_VISION = 2      # Agentes OCR-Visión (ZIPs escaneados, lo más pesado)
+
+# Estimación de tokens cuando aún no se conoce el uso real
+CARACTERES_POR_TOKEN = 4
+TOKENS_POR_IMAGEN = 1100
+TOKENS_SALIDA_POR_DEFECTO = 2000
+
+# Un proceso que espera y deja de actualizar su latido se considera muerto
+LATIDO_MAXIMO_SEGUNDOS = 15.0
+# Un permiso que nadie libera (proceso caído a media llamada) vence solo
+DURACION_MAXIMA_PERMISO_SEGUNDOS = 900.0
+
+SONDEO_MINIMO_SEGUNDOS = 0.05
+SONDEO_MAXIMO_SEGUNDOS = 0.5
+
+_ESQUEMA = """
+CREATE TABLE IF NOT EXISTS cubetas (
+    proveedor TEXT PRIMARY KEY,
+    solicitudes REAL NOT NULL,
+    tokens REAL NOT NULL,
+    actualizado REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS permisos (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    proveedor TEXT NOT NULL,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    arranque TEXT NOT NULL,
+    prioridad INTEGER NOT NULL,
+    concedido REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS esperas (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    proveedor TEXT NOT NULL,
+    host TEXT NOT NULL,
+    pid INTEGER NOT NULL,
+    arranque TEXT NOT NULL,
+    prioridad INTEGER NOT NULL,
+    latido REAL NOT NULL
+);
+"""
+
+@dataclass(frozen=True)
+class LimitesProveedor:
+    """Límites de un proveedor (o de una API key): en vuelo, solicitudes por minuto y tokens por minuto."""
+    concurrentes: int = 16
+    rpm: int = 500
+    tpm: int = 800_000
+
+def estimar_tokens(messages: List[Dict[str, Any]], max_tokens: Optional[int] = None) -> int:
+    """Estimación barata (sin tokenizer): caracteres / 4 + costo fijo por imagen + la salida esperada."""
+    caracteres = 0
+    imagenes = 0
+    for mensaje in messages:
+        contenido = mensaje.get("content")
+        if isinstance(contenido, str):
+            caracteres += len(contenido)
+            continue
+        for parte in contenido or []:
+            if parte.get("type") == "image_url":
+                imagenes += 1
+            else:
+                caracteres += len(parte.get("text", ""))
+    salida = max_tokens if max_tokens is not None else TOKENS_SALIDA_POR_DEFECTO
+    return caracteres // CARACTERES_POR_TOKEN + imagenes * TOKENS_POR_IMAGEN + salida
+
+HOST = socket.gethostname()
+
+def _arranque_proceso(pid: int) -> Optional[str]:
+    """
+    Huella de una ejecución concreta del proceso: boot_id del kernel + instante de arranque del PID
+    (campo 22 de /proc/<pid>/stat). Distingue un PID reutilizado tras reiniciar el contenedor o la máquina.
+    Devuelve None si /proc no está disponible.
+    """
+    try:
+        with open("/proc/sys/kernel/random/boot_id") as archivo:
+            boot_id = archivo.read().strip()
+        with open(f"/proc/{pid}/stat") as archivo:
+            campos = archivo.read().rsplit(")", 1)[1].split()
+        return f"{boot_id}:{campos[19]}"
+    except (OSError, IndexError):
+        return None
+
+_identidad: Tuple[int, str] = (0, "")
+
+def _arranque_actual() -> str:
+    """Token de arranque de este proceso; tras un fork el hijo calcula el suyo."""
+    global _identidad
+    pid = os.getpid()
+    if _identidad[0] != pid:
+        # Sin /proc se usa un uuid: no se puede verificar desde otro proceso, pero no se repite entre arranques
+        _identidad = (pid, _arranque_proceso(pid) or uuid.uuid4().hex)
+    return _identidad[1]
+
+def _proceso_vivo(pid: int, arranque: Optional[str] = None) -> bool:
+    """True si el PID existe y, cuando se conoce su token de arranque, sigue siendo el mismo proceso."""
+    if pid == os.getpid():
+        return arranque is None or arranque == _arranque_actual()
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    if arranque is None:
+        return True
+    actual = _arranque_proceso(pid)
+    return actual is None or actual == arranque
+
+class Permiso:
+    """Permiso concedido por el gobernador. 'registrar_uso' corrige el bucket con los tokens reales."""
+    def __init__(self, id_permiso: Optional[int], proveedor: str, tokens_estimados: int):
+        self.id_permiso = id_permiso
+        self.proveedor = proveedor
+        self.tokens_estimados = tokens_estimados
+        self.tokens_reales: Optional[int] = None
+        self.segundos_espera = 0.0
+
+    def registrar_uso(self, tokens: Optional[int]) -> None:
+        if tokens is not None:
+            self.tokens_reales = tokens
+
+class GobernadorLLM:
+    """
+    Token bucket (solicitudes y tokens) + semáforo por proveedor, con el estado en una base SQLite
+    para que todos los procesos de la máquina respeten los mismos límites.
+    Prioridades: mientras haya alguien vivo esperando con mejor prioridad para el mismo
+    proveedor, las clases inferiores no adquieren permiso.
+    Si SQLite falla, el gobernador deja pasar la llamada (nunca debe tumbar una petición).
+    """
+    def __init__(self, ruta: str, limites: Dict[str, LimitesProveedor], habilitado: bool = True):
+        self.ruta = ruta
+        self.limites = limites
+        self.habilitado = habilitado
+        self._local = threading.local()
+        self._esquema_creado = False
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión SQLite no debe cruzar un fork: tras fork() el proceso hijo abre la suya
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self.ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            if not self._esquema_creado:
+                columnas = {fila[1] for fila in conexion.execute("PRAGMA table_info(permisos)")}
+                if columnas and "arranque" not in columnas:
+                    # Base de una versión anterior (permisos solo por PID): el estado es efímero, se recrea
+                    conexion.executescript("DROP TABLE IF EXISTS permisos; DROP TABLE IF EXISTS esperas;")
+                conexion.executescript(_ESQUEMA)
+                self._esquema_creado = True
+                self._limpiar_arranques_anteriores(conexion)
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    def _limites(self, proveedor: str) -> LimitesProveedor:
+        return self.limites.get(proveedor) or LimitesProveedor()
+
+    # ----- Operaciones síncronas (cada una es una transacción corta) -----
+    def _registrar_espera(self, proveedor: str, prioridad: int) -> int:
+        cursor = self._conexion().execute(
+            "INSERT INTO esperas (proveedor, host, pid, arranque, prioridad, latido) VALUES (?, ?, ?, ?, ?, ?)",
+            (proveedor, HOST, os.getpid(), _arranque_actual(), prioridad, time.time())
+        )
+        return cursor.lastrowid
+
+    def _quitar_espera(self, id_espera: int) -> None:
+        self._conexion().execute("DELETE FROM esperas WHERE id = ?", (id_espera,))
+
+    def _quitar_muertos(self, conexion: sqlite3.Connection, tabla: str, proveedor: Optional[str] = None) -> None:
+        """Borra las filas de esta máquina cuyo proceso ya no existe o es otro que reutilizó el PID."""
+        consulta = f"SELECT DISTINCT pid, arranque FROM {tabla} WHERE host = ?"
+        parametros: Tuple[Any, ...] = (HOST,)
+        if proveedor is not None:
+            consulta += " AND proveedor = ?"
+            parametros += (proveedor,)
+        muertos = [
+            (HOST, pid, arranque) for pid, arranque in conexion.execute(consulta, parametros)
+            if not _proceso_vivo(pid, arranque)
+        ]
+        if muertos:
+            conexion.executemany(f"DELETE FROM {tabla} WHERE host = ? AND pid = ? AND arranque = ?", muertos)
+
+    def _purgar(self, conexion: sqlite3.Connection, proveedor: str, ahora: float) -> None:
+        """Elimina esperas sin latido y permisos de procesos que ya no existen o que vencieron."""
+        conexion.execute("DELETE FROM esperas WHERE latido < ?", (ahora - LATIDO_MAXIMO_SEGUNDOS,))
+        conexion.execute("DELETE FROM permisos WHERE concedido < ?", (ahora - DURACION_MAXIMA_PERMISO_SEGUNDOS,))
+        self._quitar_muertos(conexion, "permisos", proveedor)
+
+    def _limpiar_arranques_anteriores(self, conexion: sqlite3.Connection) -> None:
+        """Al arrancar: permisos y esperas de ejecuciones previas en esta máquina no esperan a vencer."""
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            self._quitar_muertos(conexion, "permisos")
+            self._quitar_muertos(conexion, "esperas")
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def limpiar_arranques_anteriores(self) -> None:
+        """Se llama al iniciar la API o un worker: la primera conexión del proceso hace la limpieza."""
+        if not self.habilitado:
+            return
+        try:
+            self._conexion()
+        except sqlite3.Error as e:
+            logger.warning(f"No se pudieron limpiar los permisos LLM de arranques anteriores: {e}")
+
+    def _intentar_adquirir(self, proveedor: str, prioridad: int, tokens: int, id_espera: int) -> Tuple[Optional[int], float]:
+        """
+        Intenta tomar un permiso. Devuelve (id_permiso, 0) si lo consiguió o (None, segundos sugeridos
+        de espera) si no. El bucket se rellena de forma continua: rpm/60 solicitudes y tpm/60 tokens por segundo.
+        """
+        limites = self._limites(proveedor)
+        # Un pedido mayor que la capacidad del bucket nunca pasaría: se recorta a la capacidad
+        tokens = min(tokens, limites.tpm)
+        conexion = self._conexion()
+        ahora = time.time()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute("UPDATE esperas SET latido = ? WHERE id = ?", (ahora, id_espera))
+            self._purgar(conexion, proveedor, ahora)
+
+            mejor_esperando = conexion.execute(
+                "SELECT 1 FROM esperas WHERE proveedor = ? AND prioridad < ? LIMIT 1", (proveedor, prioridad)
+            ).fetchone()
+            if mejor_esperando:
+                conexion.execute("COMMIT")
+                return None, SONDEO_MAXIMO_SEGUNDOS
+
+            en_vuelo = conexion.execute("SELECT COUNT(*) FROM permisos WHERE proveedor = ?", (proveedor,)).fetchone()[0]
+            if en_vuelo >= limites.concurrentes:
+                conexion.execute("COMMIT")
+                return None, SONDEO_MINIMO_SEGUNDOS * 2
+
+            fila = conexion.execute(
+                "SELECT solicitudes, tokens, actualizado FROM cubetas WHERE proveedor = ?", (proveedor,)
+            ).fetchone()
+            solicitudes, tokens_disponibles, actualizado = fila if fila else (limites.rpm, limites.tpm, ahora)
+            transcurrido = max(ahora - actualizado, 0.0)
+            solicitudes = min(limites.rpm, solicitudes + transcurrido * limites.rpm / 60)
+            tokens_disponibles = min(limites.tpm, tokens_disponibles + transcurrido * limites.tpm / 60)
+
+            if solicitudes < 1 or tokens_disponibles < tokens:
+                faltan_solicitudes = max(1 - solicitudes, 0) * 60 / limites.rpm
+                faltan_tokens = max(tokens - tokens_disponibles, 0) * 60 / limites.tpm
+                conexion.execute(
+                    "INSERT OR REPLACE INTO cubetas (proveedor, solicitudes, tokens, actualizado) VALUES (?, ?, ?, ?)",
+                    (proveedor, solicitudes, tokens_disponibles, ahora)
+                )
+                conexion.execute("COMMIT")
+                return None, max(faltan_solicitudes, faltan_tokens)
+
+            conexion.execute(
+                "INSERT OR REPLACE INTO cubetas (proveedor, solicitudes, tokens, actualizado) VALUES (?, ?, ?, ?)",
+                (proveedor, solicitudes - 1, tokens_disponibles - tokens, ahora)
+            )
+            cursor = conexion.execute(
+                "INSERT INTO permisos (proveedor, host, pid, arranque, prioridad, concedido) VALUES (?, ?, ?, ?, ?, ?)",
+                (proveedor, HOST, os.getpid(), _arranque_actual(), prioridad, ahora)
+            )
+            conexion.execute("DELETE FROM esperas WHERE id = ?", (id_espera,))
+            conexion.execute("COMMIT")
+            return cursor.lastrowid, 0.0
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    def _liberar(self, permiso: Permiso) -> None:
+        """Devuelve el lugar en vuelo y corrige el bucket con la diferencia entre lo estimado y lo real."""
+        conexion = self._conexion()
+        conexion.execute("BEGIN IMMEDIATE")
+        try:
+            conexion.execute("DELETE FROM permisos WHERE id = ?", (permiso.id_permiso,))
+            if permiso.tokens_reales is not None:
+                # Si se gastó más de lo estimado el bucket puede quedar negativo (deuda que se paga esperando)
+                limites = self._limites(permiso.proveedor)
+                conexion.execute(
+                    "UPDATE cubetas SET tokens = MIN(?, tokens + ?) WHERE proveedor = ?",
+                    (limites.tpm, permiso.tokens_estimados - permiso.tokens_reales, permiso.proveedor)
+                )
+            conexion.execute("COMMIT")
+        except BaseException:
+            conexion.execute("ROLLBACK")
+            raise
+
+    # ----- API asíncrona -----
+    @asynccontextmanager
+    async def permiso(self, proveedor: str, prioridad: int, tokens_estimados: int) -> AsyncIterator[Permiso]:
+        """
+        async with gobernador.permiso(CLIENTE_FLUXO, PRIORIDAD_PORTADA, tokens) as permiso:
+            respuesta = await cliente.chat.completions.create(...)
+            permiso.registrar_uso(respuesta.usage.total_tokens)
+        """
+        if not self.habilitado:
+            yield Permiso(None, proveedor, tokens_estimados)
+            return
+
+        inicio = time.monotonic()
+        permiso = None
+        id_espera = None
+        try:
+            id_espera = await asyncio.to_thread(self._registrar_espera, proveedor, prioridad)
+            while True:
+                id_permiso, espera = await asyncio.to_thread(
+                    self._intentar_adquirir, proveedor, prioridad, tokens_estimados, id_espera
+                )
+                if id_permiso is not None:
+                    permiso = Permiso(id_permiso, proveedor, tokens_estimados)
+                    break
+                # Jitter para que los procesos no sondeen todos al mismo tiempo
+                espera = min(max(espera, SONDEO_MINIMO_SEGUNDOS), SONDEO_MAXIMO_SEGUNDOS)
+                await asyncio.sleep(espera * random.uniform(0.5, 1.0))
+        except sqlite3.Error as e:
+            logger.warning(f"Gobernador LLM no disponible, la llamada a '{proveedor}' pasa sin límite: {e}")
+            permiso = Permiso(None, proveedor, tokens_estimados)
+        finally:
+            if permiso is None and id_espera is not None:
+                # Cancelado mientras esperaba: no dejar la espera registrada bloqueando a las clases inferiores
+                try:
+                    await asyncio.shield(asyncio.to_thread(self._quitar_espera, id_espera))
+                except (sqlite3.Error, asyncio.CancelledError):
+                    pass
+
+        permiso.segundos_espera = time.monotonic() - inicio
+        if permiso.segundos_espera > 1:
+            logger.info(f"Gobernador LLM: '{proveedor}' (prioridad {prioridad}) esperó {permiso.segundos_espera:.1f}s.")
+        try:
+            yield permiso
+        finally:
+            if permiso.id_permiso is not None:
+                try:
+                    await asyncio.shield(asyncio.to_thread(self._liberar, permiso))
+                except (sqlite3.Error, asyncio.CancelledError) as e:
+                    # El permiso vence solo por DURACION_MAXIMA_PERMISO_SEGUNDOS o al morir el proceso
+                    logger.warning(f"No se pudo liberar el permiso LLM {permiso.id_permiso}: {e}")
+
+    def estado(self, proveedor: str) -> Dict[str, Any]:
+        """Foto del estado actual de un proveedor (en vuelo, esperando por prioridad y bucket)."""
+        conexion = self._conexion()
+        en_vuelo = conexion.execute("SELECT COUNT(*) FROM permisos WHERE proveedor = ?", (proveedor,)).fetchone()[0]
+        esperando = dict(conexion.execute(
+            "SELECT prioridad, COUNT(*) FROM esperas WHERE proveedor = ? GROUP BY prioridad", (proveedor,)
+        ).fetchall())
+        fila = conexion.execute("SELECT solicitudes, tokens FROM cubetas WHERE proveedor = ?", (proveedor,)).fetchone()
+        return {
+            "en_vuelo": en_vuelo,
+            "esperando": esperando,
+            "solicitudes_disponibles": fila[0] if fila else None,
+            "tokens_disponibles": fila[1] if fila else None,
+        }
@@ -0,0 +1,382 @@
+# Resiliencia de las llamadas LLM: reintentos con backoff exponencial + jitter (respetando Retry-After),
+# solicitudes de cobertura (hedging) hacia el proveedor alterno y contadores por job
+from collections import deque
+from contextlib import aclosing
+from contextvars import ContextVar
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple, TypeVar
+import os
+import time
+import random
+import sqlite3
+import asyncio
+import threading
+import logging
+
+import openai
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Códigos HTTP que vale la pena reintentar (el resto, como 400 o 401, fallaría igual)
+ESTADOS_REINTENTABLES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+# Eventos que se cuentan por job
+EVENTO_LLAMADA = "llamadas"
+EVENTO_ACIERTO_CACHE = "aciertos_cache"
+EVENTO_REINTENTO = "reintentos"
+EVENTO_COBERTURA = "coberturas"
+EVENTO_COBERTURA_GANADA = "coberturas_ganadas"
+EVENTO_FALLO = "fallos"
+EVENTO_PORTADA_UN_MODELO = "portadas_un_modelo"
+EVENTO_PORTADA_ESCALADA = "portadas_escaladas"
+EVENTO_TRANSACCIONES = "transacciones_recibidas"
+EVENTO_CHUNKS_FALLIDOS = "chunks_fallidos"
+EVENTO_PAGINAS_LOCALES = "paginas_extraccion_local"
+EVENTO_PAGINAS_LLM = "paginas_extraccion_llm"
+EVENTO_TOKENS_PLANEADOS = "tokens_planeados_chunks"
+EVENTO_BYTES_WORKERS = "bytes_transferidos_workers"
+
+# Job al que se le atribuyen las llamadas. Las tareas de asyncio heredan el contexto; en los
+# procesos worker se fija explícitamente (los ContextVar no cruzan procesos)
+job_actual: ContextVar[Optional[str]] = ContextVar("job_llm_actual", default=None)
+
+def es_reintentable(error: BaseException) -> bool:
+    if isinstance(error, (openai.APITimeoutError, openai.APIConnectionError, asyncio.TimeoutError)):
+        return True
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in ESTADOS_REINTENTABLES
+    return False
+
+def segundos_retry_after(error: BaseException) -> Optional[float]:
+    """Lee 'retry-after-ms' o 'retry-after' (segundos o fecha HTTP) de la respuesta del proveedor."""
+    respuesta = getattr(error, "response", None)
+    encabezados = getattr(respuesta, "headers", None)
+    if not encabezados:
+        return None
+
+    valor_ms = encabezados.get("retry-after-ms")
+    if valor_ms:
+        try:
+            return max(float(valor_ms) / 1000, 0.0)
+        except ValueError:
+            pass
+
+    valor = encabezados.get("retry-after")
+    if not valor:
+        return None
+    try:
+        return max(float(valor), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(valor).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+@dataclass(frozen=True)
+class PoliticaReintentos:
+    """
+    max_reintentos: reintentos después del primer intento.
+    Backoff 'full jitter': espera aleatoria en [0, min(max_segundos, base_segundos * 2^intento)].
+    Si el proveedor manda Retry-After se respeta (hasta max_retry_after_segundos).
+    """
+    max_reintentos: int = 3
+    base_segundos: float = 1.0
+    max_segundos: float = 30.0
+    max_retry_after_segundos: float = 60.0
+
+    def espera(self, intento: int, error: BaseException) -> float:
+        retry_after = segundos_retry_after(error)
+        if retry_after is not None:
+            return min(retry_after, self.max_retry_after_segundos) + random.uniform(0, self.base_segundos)
+        return random.uniform(0, min(self.max_segundos, self.base_segundos * 2 ** intento))
+
+async def ejecutar_con_reintentos(
+    llamada: Callable[[], Awaitable[T]],
+    politica: PoliticaReintentos,
+    al_reintentar: Optional[Callable[[int, BaseException, float], None]] = None
+) -> T:
+    """Ejecuta 'llamada' y la repite ante errores transitorios. El último error se propaga."""
+    intento = 0
+    while True:
+        try:
+            return await llamada()
+        except Exception as e:
+            if intento >= politica.max_reintentos or not es_reintentable(e):
+                raise
+            espera = politica.espera(intento, e)
+            intento += 1
+            if al_reintentar:
+                al_reintentar(intento, e, espera)
+            await asyncio.sleep(espera)
+
+async def ejecutar_con_cobertura(
+    principal: Callable[[], Awaitable[T]],
+    alterna: Callable[[], Awaitable[T]],
+    umbral_segundos: float,
+    es_valida: Callable[[Any], bool] = bool,
+    al_cubrir: Optional[Callable[[], None]] = None
+) -> Tuple[T, bool]:
+    """
+    Lanza 'principal'; si no termina con una respuesta válida antes de 'umbral_segundos' (o falla),
+    lanza 'alterna' y se queda con la primera respuesta válida. La otra se cancela.
+    Devuelve (resultado, True si ganó la alterna). Si ninguna es válida, devuelve o lanza lo de la principal.
+    """
+    tarea_principal = asyncio.ensure_future(principal())
+    tarea_alterna: Optional[asyncio.Future] = None
+    pendientes = {tarea_principal}
+
+    def valida(tarea: asyncio.Future) -> bool:
+        return not tarea.cancelled() and tarea.exception() is None and es_valida(tarea.result())
+
+    try:
+        terminadas, pendientes = await asyncio.wait(pendientes, timeout=umbral_segundos)
+        if tarea_principal in terminadas and valida(tarea_principal):
+            return tarea_principal.result(), False
+
+        if al_cubrir:
+            al_cubrir()
+        tarea_alterna = asyncio.ensure_future(alterna())
+        pendientes.add(tarea_alterna)
+
+        while pendientes:
+            terminadas, pendientes = await asyncio.wait(pendientes, return_when=asyncio.FIRST_COMPLETED)
+            for tarea in terminadas:
+                if valida(tarea):
+                    return tarea.result(), tarea is tarea_alterna
+
+        # Ninguna respuesta válida: se respeta el resultado (o error) de la principal
+        return tarea_principal.result(), False
+    finally:
+        tareas = [tarea for tarea in (tarea_principal, tarea_alterna) if tarea is not None]
+        for tarea in tareas:
+            tarea.cancel()
+        # Se espera a la perdedora para que libere su permiso del gobernador antes de seguir
+        # (y para recuperar su error, evitando "exception was never retrieved")
+        await asyncio.gather(*tareas, return_exceptions=True)
+
+async def transmitir_con_reintentos(
+    fabrica: Callable[[], AsyncIterator[T]],
+    politica: PoliticaReintentos,
+    al_reintentar: Optional[Callable[[int, BaseException, float], None]] = None
+) -> AsyncIterator[T]:
+    """
+    Versión para streams de 'ejecutar_con_reintentos': solo se reintenta si el error llega
+    ANTES del primer elemento (lo ya entregado al consumidor no se puede deshacer).
+    """
+    intento = 0
+    while True:
+        emitido = False
+        try:
+            async with aclosing(fabrica()) as flujo:
+                async for elemento in flujo:
+                    emitido = True
+                    yield elemento
+            return
+        except Exception as e:
+            if emitido or intento >= politica.max_reintentos or not es_reintentable(e):
+                raise
+            espera = politica.espera(intento, e)
+            intento += 1
+            if al_reintentar:
+                al_reintentar(intento, e, espera)
+            await asyncio.sleep(espera)
+
+async def transmitir_con_cobertura(
+    principal: Callable[[], AsyncIterator[T]],
+    alterna: Callable[[], AsyncIterator[T]],
+    umbral_segundos: float,
+    al_cubrir: Optional[Callable[[], None]] = None,
+    al_ganar_alterna: Optional[Callable[[], None]] = None
+) -> AsyncIterator[T]:
+    """
+    Versión para streams de 'ejecutar_con_cobertura': el umbral aplica al PRIMER elemento.
+    Si la principal no entrega nada antes de 'umbral_segundos' (o falla, o termina vacía),
+    se abre la alterna; el stream que entregue primero gana y el otro se cierra.
+    Si ninguno entrega nada se propaga el error de la principal (o de la alterna).
+    """
+    flujos: Dict[int, AsyncIterator[T]] = {0: principal()}
+    pendientes: Dict[asyncio.Future, int] = {asyncio.ensure_future(flujos[0].__anext__()): 0}
+    errores: Dict[int, BaseException] = {}
+    ganador: Optional[int] = None
+    primer_elemento = None
+
+    try:
+        while pendientes and ganador is None:
+            terminadas, _ = await asyncio.wait(
+                pendientes, timeout=umbral_segundos if 1 not in flujos else None, return_when=asyncio.FIRST_COMPLETED
+            )
+            for tarea in terminadas:
+                indice = pendientes.pop(tarea)
+                error = tarea.exception()
+                if error is None and ganador is None:
+                    ganador, primer_elemento = indice, tarea.result()
+                elif error is not None and not isinstance(error, StopAsyncIteration):
+                    errores[indice] = error
+
+            if ganador is None and 1 not in flujos:
+                if al_cubrir:
+                    al_cubrir()
+                flujos[1] = alterna()
+                pendientes[asyncio.ensure_future(flujos[1].__anext__())] = 1
+
+        if ganador is None:
+            error = errores.get(0) or errores.get(1)
+            if error is not None:
+                raise error
+            return
+
+        if ganador == 1 and al_ganar_alterna:
+            al_ganar_alterna()
+        # Se cierra el perdedor antes de seguir (libera su permiso del gobernador y su conexión)
+        for tarea in pendientes:
+            tarea.cancel()
+        await asyncio.gather(*pendientes, return_exceptions=True)
+        pendientes.clear()
+        for indice, flujo in flujos.items():
+            if indice != ganador:
+                await flujo.aclose()
+
+        yield primer_elemento
+        async for elemento in flujos[ganador]:
+            yield elemento
+    finally:
+        for tarea in pendientes:
+            tarea.cancel()
+        await asyncio.gather(*pendientes, return_exceptions=True)
+        for flujo in flujos.values():
+            await flujo.aclose()
+
+class RegistroLatencias:
+    """Latencias recientes por (cliente, modelo) para calcular el p95 que dispara la cobertura."""
+    def __init__(self, ventana: int = 200, min_muestras: int = 20):
+        self.min_muestras = min_muestras
+        self._ventana = ventana
+        self._muestras: Dict[Tuple[str, str], Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def registrar(self, cliente: str, modelo: str, segundos: float) -> None:
+        with self._lock:
+            self._muestras.setdefault((cliente, modelo), deque(maxlen=self._ventana)).append(segundos)
+
+    def p95(self, cliente: str, modelo: str) -> Optional[float]:
+        """None mientras no haya suficientes muestras."""
+        with self._lock:
+            muestras = sorted(self._muestras.get((cliente, modelo), ()))
+        if len(muestras) < self.min_muestras:
+            return None
+        return muestras[min(int(len(muestras) * 0.95), len(muestras) - 1)]
+
+class ContadoresJob:
+    """
+    Contadores de eventos LLM por job (reintentos, coberturas, fallos...). Viven en SQLite
+    para que los procesos worker sumen sobre el mismo job que la API.
+    'incrementar' solo suma en memoria; un hilo escritor vuelca los totales cada 'intervalo_segundos'
+    en una transacción, así ninguna llamada LLM espera al disco desde el event loop.
+    """
+    def __init__(self, ruta: str, habilitado: bool = True, intervalo_segundos: float = 1.0,
+                 retencion_segundos: float = 7 * 24 * 3600):
+        self.ruta = ruta
+        self.habilitado = habilitado
+        self.intervalo_segundos = intervalo_segundos
+        self.retencion_segundos = retencion_segundos
+        self._local = threading.local()
+        self._pendientes: Dict[Tuple[str, str], int] = {}
+        self._lock = threading.Lock()
+        self._lock_escritura = threading.Lock()
+        self._hilo: Optional[threading.Thread] = None
+        self._pid_hilo: Optional[int] = None
+        self._ultima_purga = 0.0
+
+    def _conexion(self) -> sqlite3.Connection:
+        # Una conexión SQLite no debe cruzar un fork: tras fork() el proceso hijo abre la suya
+        conexion = getattr(self._local, "conexion", None)
+        if conexion is None or self._local.pid != os.getpid():
+            directorio = os.path.dirname(self.ruta)
+            if directorio:
+                os.makedirs(directorio, exist_ok=True)
+            conexion = sqlite3.connect(self.ruta, timeout=30, isolation_level=None)
+            conexion.execute("PRAGMA journal_mode=WAL")
+            conexion.execute(
+                """CREATE TABLE IF NOT EXISTS eventos_job (
+                    job_id TEXT NOT NULL,
+                    evento TEXT NOT NULL,
+                    total INTEGER NOT NULL,
+                    actualizado REAL NOT NULL,
+                    PRIMARY KEY (job_id, evento)
+                )"""
+            )
+            conexion.execute("CREATE INDEX IF NOT EXISTS idx_eventos_job_actualizado ON eventos_job (actualizado)")
+            self._local.conexion = conexion
+            self._local.pid = os.getpid()
+        return conexion
+
+    def _asegurar_escritor(self) -> None:
+        # Tras fork() el hilo no existe en el hijo ni le pertenecen los pendientes del padre
+        if self._hilo is not None and self._pid_hilo == os.getpid() and self._hilo.is_alive():
+            return
+        with self._lock:
+            if self._pid_hilo != os.getpid():
+                self._pendientes = {}
+            if self._hilo is None or self._pid_hilo != os.getpid() or not self._hilo.is_alive():
+                self._hilo = threading.Thread(target=self._escritor, name="contadores-job", daemon=True)
+                self._pid_hilo = os.getpid()
+                self._hilo.start()
+
+    def _escritor(self) -> None:
+        while True:
+            time.sleep(self.intervalo_segundos)
+            self.vaciar()
+
+    def incrementar(self, evento: str, cantidad: int = 1, job_id: Optional[str] = None) -> None:
+        """Suma al job indicado o, si no se indica, al del contexto actual. Sin job no se cuenta nada."""
+        job_id = job_id or job_actual.get()
+        if not self.habilitado or not job_id or not cantidad:
+            return
+        self._asegurar_escritor()
+        with self._lock:
+            clave = (job_id, evento)
+            self._pendientes[clave] = self._pendientes.get(clave, 0) + cantidad
+
+    def vaciar(self) -> None:
+        """Escribe los totales pendientes (lo llama el hilo escritor; también 'obtener' y el apagado)."""
+        if not self.habilitado:
+            return
+        with self._lock_escritura:
+            with self._lock:
+                pendientes, self._pendientes = self._pendientes, {}
+            ahora = time.time()
+            purgar = ahora - self._ultima_purga > 3600
+            if not pendientes and not purgar:
+                return
+            conexion = None
+            try:
+                conexion = self._conexion()
+                conexion.execute("BEGIN")
+                conexion.executemany(
+                    """INSERT INTO eventos_job (job_id, evento, total, actualizado) VALUES (?, ?, ?, ?)
+                       ON CONFLICT (job_id, evento) DO UPDATE SET total = total + excluded.total, actualizado = excluded.actualizado""",
+                    [(job_id, evento, total, ahora) for (job_id, evento), total in pendientes.items()]
+                )
+                if purgar:
+                    # Retención: los contadores de jobs viejos ya no los consulta nadie
+                    conexion.execute("DELETE FROM eventos_job WHERE actualizado < ?", (ahora - self.retencion_segundos,))
+                    self._ultima_purga = ahora
+                conexion.execute("COMMIT")
+            except sqlite3.Error as e:
+                logger.warning(f"No se pudieron registrar {len(pendientes)} contadores de eventos LLM: {e}")
+                if conexion is not None and conexion.in_transaction:
+                    conexion.execute("ROLLBACK")
+
+    def obtener(self, job_id: str) -> Dict[str, int]:
+        """Totales del job sumando todos los procesos (antes vuelca lo pendiente de este). Es bloqueante."""
+        if not self.habilitado:
+            return {}
+        if self._pid_hilo == os.getpid():
+            self.vaciar()
+        return dict(self._conexion().execute(
+            "SELECT evento, total FROM eventos_job WHERE job_id = ? ORDER BY evento", (job_id,)
+        ).fetchall())
@@ -0,0 +1,127 @@
+# Extracción posicional de montos: agrupa los números de una página en columnas y
+# las vincula con los encabezados de cargos/abonos usando arreglos de NumPy
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+import re
+import numpy as np
+
+KEYWORDS_MAPPING = {
+    "cargo": ["cargos", "retiros", "retiro", "debitos", "débitos", "cargo", "debe", "signo"],
+    "abono": ["abonos", "depositos", "depósito", "depósitos", "creditos", "créditos", "abono"]
+}
+MONTO_REGEX = re.compile(r'^\d{1,3}(?:,\d{3})*\.\d{2}$')
+
+# Índice del tipo dentro de MontosPagina.tipos
+TIPOS_MONTO = ("cargo", "abono")
+
+_PALABRAS_CARGO = frozenset(KEYWORDS_MAPPING["cargo"])
+_PALABRAS_ABONO = frozenset(KEYWORDS_MAPPING["abono"])
+
+DISTANCIA_MAXIMA_COLUMNA = 20  # Distancia en X entre centros para seguir en la misma columna
+MIN_MONTOS_POR_COLUMNA = 3
+MARGEN_ENCABEZADO = 15
+
+@dataclass
+class MontosPagina:
+    """
+    Montos posicionados de una página en formato columnar (un arreglo por campo)
+    en lugar de un dict por monto. Es mucho más ligero de serializar hacia el
+    ProcessPoolExecutor y se evalúa como False cuando la página no tiene montos.
+    'filas' son los movimientos completos que reconstruyó el motor local
+    (ver transacciones_locales); None si la página no se pudo reconstruir.
+    """
+    montos: np.ndarray  # float64 (n,)
+    tipos: np.ndarray   # int8 (n,) -> índice en TIPOS_MONTO
+    coords: np.ndarray  # float64 (n, 4) -> x0, y0, x1, y1
+    filas: Optional[List[Any]] = None  # List[FilaMovimiento]
+
+    @classmethod
+    def vacio(cls) -> "MontosPagina":
+        return cls(
+            montos=np.empty(0, dtype=np.float64),
+            tipos=np.empty(0, dtype=np.int8),
+            coords=np.empty((0, 4), dtype=np.float64),
+        )
+
+    def __len__(self) -> int:
+        return int(self.montos.shape[0])
+
+    def __bool__(self) -> bool:
+        return len(self) > 0
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        """Compatibilidad con el formato anterior: un dict {"monto", "tipo", "coords"} por monto."""
+        for monto, tipo, coords in zip(self.montos.tolist(), self.tipos.tolist(), self.coords.tolist()):
+            yield {"monto": monto, "tipo": TIPOS_MONTO[tipo], "coords": tuple(coords)}
+
+    def a_lista(self) -> List[Dict[str, Any]]:
+        return list(self)
+
+def _hay_encabezado_en_intervalo(encabezados_x: np.ndarray, minimos: np.ndarray, maximos: np.ndarray) -> np.ndarray:
+    """
+    Para cada intervalo [minimo, maximo] indica si contiene al menos un encabezado.
+    'encabezados_x' debe venir ordenado (búsqueda binaria en lugar de comparar todos contra todos).
+    """
+    if encabezados_x.size == 0:
+        return np.zeros(minimos.shape[0], dtype=bool)
+    izquierda = np.searchsorted(encabezados_x, minimos, side="left")
+    derecha = np.searchsorted(encabezados_x, maximos, side="right")
+    return derecha > izquierda
+
+def extraer_montos_pagina(words: List[Tuple]) -> MontosPagina:
+    """
+    Ubica los encabezados de cargos/abonos de la página, agrupa los montos en columnas
+    por su posición X y asigna a cada columna el tipo del encabezado que tiene encima.
+    """
+    # --- PASO 1: DETECTAR UBICACIÓN DE ENCABEZADOS ---
+    headers_cargo = []
+    headers_abono = []
+    candidatos = []
+    for w in words:
+        texto = w[4]
+        text_clean = texto.lower().strip().replace(":", "").replace(".", "")
+        if text_clean in _PALABRAS_CARGO:
+            headers_cargo.append((w[0] + w[2]) / 2)
+        elif text_clean in _PALABRAS_ABONO:
+            headers_abono.append((w[0] + w[2]) / 2)
+        elif MONTO_REGEX.fullmatch(texto.strip()):
+            candidatos.append((w[0], w[1], w[2], w[3], float(texto.replace(',', ''))))
+
+    if not headers_cargo and not headers_abono:
+        return MontosPagina.vacio()
+
+    if len(candidatos) < MIN_MONTOS_POR_COLUMNA:
+        return MontosPagina.vacio()
+
+    # --- PASO 2: AGRUPAR NÚMEROS EN COLUMNAS ---
+    datos = np.array(candidatos, dtype=np.float64)
+    centro_x = (datos[:, 0] + datos[:, 2]) / 2
+    # Orden estable: montos con el mismo centro conservan el orden de lectura
+    datos = datos[np.argsort(centro_x, kind="stable")]
+    centro_x = (datos[:, 0] + datos[:, 2]) / 2
+
+    # Una columna nueva empieza donde el salto entre centros consecutivos es >= al umbral
+    cortes = np.flatnonzero(np.diff(centro_x) >= DISTANCIA_MAXIMA_COLUMNA) + 1
+    inicios = np.concatenate(([0], cortes))
+    tamanos = np.diff(np.concatenate((inicios, [datos.shape[0]])))
+
+    # --- PASO 3: VINCULAR COLUMNAS ---
+    col_min_x = np.minimum.reduceat(datos[:, 0], inicios) - MARGEN_ENCABEZADO
+    col_max_x = np.maximum.reduceat(datos[:, 2], inicios) + MARGEN_ENCABEZADO
+
+    con_cargo = _hay_encabezado_en_intervalo(np.sort(np.array(headers_cargo)), col_min_x, col_max_x)
+    con_abono = _hay_encabezado_en_intervalo(np.sort(np.array(headers_abono)), col_min_x, col_max_x)
+
+    # El encabezado de cargo tiene prioridad sobre el de abono; -1 = indefinido
+    tipo_columna = np.where(con_cargo, 0, np.where(con_abono, 1, -1)).astype(np.int8)
+    columna_valida = (tamanos >= MIN_MONTOS_POR_COLUMNA) & (tipo_columna >= 0)
+
+    if not columna_valida.any():
+        return MontosPagina.vacio()
+
+    seleccion = np.repeat(columna_valida, tamanos)
+    return MontosPagina(
+        montos=np.ascontiguousarray(datos[seleccion, 4]),
+        tipos=np.repeat(tipo_columna, tamanos)[seleccion],
+        coords=np.ascontiguousarray(datos[seleccion, :4]),
+    )
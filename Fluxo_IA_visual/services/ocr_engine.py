@@ -0,0 +1,161 @@
+# Motor de OCR paralelo por páginas para documentos escaneados
+from ..core.exceptions import OCRTiempoExcedidoError
+
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FuturesTimeoutError, Future
+from typing import Dict, Iterator, List, Optional, Tuple
+from PIL import Image
+import os
+import time
+import tempfile
+import threading
+import logging
+import fitz
+import pytesseract
+
+# tesserocr es opcional: si está instalado, cada worker mantiene UNA instancia de Tesseract
+# viva (API en C) en lugar de lanzar un subproceso por página como hace pytesseract.
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+logger = logging.getLogger(__name__)
+
+MAX_WORKERS_OCR = min(4, os.cpu_count() or 1)
+
+# ----- Estado por proceso worker -----
+_api_tesseract = None
+_documento_worker: Dict[str, fitz.Document] = {}
+
+def _inicializar_worker_ocr(idioma: str) -> None:
+    """Initializer del pool: crea la instancia persistente de Tesseract del worker."""
+    global _api_tesseract
+    if tesserocr is not None:
+        try:
+            _api_tesseract = tesserocr.PyTessBaseAPI(lang=idioma)
+        except Exception as e:
+            logger.warning(f"No se pudo iniciar tesserocr ({e}). Se usará pytesseract.")
+            _api_tesseract = None
+
+def _abrir_documento_worker(ruta_pdf: str) -> fitz.Document:
+    """Mantiene abierto en el worker solo el último documento usado."""
+    documento = _documento_worker.get(ruta_pdf)
+    if documento is None:
+        for anterior in _documento_worker.values():
+            anterior.close()
+        _documento_worker.clear()
+        documento = fitz.open(ruta_pdf)
+        _documento_worker[ruta_pdf] = documento
+    return documento
+
+def _ocr_pagina(ruta_pdf: str, indice_pagina: int, dpi: int, idioma: str) -> Tuple[int, str]:
+    """Rasteriza y reconoce UNA página dentro del proceso worker."""
+    documento = _abrir_documento_worker(ruta_pdf)
+    pix = documento.load_page(indice_pagina).get_pixmap(dpi=dpi)
+    # Pasamos los pixeles directo a PIL (sin codificar/decodificar PNG)
+    modo = "L" if pix.n == 1 else "RGB"
+    imagen_pil = Image.frombytes(modo, (pix.width, pix.height), pix.samples)
+
+    if _api_tesseract is not None:
+        _api_tesseract.SetImage(imagen_pil)
+        texto_pagina = _api_tesseract.GetUTF8Text()
+    else:
+        texto_pagina = pytesseract.image_to_string(imagen_pil, lang=idioma)
+
+    return indice_pagina, texto_pagina.lower()
+
+class MotorOCR:
+    """
+    Reparte las páginas de un documento en un pool acotado de procesos y devuelve
+    el texto de cada página EN ORDEN conforme va estando listo.
+    El PDF se escribe una sola vez a un archivo temporal para no serializarlo por página.
+    """
+    def __init__(self, max_workers: int = MAX_WORKERS_OCR, idioma: str = "eng"):
+        self.max_workers = max_workers
+        self.idioma = idioma
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def _obtener_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    initializer=_inicializar_worker_ocr,
+                    initargs=(self.idioma,)
+                )
+            return self._executor
+
+    def iterar_paginas(
+        self,
+        pdf_bytes: bytes,
+        dpi: int = 300,
+        tiempo_limite: Optional[float] = None
+    ) -> Iterator[Tuple[int, str]]:
+        """
+        Genera tuplas (num_pagina, texto) en orden de página.
+        - Lanza OCRTiempoExcedidoError si el documento supera 'tiempo_limite' segundos;
+          sus páginas en cola se cancelan sin tocar las de otros documentos que comparten el pool.
+        """
+        limite = time.monotonic() + tiempo_limite if tiempo_limite else None
+
+        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
+            total_paginas = len(doc)
+
+        descriptor, ruta_pdf = tempfile.mkstemp(suffix=".pdf")
+        futuros: List[Future] = []
+        try:
+            with os.fdopen(descriptor, "wb") as archivo:
+                archivo.write(pdf_bytes)
+
+            executor = self._obtener_executor()
+            futuros = [
+                executor.submit(_ocr_pagina, ruta_pdf, indice, dpi, self.idioma)
+                for indice in range(total_paginas)
+            ]
+
+            for futuro in futuros:
+                restante = None if limite is None else max(0.0, limite - time.monotonic())
+                try:
+                    indice, texto = futuro.result(timeout=restante)
+                except FuturesTimeoutError:
+                    self._cancelar_pendientes(futuros)
+                    raise OCRTiempoExcedidoError(
+                        f"El OCR superó el límite de {tiempo_limite} segundos."
+                    )
+                yield indice + 1, texto
+        finally:
+            # Cancelamos lo que no alcanzó a empezar (timeout, error o consumidor que se detuvo)
+            for futuro in futuros:
+                futuro.cancel()
+            try:
+                os.remove(ruta_pdf)
+            except OSError:
+                pass
+
+    def _cancelar_pendientes(self, futuros: List[Future]) -> None:
+        """
+        Tras un timeout: cancela las páginas de ESTA llamada que no empezaron. El pool es del proceso
+        y lo comparten otros documentos, así que no se termina: lo que ya corre en un worker acaba
+        solo (a lo más una página por worker) y su resultado se descarta.
+        """
+        corriendo = [futuro for futuro in futuros if not futuro.cancel() and not futuro.done()]
+        if corriendo:
+            logger.warning(f"OCR detenido por timeout: {len(corriendo)} páginas en curso terminan sin usarse.")
+
+    def cerrar(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+_motor_por_defecto: Optional[MotorOCR] = None
+_lock_motor = threading.Lock()
+
+def obtener_motor_ocr() -> MotorOCR:
+    """Devuelve el motor OCR compartido del proceso (se crea la primera vez que se usa)."""
+    global _motor_por_defecto
+    with _lock_motor:
+        if _motor_por_defecto is None:
+            _motor_por_defecto = MotorOCR()
+        return _motor_por_defecto
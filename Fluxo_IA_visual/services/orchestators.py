@@ -1,13 +1,16 @@
 from ..utils.helpers import (
     es_escaneado_o_no, extraer_datos_por_banco, extraer_json_del_markdown, limpiar_monto, sanitizar_datos_ia, 
-    reconciliar_resultados_ia, detectar_tipo_contribuyente, crear_chunks_con_superposicion, crear_objeto_resultado
-    
+    reconciliar_resultados_ia, detectar_tipo_contribuyente, crear_objeto_resultado,
+    crear_prompt_campos_faltantes, campos_vacios, hay_desacuerdo_con_regex, ConsolidadorTransacciones
 )
+from ..core.exceptions import PDFCifradoError, PoolWorkersCerradoError, UnidadTrabajoError
 from .ia_extractor import (
-    analizar_gpt_fluxo, analizar_gemini_fluxo, analizar_gpt_nomi, _extraer_datos_con_ia, llamar_agente_tpv, llamar_agente_ocr_vision
+    analizar_gpt_fluxo, analizar_gemini_fluxo, analizar_gpt_nomi, _extraer_datos_con_ia, transmitir_agente_tpv, transmitir_agente_ocr_vision,
+    PERFIL_NOMI, PERFIL_FLUXO, PERFIL_OCR_VISION, cache_imagenes, contadores_job
 )
 from ..utils.helpers_texto_fluxo import (
-    PALABRAS_BMRCASH, PALABRAS_EXCLUIDAS, PALABRAS_EFECTIVO, PALABRAS_TRASPASO_ENTRE_CUENTAS, PALABRAS_TRASPASO_FINANCIAMIENTO, prompt_base_fluxo
+    prompt_base_fluxo,
+    CAMPOS_PORTADA, CAMPOS_CLAVE_REGEX, CAMPOS_VERIFICACION_PORTADA, CAMPOS_OPCIONALES_PORTADA
 )
 from ..utils.helpers_texto_nomi import (
     PROMPT_COMPROBANTE, PROMPT_ESTADO_CUENTA, PROMPT_NOMINA, SEGUNDO_PROMPT_NOMINA
@@ -17,17 +20,31 @@ from ..utils.helpers_texto_csf import (
 )
 
 from .pdf_processor import (
-    extraer_movimientos_con_posiciones, extraer_texto_de_pdf, convertir_pdf_a_imagenes, leer_qr_de_imagenes
+    iterar_movimientos_con_posiciones, extraer_texto_de_pdf, convertir_pdf_a_imagenes, leer_qr_de_pdf,
+    PaginaProcesada
+)
+from .document_cache import SesionDocumento
+from .image_cache import (
+    ImagenRenderizada, codificar_paginas_pdf, guardar_paginas_codificadas, paginas_sin_cache, renderizar_paginas_con_cache
 )
+from .perfiles_imagen import PerfilImagen
+from .cola_trabajo import cola_trabajo, ejecutar_cpu, TIPO_AGENTE_TPV
+from .job_store import registro_jobs, ETAPA_CHUNKS, ETAPA_CHUNKS_OCR, EVENTO_CHUNK_TERMINADO
+from .transacciones_locales import extraer_transacciones_locales
+from .planificador_chunks import planificar_chunks
+from .llm_resiliencia import (
+    EVENTO_PORTADA_UN_MODELO, EVENTO_PORTADA_ESCALADA, EVENTO_TRANSACCIONES, EVENTO_PAGINAS_LOCALES, EVENTO_PAGINAS_LLM,
+    EVENTO_TOKENS_PLANEADOS, EVENTO_CHUNKS_FALLIDOS
+)
+from ..core.config import settings
 
 from ..utils.helpers import extraer_rfc_curp_por_texto
 from ..models.responses import NomiFlash, CSF, AnalisisTPV
 
-from typing import Dict, Any, Tuple, Optional, Union, List
+from typing import Dict, Any, Tuple, Optional, Union, List, Callable, Iterator, AsyncIterator
 from fastapi import UploadFile
-from io import BytesIO
+from contextlib import aclosing
 import logging
-import fitz
 import asyncio
 
 logger = logging.getLogger(__name__)
@@ -62,106 +79,373 @@ async def analizar_metadatos_rango(
     
     return datos_reconciliados
 
-# ESTA FUNCIÓN ES PARA OBTENER Y PROCESAR LAS PORTADAS DE LOS PDF
-async def obtener_y_procesar_portada(prompt:str, pdf_bytes: bytes) -> Tuple[Dict[str, Any], bool, str, Dict[int, Any]]:
+async def _iterar_en_hilo(funcion_generadora: Callable[..., Iterator], *args) -> AsyncIterator:
     """
-    Orquesta el proceso detectando múltiples cuentas dentro del mismo PDF.
-    Devuelve una lista de resultados (uno por cada cuenta detectada).
+    Consume un generador síncrono (CPU / fitz) en un hilo del executor y entrega
+    sus elementos al event loop conforme se producen.
     """
     loop = asyncio.get_running_loop()
+    cola: asyncio.Queue = asyncio.Queue()
+    fin_del_generador = object()
 
-    # --- 1. PRIMERO: Extraer Texto Y Movimientos (Detectar cortes) ---
-    # Esta función ya nos devuelve los puntos donde cambia de cuenta
-    movimientos_por_pagina, texto_por_pagina, rangos_cuentas = await loop.run_in_executor(
-        None,
-        extraer_movimientos_con_posiciones,
-        pdf_bytes
-    )
+    def productor():
+        try:
+            for elemento in funcion_generadora(*args):
+                loop.call_soon_threadsafe(cola.put_nowait, elemento)
+        except BaseException as e:
+            loop.call_soon_threadsafe(cola.put_nowait, e)
+        finally:
+            loop.call_soon_threadsafe(cola.put_nowait, fin_del_generador)
+
+    hilo = loop.run_in_executor(None, productor)
+    while True:
+        elemento = await cola.get()
+        if elemento is fin_del_generador:
+            break
+        if isinstance(elemento, BaseException):
+            await hilo
+            raise elemento
+        yield elemento
+    await hilo
+
+async def _rasterizar_en_pool(
+    sesion: SesionDocumento,
+    paginas: List[int],
+    perfil: PerfilImagen
+) -> Dict[int, ImagenRenderizada]:
+    """
+    Rasteriza en el pool de procesos (o en los workers de la cola) las páginas que aún no están en la
+    cache de imágenes, para que las llamadas de visión solo lean de ahí y el event loop no se bloquee
+    renderizando. Devuelve las páginas que rasterizó; si no se pudo, las llamadas renderizan como antes.
+    """
+    faltantes = paginas_sin_cache(cache_imagenes, sesion.hash_documento, paginas, perfil)
+    if not faltantes:
+        return {}
+    try:
+        imagenes = await ejecutar_cpu(codificar_paginas_pdf, sesion.pdf_bytes, faltantes, perfil)
+    except (PoolWorkersCerradoError, UnidadTrabajoError) as e:
+        logger.warning(f"No se pudo rasterizar en el pool ({e}); se renderiza en el proceso principal.")
+        return {}
+    return guardar_paginas_codificadas(cache_imagenes, sesion.hash_documento, perfil, imagenes)
 
-    # Construimos el texto completo
-    texto_verificacion_global = "\n".join(texto_por_pagina.values())
-    es_documento_digital = es_escaneado_o_no(texto_verificacion_global)
-
-    logger.info(f"Se detectaron {len(rangos_cuentas)} cuentas en los rangos: {rangos_cuentas}")
-
-    resultados_acumulados = []
-
-    # --- BUCLE PRINCIPAL: PROCESAR CADA CUENTA (RANGO) ---
-    for inicio_rango, fin_rango in rangos_cuentas:
-        logger.info(f"Procesando cuenta en rango: {inicio_rango} a {fin_rango}")
-
-        # A. Construir texto específico de este rango para regex
-        # (Esto aísla el contexto: el regex solo verá texto de ESTA cuenta)
-        texto_rango = []
-        for p in range(inicio_rango, fin_rango + 1):
-            texto_rango.append(texto_por_pagina.get(p, ""))
-        texto_verificacion_rango = "\n".join(texto_rango)
-
-        # B. Reconocer banco y datos por Regex para ESTE rango
-        datos_regex = extraer_datos_por_banco(texto_verificacion_rango.lower())
-        banco_estandarizado = datos_regex.get("banco")
-        rfc_estandarizado = datos_regex.get("rfc")
-        comisiones_est = datos_regex.get("comisiones")
-        depositos_est = datos_regex.get("depositos")
-
-        # C. Decidir qué páginas enviar a la IA (Relativo al rango actual)
-        # Lógica: Mandamos la primera del rango y la segunda (si existe)
-        paginas_para_ia = [inicio_rango]
-        if (inicio_rango + 1) <= fin_rango:
-            paginas_para_ia.append(inicio_rango + 1)
-
-        # Lógica especial para BANREGIO (u otros que requieran final del documento)
-        if banco_estandarizado == "BANREGIO":
-            longitud_rango = (fin_rango - inicio_rango) + 1
-            if longitud_rango > 5:
-                # Primeras del rango + Últimas 5 DEL RANGO
-                paginas_finales = list(range(fin_rango - 4, fin_rango + 1))
-                paginas_para_ia = sorted(list(set(paginas_para_ia + paginas_finales)))
-            else:
-                # Todas las páginas del rango si es corto
-                paginas_para_ia = list(range(inicio_rango, fin_rango + 1))
+async def _imagenes_de_ventana(sesion: SesionDocumento, paginas: List[int], perfil: PerfilImagen) -> List[ImagenRenderizada]:
+    """
+    Imágenes de una ventana de OCR, rasterizadas justo antes de su llamada y entregadas directo al
+    agente: no dependen de que la cache (compartida y acotada) las conserve hasta entonces.
+    """
+    imagenes = await _rasterizar_en_pool(sesion, paginas, perfil)
+    faltantes = [p for p in paginas if p not in imagenes]
+    if faltantes:
+        # Ya en cache (ventana superpuesta) o sin pool: se leen o renderizan en un hilo, nunca en el event loop
+        renderizadas = await asyncio.to_thread(
+            renderizar_paginas_con_cache, cache_imagenes, sesion.pdf_bytes, faltantes, perfil
+        )
+        imagenes.update(zip(faltantes, renderizadas))
+    return [imagenes[p] for p in paginas if p in imagenes]
+
+async def _transmitir_agente_ocr(banco: str, sesion: SesionDocumento, paginas: List[int]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Stream del agente OCR-Visión para una ventana; rasteriza sus páginas al arrancar."""
+    imagenes = await _imagenes_de_ventana(sesion, paginas, PERFIL_OCR_VISION)
+    async with aclosing(transmitir_agente_ocr_vision(banco, sesion, paginas, imagenes)) as lotes:
+        async for lote in lotes:
+            yield lote
+
+def _json_de_respuesta(respuesta: Any) -> Dict[str, Any]:
+    """JSON de la respuesta de un modelo, o {} si la llamada falló o vino vacía."""
+    if respuesta and not isinstance(respuesta, Exception):
+        return extraer_json_del_markdown(respuesta)
+    return {}
+
+async def _analizar_portada_dual(prompt: str, sesion: SesionDocumento, paginas_para_ia: List[int]) -> Dict[str, Any]:
+    """Ruta completa: GPT y Qwen con el prompt entero y reconciliación de ambas respuestas."""
+    tarea_gpt = analizar_gpt_fluxo(prompt, sesion, paginas_a_procesar=paginas_para_ia)
+    tarea_gemini = analizar_gemini_fluxo(prompt, sesion, paginas_a_procesar=paginas_para_ia)
+
+    res_gpt_str, res_gemini_str = await asyncio.gather(tarea_gpt, tarea_gemini, return_exceptions=True)
+
+    datos_gpt_sanitizados = sanitizar_datos_ia(_json_de_respuesta(res_gpt_str))
+    datos_gemini_sanitizados = sanitizar_datos_ia(_json_de_respuesta(res_gemini_str))
+    return reconciliar_resultados_ia(datos_gpt_sanitizados, datos_gemini_sanitizados)
+
+async def _analizar_portada_adaptativa(
+    prompt: str,
+    sesion: SesionDocumento,
+    paginas_para_ia: List[int],
+    datos_regex: Dict[str, Any]
+) -> Tuple[Dict[str, Any], str]:
+    """
+    El regex ya resolvió los campos clave: se le pide a GPT solo lo que falta (más los campos
+    de verificación). Solo si quedan campos obligatorios vacíos o la verificación no coincide
+    con el regex se consulta a Qwen con el prompt completo y se reconcilian ambas respuestas.
+    Devuelve (datos, modo) con modo 'un_modelo' o 'escalado'.
+    """
+    campos_pedidos = [c for c in CAMPOS_PORTADA if c not in CAMPOS_CLAVE_REGEX] + CAMPOS_VERIFICACION_PORTADA
+    prompt_reducido = crear_prompt_campos_faltantes(prompt, campos_pedidos)
 
-        # D. Llamar a las IA (Enviando las páginas calculadas)
-        tarea_gpt = analizar_gpt_fluxo(prompt, pdf_bytes, paginas_a_procesar=paginas_para_ia)
-        tarea_gemini = analizar_gemini_fluxo(prompt, pdf_bytes, paginas_a_procesar=paginas_para_ia)
+    try:
+        datos_gpt = _json_de_respuesta(await analizar_gpt_fluxo(prompt_reducido, sesion, paginas_a_procesar=paginas_para_ia))
+    except Exception as e:
+        logger.warning(f"Portada con un modelo falló ({e}); se escala a los dos modelos.")
+        datos_gpt = {}
 
-        resultados_ia_brutos = await asyncio.gather(tarea_gpt, tarea_gemini, return_exceptions=True)
-        res_gpt_str, res_gemini_str = resultados_ia_brutos
+    vacios = campos_vacios(datos_gpt, [c for c in campos_pedidos if c not in CAMPOS_OPCIONALES_PORTADA])
+    desacuerdo = hay_desacuerdo_con_regex(datos_gpt, datos_regex, CAMPOS_VERIFICACION_PORTADA)
+    if not vacios and not desacuerdo:
+        contadores_job.incrementar(EVENTO_PORTADA_UN_MODELO)
+        return sanitizar_datos_ia(datos_gpt), "un_modelo"
 
-        # Extracción segura de JSON (Validamos que no sea Exception Y que tenga contenido)
-        datos_gpt = {}
-        if res_gpt_str and not isinstance(res_gpt_str, Exception):
-            datos_gpt = extraer_json_del_markdown(res_gpt_str)
-        
+    logger.info(f"Portada escalada a dos modelos (vacíos: {vacios}, desacuerdo con regex: {desacuerdo}).")
+    contadores_job.incrementar(EVENTO_PORTADA_ESCALADA)
+    try:
+        datos_gemini = _json_de_respuesta(await analizar_gemini_fluxo(prompt, sesion, paginas_a_procesar=paginas_para_ia))
+    except Exception as e:
+        logger.error(f"Falló la escalación de portada a Qwen: {e}")
         datos_gemini = {}
-        if res_gemini_str and not isinstance(res_gemini_str, Exception):
-            datos_gemini = extraer_json_del_markdown(res_gemini_str)
+    return reconciliar_resultados_ia(sanitizar_datos_ia(datos_gpt), sanitizar_datos_ia(datos_gemini)), "escalado"
+
+async def _analizar_rango_portada(
+    prompt: str,
+    sesion: SesionDocumento,
+    inicio_rango: int,
+    fin_rango: int,
+    texto_por_pagina: Dict[int, str]
+) -> Dict[str, Any]:
+    """
+    Regex + análisis de visión (GPT y Qwen) para UNA cuenta (rango de páginas).
+    Solo lee las páginas de su rango, que ya están completas cuando el rango se cierra.
+    Si el regex ya resolvió los campos clave y el modo adaptativo está activo, se usa un solo modelo.
+    """
+    logger.info(f"Procesando cuenta en rango: {inicio_rango} a {fin_rango}")
+
+    # A. Construir texto específico de este rango para regex
+    # (Esto aísla el contexto: el regex solo verá texto de ESTA cuenta)
+    texto_rango = []
+    for p in range(inicio_rango, fin_rango + 1):
+        texto_rango.append(texto_por_pagina.get(p, ""))
+    texto_verificacion_rango = "\n".join(texto_rango)
+
+    # B. Reconocer banco y datos por Regex para ESTE rango
+    datos_regex = extraer_datos_por_banco(texto_verificacion_rango.lower())
+    banco_estandarizado = datos_regex.get("banco")
+    rfc_estandarizado = datos_regex.get("rfc")
+    comisiones_est = datos_regex.get("comisiones")
+    depositos_est = datos_regex.get("depositos")
+
+    # C. Decidir qué páginas enviar a la IA (Relativo al rango actual)
+    # Lógica: Mandamos la primera del rango y la segunda (si existe)
+    paginas_para_ia = [inicio_rango]
+    if (inicio_rango + 1) <= fin_rango:
+        paginas_para_ia.append(inicio_rango + 1)
+
+    # Lógica especial para BANREGIO (u otros que requieran final del documento)
+    if banco_estandarizado == "BANREGIO":
+        longitud_rango = (fin_rango - inicio_rango) + 1
+        if longitud_rango > 5:
+            # Primeras del rango + Últimas 5 DEL RANGO
+            paginas_finales = list(range(fin_rango - 4, fin_rango + 1))
+            paginas_para_ia = sorted(list(set(paginas_para_ia + paginas_finales)))
+        else:
+            # Todas las páginas del rango si es corto
+            paginas_para_ia = list(range(inicio_rango, fin_rango + 1))
+
+    # D y E. Llamar a las IA (Enviando las páginas calculadas), sanitizar y reconciliar.
+    # Los rangos ya corren concurrentes (cada uno es una tarea que se lanza al cerrarse y el gobernador
+    # acota las llamadas en vuelo); sus páginas se rasterizan en paralelo en el pool de procesos.
+    await _rasterizar_en_pool(sesion, paginas_para_ia, PERFIL_FLUXO)
+    regex_completo = all(datos_regex.get(campo) for campo in CAMPOS_CLAVE_REGEX)
+    if settings.PORTADA_MODO_ADAPTATIVO and regex_completo:
+        datos_ia_reconciliados, modo_portada = await _analizar_portada_adaptativa(prompt, sesion, paginas_para_ia, datos_regex)
+    else:
+        datos_ia_reconciliados, modo_portada = await _analizar_portada_dual(prompt, sesion, paginas_para_ia), "dual"
+
+    # F. Merge con datos Regex (Prioridad al texto detectado)
+    if banco_estandarizado: datos_ia_reconciliados["banco"] = banco_estandarizado
+    if rfc_estandarizado: datos_ia_reconciliados["rfc"] = rfc_estandarizado
+    if comisiones_est: datos_ia_reconciliados["comisiones"] = comisiones_est
+    if depositos_est: datos_ia_reconciliados["depositos"] = depositos_est
+
+    # Agregamos metadatos útiles para saber de qué páginas vino en el frontend/DB
+    datos_ia_reconciliados["_metadatos_paginas"] = {
+        "inicio": inicio_rango,
+        "fin": fin_rango,
+        "paginas_analizadas_ia": paginas_para_ia,
+        "modo_portada": modo_portada
+    }
+    return datos_ia_reconciliados
+
+# (índice de la cuenta, datos de portada, rango, texto del rango, movimientos del rango)
+AvisoCuentaDigital = Callable[[int, Dict[str, Any], Tuple[int, int], Dict[int, str], Dict[int, Any]], None]
+
+async def _analizar_rango_y_avisar(
+    indice_cuenta: int,
+    prompt: str,
+    sesion: SesionDocumento,
+    inicio_rango: int,
+    fin_rango: int,
+    texto_por_pagina: Dict[int, str],
+    movimientos_por_pagina: Dict[int, Any],
+    documento_digital: asyncio.Future,
+    al_cerrar_cuenta_digital: AvisoCuentaDigital
+) -> Dict[str, Any]:
+    """Portada de un rango y, si el documento resulta digital, aviso inmediato para que su extracción arranque ya."""
+    datos_cuenta = await _analizar_rango_portada(prompt, sesion, inicio_rango, fin_rango, texto_por_pagina)
+    if await documento_digital:
+        rango = (inicio_rango, fin_rango)
+        al_cerrar_cuenta_digital(
+            indice_cuenta, datos_cuenta, rango,
+            recortar_rango(texto_por_pagina, rango), recortar_rango(movimientos_por_pagina, rango)
+        )
+    return datos_cuenta
 
-        # E. Sanitización y Reconciliación
-        datos_gpt_sanitizados = sanitizar_datos_ia(datos_gpt)
-        datos_gemini_sanitizados = sanitizar_datos_ia(datos_gemini)
-        
-        datos_ia_reconciliados = reconciliar_resultados_ia(datos_gpt_sanitizados, datos_gemini_sanitizados)
-
-        # F. Merge con datos Regex (Prioridad al texto detectado)
-        if banco_estandarizado: datos_ia_reconciliados["banco"] = banco_estandarizado
-        if rfc_estandarizado: datos_ia_reconciliados["rfc"] = rfc_estandarizado
-        if comisiones_est: datos_ia_reconciliados["comisiones"] = comisiones_est
-        if depositos_est: datos_ia_reconciliados["depositos"] = depositos_est
-
-        # Agregamos metadatos útiles para saber de qué páginas vino en el frontend/DB
-        datos_ia_reconciliados["_metadatos_paginas"] = {
-            "inicio": inicio_rango,
-            "fin": fin_rango,
-            "paginas_analizadas_ia": paginas_para_ia
-        }
-        
-        resultados_acumulados.append(datos_ia_reconciliados)
+# ESTA FUNCIÓN ES PARA OBTENER Y PROCESAR LAS PORTADAS DE LOS PDF
+async def obtener_y_procesar_portada(
+    prompt:str,
+    pdf_bytes: bytes,
+    al_cerrar_cuenta_digital: Optional[AvisoCuentaDigital] = None
+) -> Tuple[Dict[str, Any], bool, str, Dict[int, Any]]:
+    """
+    Orquesta el proceso detectando múltiples cuentas dentro del mismo PDF.
+    Devuelve una lista de resultados (uno por cada cuenta detectada).
+
+    Las páginas se consumen en streaming: en cuanto una cuenta se cierra se lanzan su
+    regex y sus llamadas de visión, mientras se siguen parseando las páginas de la siguiente.
+    Si se recibe 'al_cerrar_cuenta_digital', se llama (síncrono, sin bloquear) con cada cuenta
+    de un documento digital en cuanto su portada está lista, sin esperar a las demás cuentas.
+    """
+    movimientos_por_pagina: Dict[int, Any] = {}
+    texto_por_pagina: Dict[int, str] = {}
+    rangos_cuentas: List[Tuple[int, int]] = []
+    tareas_rangos: List[asyncio.Task] = []
+    # Se resuelve al terminar el parseo (digital o escaneado se decide con el texto de todo el documento)
+    documento_digital: asyncio.Future = asyncio.get_running_loop().create_future()
+
+    # Una sola apertura del PDF para el parseo en streaming y las imágenes de todas las cuentas.
+    # Un PDF inválido o con contraseña falla aquí y la Etapa 1 lo reporta por archivo.
+    with SesionDocumento(pdf_bytes) as sesion:
+        if sesion.esta_cifrado:
+            raise PDFCifradoError("El documento está protegido por contraseña.")
+
+        try:
+            # --- 1. Extraer Texto Y Movimientos (Detectar cortes) conforme avanza el documento ---
+            async for evento in _iterar_en_hilo(iterar_movimientos_con_posiciones, sesion):
+                if isinstance(evento, PaginaProcesada):
+                    texto_por_pagina[evento.num_pagina] = evento.texto
+                    movimientos_por_pagina[evento.num_pagina] = evento.montos
+                else:
+                    # --- 2. PROCESAR CADA CUENTA (RANGO) EN CUANTO SE CIERRA ---
+                    rangos_cuentas.append((evento.inicio, evento.fin))
+                    if al_cerrar_cuenta_digital is None:
+                        analisis = _analizar_rango_portada(prompt, sesion, evento.inicio, evento.fin, texto_por_pagina)
+                    else:
+                        analisis = _analizar_rango_y_avisar(
+                            len(rangos_cuentas) - 1, prompt, sesion, evento.inicio, evento.fin,
+                            texto_por_pagina, movimientos_por_pagina, documento_digital, al_cerrar_cuenta_digital
+                        )
+                    tareas_rangos.append(asyncio.create_task(analisis))
+
+            # Construimos el texto completo
+            texto_verificacion_global = "\n".join(texto_por_pagina.values())
+            es_documento_digital = es_escaneado_o_no(texto_verificacion_global)
+            documento_digital.set_result(es_documento_digital)
+
+            logger.info(f"Se detectaron {len(rangos_cuentas)} cuentas en los rangos: {rangos_cuentas}")
+
+            # gather respeta el orden de los rangos, así lista_cuentas_ia y rangos_cuentas quedan alineados 1 a 1
+            resultados_acumulados = await asyncio.gather(*tareas_rangos)
+        except BaseException:
+            documento_digital.cancel()
+            for tarea in tareas_rangos:
+                tarea.cancel()
+            raise
 
     # Retornamos la lista de resultados y los datos globales
     # OJO: Ahora el primer elemento es una LISTA, no un Dict único.
-    return resultados_acumulados, es_documento_digital, texto_verificacion_global, movimientos_por_pagina, texto_por_pagina, rangos_cuentas
+    return list(resultados_acumulados), es_documento_digital, texto_verificacion_global, movimientos_por_pagina, texto_por_pagina, rangos_cuentas
     
+async def _transmitir_agente_tpv(banco: str, texto_chunk: str, paginas: List[int]) -> AsyncIterator[List[Dict[str, Any]]]:
+    """Stream del agente TPV para un chunk; con la cola habilitada el chunk lo procesa cualquier worker."""
+    if not cola_trabajo.habilitada:
+        async with aclosing(transmitir_agente_tpv(banco, texto_chunk, paginas)) as lotes:
+            async for lote in lotes:
+                yield lote
+        return
+    for lote in await cola_trabajo.ejecutar(TIPO_AGENTE_TPV, banco, texto_chunk, paginas):
+        yield lote
+
+async def _consumir_agentes(
+    flujos: List[AsyncIterator[List[Dict[str, Any]]]],
+    consolidador: ConsolidadorTransacciones,
+    paginas_por_flujo: List[List[int]],
+    etapa: str = ETAPA_CHUNKS
+) -> List[str]:
+    """
+    Consume en paralelo los streams de los agentes por chunk: cada lote se deduplica y
+    clasifica en cuanto llega (posición = índice de chunk, índice de línea). Las transacciones
+    nuevas se cuentan en memoria y se suman al contador del job una vez por chunk. Cada chunk
+    que termina avanza 'etapa' y emite un evento con sus páginas.
+    Devuelve un error por cada chunk que falló (lo que alcanzó a llegar se conserva).
+    """
+    async def consumir(indice_chunk: int, flujo: AsyncIterator[List[Dict[str, Any]]]) -> None:
+        linea = 0
+        nuevas = 0
+        error = None
+        try:
+            async with aclosing(flujo) as lotes:
+                async for lote in lotes:
+                    for trx in lote:
+                        nuevas += consolidador.agregar((indice_chunk, linea), trx)
+                        linea += 1
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            contadores_job.incrementar(EVENTO_TRANSACCIONES, nuevas)
+            registro_jobs.avanzar(etapa)
+            registro_jobs.evento(EVENTO_CHUNK_TERMINADO, {
+                "etapa": etapa, "paginas": paginas_por_flujo[indice_chunk], "transacciones": linea, "error": error
+            })
+
+    registro_jobs.avanzar(etapa, completados=0, total=len(flujos))
+
+    resultados = await asyncio.gather(*(consumir(i, flujo) for i, flujo in enumerate(flujos)), return_exceptions=True)
+    errores = []
+    for paginas, resultado in zip(paginas_por_flujo, resultados):
+        if isinstance(resultado, Exception):
+            logger.error(f"Error consumiendo el stream de un agente (págs {paginas[0]}-{paginas[-1]}): {resultado}")
+            errores.append(f"págs {paginas[0]}-{paginas[-1]}: {type(resultado).__name__}: {resultado}")
+    if errores:
+        contadores_job.incrementar(EVENTO_CHUNKS_FALLIDOS, len(errores))
+    return errores
+
+def _error_chunks(errores: List[str], total_chunks: int) -> Optional[str]:
+    """Resumen para 'error_transacciones' cuando algún chunk falló: sus transacciones faltan en la cuenta."""
+    if not errores:
+        return None
+    return f"{len(errores)} de {total_chunks} fragmentos fallaron y sus transacciones faltan ({'; '.join(errores)})."
+
+def _ensamblar_cuenta(
+    ia_data: dict, nombre_archivo: str, consolidador: ConsolidadorTransacciones, error_transacciones: Optional[str] = None
+) -> Dict[str, Any]:
+    """Arma el dict final de la cuenta con las transacciones clasificadas y sus totales."""
+    totales = consolidador.totales()
+    comisiones_str = ia_data.get("comisiones", "0.0")
+    if comisiones_str is None: comisiones_str = "0.0"
+    comisiones = limpiar_monto(str(comisiones_str))
+
+    return {
+        **ia_data,
+        "nombre_archivo_virtual": nombre_archivo,
+        "transacciones": consolidador.transacciones(),
+        **totales,
+        "entradas_TPV_neto": totales["entradas_TPV_bruto"] - comisiones,
+        "error_transacciones": error_transacciones
+    }
+
+def recortar_rango(por_pagina: Dict[int, Any], rango_paginas: Tuple[int, int]) -> Dict[int, Any]:
+    """Solo las páginas del rango (inclusivo) de una cuenta, para no cargar el documento completo por cuenta."""
+    inicio, fin = rango_paginas
+    return {p: por_pagina[p] for p in range(inicio, fin + 1) if p in por_pagina}
+
 async def procesar_documento_con_agentes_async(
     ia_data_cuenta: dict, 
     texto_total: Dict[int, str], 
@@ -176,10 +460,9 @@ async def procesar_documento_con_agentes_async(
     logger.info(f"Worker iniciando para: {nombre_cuenta}")
     banco = ia_data_cuenta.get("banco", "generico").lower()
     
-    # 1. FILTRAR INPUTS
-    lista_paginas = list(range(start_pg, end_pg + 1))
-    texto_subset = {k: v for k, v in texto_total.items() if k in lista_paginas}
-    movimientos_subset = {k: v for k, v in movimientos_total.items() if k in lista_paginas}
+    # 1. FILTRAR INPUTS (no cuesta nada si el llamador ya mandó solo el rango)
+    texto_subset = recortar_rango(texto_total, rango_paginas)
+    movimientos_subset = recortar_rango(movimientos_total, rango_paginas)
     paginas_con_movimientos = [p for p, m in movimientos_subset.items() if m]
     
     if not paginas_con_movimientos:
@@ -194,28 +477,40 @@ async def procesar_documento_con_agentes_async(
             "error_transacciones": "Sin movimientos detectados en el rango asignado."
         }
 
-    # 2. CHUNKING Y AGENTES
-    chunks = crear_chunks_con_superposicion(
+    consolidador = ConsolidadorTransacciones(tipo_flexible=False)
+
+    # 2. EXTRACCIÓN LOCAL (plantilla del banco); solo las páginas que no validan van al LLM.
+    # Sus transacciones van en la posición -1 para ir antes que los chunks y ganarles en la deduplicación.
+    paginas_para_llm = paginas_con_movimientos
+    if settings.EXTRACCION_LOCAL_ENABLED:
+        resultado_local = extraer_transacciones_locales(movimientos_subset, banco, ia_data_cuenta.get("depositos"))
+        for linea, trx in enumerate(resultado_local.transacciones):
+            consolidador.agregar((-1, linea), trx)
+        paginas_para_llm = resultado_local.paginas_pendientes
+        contadores_job.incrementar(EVENTO_PAGINAS_LOCALES, len(resultado_local.paginas_locales))
+        logger.info(
+            f"{nombre_cuenta}: {len(resultado_local.paginas_locales)} páginas extraídas localmente, "
+            f"{len(paginas_para_llm)} van al LLM."
+        )
+    contadores_job.incrementar(EVENTO_PAGINAS_LLM, len(paginas_para_llm))
+
+    # 3. CHUNKING POR PRESUPUESTO DE TOKENS Y AGENTES (solo para lo que no resolvió el motor local)
+    chunks = planificar_chunks(
         texto_por_pagina=texto_subset,
-        paginas_con_movimientos=paginas_con_movimientos,
-        tamano_chunk=5, superposicion=1
+        paginas_con_movimientos=paginas_para_llm,
+        presupuesto_tokens=settings.CHUNK_PRESUPUESTO_TOKENS,
+        lineas_superposicion=settings.CHUNK_LINEAS_SUPERPOSICION
     )
+    if len(chunks):
+        logger.info(f"{nombre_cuenta}: {len(chunks)} chunks, ~{chunks.tokens_planeados} tokens planeados.")
+        contadores_job.incrementar(EVENTO_TOKENS_PLANEADOS, chunks.tokens_planeados)
+    errores_chunks = await _consumir_agentes(
+        [_transmitir_agente_tpv(banco, txt, pags) for txt, pags in chunks], consolidador, [pags for _, pags in chunks]
+    )
+    error_transacciones = _error_chunks(errores_chunks, len(chunks))
     
-    tareas = [llamar_agente_tpv(banco, txt, pags) for txt, pags in chunks]
-    res_chunks = await asyncio.gather(*tareas, return_exceptions=True)
-    
-    # 3. CONSOLIDACIÓN
-    transacciones_totales = []
-    ids_unicos = set()
-    for res in res_chunks:
-        if not isinstance(res, Exception):
-            for trx in res:
-                id_trx = f"{trx.get('fecha')}-{trx.get('monto')}-{trx.get('descripcion', '')[:15]}"
-                if id_trx not in ids_unicos:
-                    transacciones_totales.append(trx)
-                    ids_unicos.add(id_trx)
-    
-    if not transacciones_totales:
+    # 4. CONSOLIDACIÓN Y CLASIFICACIÓN (Lógica POR DESCARTE, aplicada conforme llegan las líneas)
+    if not len(consolidador):
         return {
             **ia_data_cuenta,
             "nombre_archivo_virtual": nombre_cuenta,
@@ -223,94 +518,11 @@ async def procesar_documento_con_agentes_async(
             "depositos_en_efectivo": 0.0, "traspaso_entre_cuentas": 0.0,
             "total_entradas_financiamiento": 0.0, "entradas_bmrcash": 0.0,
             "entradas_TPV_bruto": 0.0, "entradas_TPV_neto": 0.0,
-            "error_transacciones": "Agentes LLM no encontraron transacciones TPV."
-        }
-    
-    # 4. CLASIFICACIÓN (Lógica correjida POR DESCARTE)
-    total_depositos_efectivo = 0.0
-    total_traspaso_entre_cuentas = 0.0
-    total_entradas_financiamiento = 0.0
-    total_entradas_bmrcash = 0.0
-    total_entradas_tpv = 0.0
-    todas_las_transacciones = []
-
-    for trx in transacciones_totales:
-        monto_float = trx.get("monto", 0.0)
-        if not isinstance(monto_float, (int, float)):
-            monto_float = limpiar_monto(str(monto_float))
-
-        descripcion_limpia = trx.get("descripcion", "").lower()
-        
-        # dependencia directa de la decisión de la IA para la categorización final
-        es_tpv_ia = trx.get("categoria", False) 
-
-        trx_procesada = {
-            "fecha": trx.get("fecha"),
-            "descripcion": trx.get("descripcion"),
-            "monto": f"{monto_float:,.2f}",
-            "tipo": trx.get("tipo"),
-            "categoria": "GENERAL" # Por defecto
+            "error_transacciones": error_transacciones or "Agentes LLM no encontraron transacciones TPV."
         }
 
-        if trx.get("tipo") == "abono":
-            # 1. FILTRO DE EXCLUSIÓN
-            # Nota: Usamos 'any' para que si encuentra CUALQUIER palabra prohibida, lo descarte.
-            if any(p in descripcion_limpia for p in PALABRAS_EXCLUIDAS):
-                # Se queda como GENERAL
-                pass 
-            
-            else:
-                # 2. FILTROS ESPECÍFICOS (Efectivo, Traspaso, BMR...)
-                if any(p in descripcion_limpia for p in PALABRAS_EFECTIVO):
-                    total_depositos_efectivo += monto_float
-                    trx_procesada["categoria"] = "EFECTIVO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_ENTRE_CUENTAS):
-                    total_traspaso_entre_cuentas += monto_float
-                    trx_procesada["categoria"] = "TRASPASO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_FINANCIAMIENTO):
-                    total_entradas_financiamiento += monto_float
-                    trx_procesada["categoria"] = "FINANCIAMIENTO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_BMRCASH):
-                    total_entradas_bmrcash += monto_float
-                    trx_procesada["categoria"] = "BMRCASH"
-                
-                else:
-                    # Ahora preguntamos: ¿La IA cree que ES TPV?
-                    if es_tpv_ia:
-                        total_entradas_tpv += monto_float
-                        trx_procesada["categoria"] = "TPV"
-                    else:
-                        # Pasó los filtros negativos, pero la IA no está segura.
-                        # Lo dejamos como GENERAL para revisión manual o descarte.
-                        trx_procesada["categoria"] = "GENERAL"
-        
-        elif trx.get("tipo") == "cargo":
-            trx_procesada["categoria"] = "CARGO"
-
-        todas_las_transacciones.append(trx_procesada)
-
     # 5. RETORNO FINAL
-    comisiones_str = ia_data_cuenta.get("comisiones", "0.0")
-    if comisiones_str is None: comisiones_str = "0.0"
-    comisiones = limpiar_monto(str(comisiones_str))
-    
-    entradas_TPV_neto = total_entradas_tpv - comisiones
-
-    return {
-        **ia_data_cuenta,
-        "nombre_archivo_virtual": nombre_cuenta,
-        "transacciones": todas_las_transacciones,
-        "depositos_en_efectivo": total_depositos_efectivo,
-        "traspaso_entre_cuentas": total_traspaso_entre_cuentas,
-        "total_entradas_financiamiento": total_entradas_financiamiento,
-        "entradas_bmrcash": total_entradas_bmrcash,
-        "entradas_TPV_bruto": total_entradas_tpv,
-        "entradas_TPV_neto": entradas_TPV_neto,
-        "error_transacciones": None
-    }
+    return _ensamblar_cuenta(ia_data_cuenta, nombre_cuenta, consolidador, error_transacciones)
 
 async def procesar_documento_escaneado_con_agentes_async(
     ia_data: dict, 
@@ -322,10 +534,10 @@ async def procesar_documento_escaneado_con_agentes_async(
     banco = ia_data.get("banco", "generico")
     
     try:
-        with fitz.open(stream=pdf_bytes, filetype="pdf") as doc:
-            total_paginas = len(doc)
+        sesion = SesionDocumento(pdf_bytes)
     except Exception:
         return [{**ia_data, "error_transacciones": "No se pudo leer el PDF (corrupto)."}]
+    total_paginas = sesion.total_paginas
 
     # Chunking por páginas
     TAMANO_CHUNK, SUPERPOSICION = 2, 1
@@ -337,142 +549,52 @@ async def procesar_documento_escaneado_con_agentes_async(
         chunks_paginas.append(paginas)
         i += (TAMANO_CHUNK - SUPERPOSICION)
 
-    # Llamadas a Agente
-    tareas = [llamar_agente_ocr_vision(banco, pdf_bytes, pags) for pags in chunks_paginas]
-    res_chunks = await asyncio.gather(*tareas, return_exceptions=True)
-
-    # Consolidación
-    transacciones_totales = []
-    ids_unicos = set()
-    for res in res_chunks:
-        if not isinstance(res, Exception):
-            for trx in res:
-                id_trx = f"{trx.get('fecha')}-{trx.get('monto')}-{trx.get('descripcion', '')[:15]}"
-                if id_trx not in ids_unicos:
-                    transacciones_totales.append(trx)
-                    ids_unicos.add(id_trx)
-
-    # --- E. CLASIFICACIÓN DE NEGOCIO (LÓGICA UNIFICADA) ---
-    total_depositos_efectivo = 0.0
-    total_traspaso_entre_cuentas = 0.0
-    total_entradas_financiamiento = 0.0
-    total_entradas_bmrcash = 0.0
-    total_entradas_tpv = 0.0
-    transacciones_clasificadas = []
-
-    for trx in transacciones_totales:
-        monto_float = trx.get("monto", 0.0)
-        if not isinstance(monto_float, (int, float)):
-            monto_float = limpiar_monto(str(monto_float))
-
-        descripcion_limpia = trx.get("descripcion", "").lower()
-        
-        # Obtenemos la opinión de la IA si existe (OCR también debería devolver esto)
-        es_tpv_ia = trx.get("categoria", False)
-
-        # Estructura base
-        trx_procesada = {
-            "fecha": trx.get("fecha"),
-            "descripcion": trx.get("descripcion"),
-            "monto": f"{monto_float:,.2f}",
-            "tipo": trx.get("tipo", "abono"),
-            "categoria": "GENERAL" # Valor por defecto obligatorio
-        }
-
-        tipo_trx = trx.get("tipo", "abono").lower()
-
-        if "abono" in tipo_trx or "depósito" in tipo_trx:
-            # 1. FILTRO DE EXCLUSIÓN
-            if any(p in descripcion_limpia for p in PALABRAS_EXCLUIDAS):
-                # Se queda como GENERAL
-                pass 
-            else:
-                # 2. FILTROS ESPECÍFICOS
-                if any(p in descripcion_limpia for p in PALABRAS_EFECTIVO):
-                    total_depositos_efectivo += monto_float
-                    trx_procesada["categoria"] = "EFECTIVO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_ENTRE_CUENTAS):
-                    total_traspaso_entre_cuentas += monto_float
-                    trx_procesada["categoria"] = "TRASPASO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_FINANCIAMIENTO):
-                    total_entradas_financiamiento += monto_float
-                    trx_procesada["categoria"] = "FINANCIAMIENTO"
-                
-                elif any(p in descripcion_limpia for p in PALABRAS_BMRCASH):
-                    total_entradas_bmrcash += monto_float
-                    trx_procesada["categoria"] = "BMRCASH"
-                
-                else:
-                    # 3. DOBLE VALIDACIÓN (FILTRO NEGATIVO + IA POSITIVA)
-                    if es_tpv_ia:
-                        total_entradas_tpv += monto_float
-                        trx_procesada["categoria"] = "TPV"
-                    else:
-                        trx_procesada["categoria"] = "GENERAL"
-        
-        elif "cargo" in tipo_trx or "retiro" in tipo_trx:
-            trx_procesada["categoria"] = "CARGO"
+    # Rasterizar es lo único pesado en CPU: cada ventana manda sus páginas al pool de procesos justo
+    # antes de su llamada y recibe las imágenes, así nada se renderiza en este event loop
+    with sesion:
+        consolidador = ConsolidadorTransacciones(tipo_flexible=True)
+        errores_chunks = await _consumir_agentes(
+            [_transmitir_agente_ocr(banco, sesion, pags) for pags in chunks_paginas], consolidador,
+            chunks_paginas, etapa=ETAPA_CHUNKS_OCR
+        )
 
-        transacciones_clasificadas.append(trx_procesada)
+    # Consolidación + clasificación de negocio (lógica unificada) y ensamble final de la cuenta
+    # (Envuelto en lista)
+    return [_ensamblar_cuenta(ia_data, filename, consolidador, _error_chunks(errores_chunks, len(chunks_paginas)))]
 
-    # --- F. ENSAMBLE FINAL DE LA CUENTA ---
-    comisiones_str = ia_data.get("comisiones", "0.0")
-    if comisiones_str is None: comisiones_str = "0.0"
-    comisiones = limpiar_monto(str(comisiones_str))
-    
-    entradas_TPV_neto = total_entradas_tpv - comisiones
-
-    # Retorno (Envuelto en lista)
-    return [{
-        **ia_data, 
-        "nombre_archivo_virtual": filename,
-        "transacciones": transacciones_clasificadas,
-        "depositos_en_efectivo": total_depositos_efectivo,
-        "traspaso_entre_cuentas": total_traspaso_entre_cuentas,
-        "total_entradas_financiamiento": total_entradas_financiamiento,
-        "entradas_bmrcash": total_entradas_bmrcash,
-        "entradas_TPV_bruto": total_entradas_tpv,
-        "entradas_TPV_neto": entradas_TPV_neto,
-        "error_transacciones": None
-    }]
-
-def procesar_digital_worker_sync(
+async def procesar_cuenta_digital(
     ia_data_inicial: dict, 
     texto_por_pagina: Dict[int, str], 
     movimientos_por_pagina: Dict[int, Any], 
     filename: str,
     rango_paginas: Tuple[int, int]
 ) -> Union[AnalisisTPV.ResultadoExtraccion, Exception]:
+    """
+    Cuenta digital completa como corrutina del event loop principal: casi todo es esperar a los
+    agentes, así que no paga pickling ni procesos. Los contadores van al job del contexto (job_actual).
+    """
     try:
-        # Ejecutamos la función async que ahora devuelve UN solo dict
-        resultado_dict = asyncio.run(
-            procesar_documento_con_agentes_async(
-                ia_data_inicial, texto_por_pagina, movimientos_por_pagina, 
-                filename, rango_paginas
-            )
+        resultado_dict = await procesar_documento_con_agentes_async(
+            ia_data_inicial, texto_por_pagina, movimientos_por_pagina, 
+            filename, rango_paginas
         )
         # Lo envolvemos en el objeto Pydantic esperado
         return crear_objeto_resultado(resultado_dict)
     except Exception as e:
-        logger.error(f"Error Worker Digital ({filename}): {e}", exc_info=True)
+        logger.error(f"Error en cuenta digital ({filename}): {e}", exc_info=True)
         return e
 
-def procesar_ocr_worker_sync(
+async def procesar_cuenta_escaneada(
     ia_data: dict, 
     pdf_content: bytes, 
     filename: str
 ) -> Union[List[AnalisisTPV.ResultadoExtraccion], Exception]:
+    """Cuenta escaneada: la rasterización corre en el pool de procesos y los agentes de visión en este loop."""
     try:
-        lista_dicts = asyncio.run(
-            procesar_documento_escaneado_con_agentes_async(
-                ia_data, pdf_content, filename
-            )
-        )
+        lista_dicts = await procesar_documento_escaneado_con_agentes_async(ia_data, pdf_content, filename)
         return [crear_objeto_resultado(d) for d in lista_dicts]
     except Exception as e:
-        logger.error(f"Error Worker OCR ({filename}): {e}", exc_info=True)
+        logger.error(f"Error en cuenta escaneada ({filename}): {e}", exc_info=True)
         return e
 
 ### ----- FUNCIONES ORQUESTADORAS PARA NOMIFLASH -----
@@ -488,42 +610,43 @@ async def procesar_nomina(archivo: UploadFile) -> NomiFlash.RespuestaNomina:
         # Leer contenido. Si falla, la excepción será capturada.
         pdf_bytes = await archivo.read()
 
-        # --- Lógica de negocio específica para Nómina ---
-        # 1. Extraemos texto para la validación con regex
-        texto_inicial = extraer_texto_de_pdf(pdf_bytes, num_paginas=2)
-        rfc, curp = extraer_rfc_curp_por_texto(texto_inicial, "nomina")
+        # El PDF se abre UNA vez por petición (texto, imágenes y QR) y se cierra al terminar
+        with SesionDocumento(pdf_bytes) as sesion:
+            # --- Lógica de negocio específica para Nómina ---
+            # 1. Extraemos texto para la validación con regex
+            texto_inicial = extraer_texto_de_pdf(sesion, num_paginas=2)
+            rfc, curp = extraer_rfc_curp_por_texto(texto_inicial, "nomina")
 
-        # 2. Leemos el QR de las imagenes (con loop executor para no bloquear el servidor)
-        loop = asyncio.get_running_loop()
+            # 2. Generamos las imágenes para la IA (con loop executor para no bloquear el servidor)
+            loop = asyncio.get_running_loop()
 
-        imagen_buffers = await loop.run_in_executor(
-            None, convertir_pdf_a_imagenes, pdf_bytes
-        )
+            imagen_buffers = await loop.run_in_executor(
+                None, convertir_pdf_a_imagenes, sesion, [1], PERFIL_NOMI
+            )
 
-        if not imagen_buffers:
-            raise ValueError("No se pudieron generar imágenes del PDF.")
+            if not imagen_buffers:
+                raise ValueError("No se pudieron generar imágenes del PDF.")
 
-        # 2.5 Leemos el QR de las imágenes (lógica condicional aquí)
-        datos_qr = await loop.run_in_executor(
-            None, leer_qr_de_imagenes, imagen_buffers
-        )
-        
-        # 3. Analizamos con la IA usando el prompt de nómina y las mismas imagenes
-        respuesta_gpt = await analizar_gpt_nomi(PROMPT_NOMINA, imagen_buffers)
-        datos_crudos = extraer_json_del_markdown(respuesta_gpt)
-        datos_listos = sanitizar_datos_ia(datos_crudos)
-
-        # --- Lógica de corrección específica para Nómina ---
-        # 3. Sobrescribimos los datos de la IA con los de la regex (más fiables)
-        if datos_qr:
-            datos_listos["datos_qr"] = datos_qr
-        if rfc:
-            datos_listos["rfc"] = rfc[-1]
-        if curp:
-            datos_listos["curp"] = curp[-1]
+            # 2.5 y 3. El QR se lee directo del PDF (imágenes incrustadas primero) en un hilo,
+            # mientras la IA analiza las imágenes con el prompt correspondiente
+            datos_qr, respuesta_gpt = await asyncio.gather(
+                loop.run_in_executor(None, leer_qr_de_pdf, sesion, [1]),
+                analizar_gpt_nomi(PROMPT_NOMINA, imagen_buffers)
+            )
+            datos_crudos = extraer_json_del_markdown(respuesta_gpt)
+            datos_listos = sanitizar_datos_ia(datos_crudos)
+
+            # --- Lógica de corrección específica para Nómina ---
+            # 3. Sobrescribimos los datos de la IA con los de la regex (más fiables)
+            if datos_qr:
+                datos_listos["datos_qr"] = datos_qr
+            if rfc:
+                datos_listos["rfc"] = rfc[-1]
+            if curp:
+                datos_listos["curp"] = curp[-1]
         
-        # Si todo fue exitoso, devuelve los datos.
-        return NomiFlash.RespuestaNomina(**datos_listos)
+            # Si todo fue exitoso, devuelve los datos.
+            return NomiFlash.RespuestaNomina(**datos_listos)
 
     except Exception as e:
         # Error por procesamiento
@@ -539,45 +662,46 @@ async def procesar_segunda_nomina(archivo: UploadFile) -> NomiFlash.SegundaRespu
         # Leer contenido. Si falla, la excepción será capturada.
         pdf_bytes = await archivo.read()
 
-        # --- Lógica de negocio específica para Nómina ---
-        # 1. Extraemos texto para la validación con regex
-        texto_inicial = extraer_texto_de_pdf(pdf_bytes, num_paginas=2)
-        rfc, curp = extraer_rfc_curp_por_texto(texto_inicial, "nomina")
-        # 2.5 Log de RFC y CURP extraídos
-        logger.info(f"Se extrajo el RFC: {rfc[-1] if rfc else None}")
-        logger.info(f"Se extrajo el CURP: {curp[-1] if curp else None}")
-
-        # 2. Leemos el QR de las imagenes (con loop executor para no bloquear el servidor)
-        loop = asyncio.get_running_loop()
-
-        imagen_buffers = await loop.run_in_executor(
-            None, convertir_pdf_a_imagenes, pdf_bytes
-        )
+        # El PDF se abre UNA vez por petición (texto, imágenes y QR) y se cierra al terminar
+        with SesionDocumento(pdf_bytes) as sesion:
+            # --- Lógica de negocio específica para Nómina ---
+            # 1. Extraemos texto para la validación con regex
+            texto_inicial = extraer_texto_de_pdf(sesion, num_paginas=2)
+            rfc, curp = extraer_rfc_curp_por_texto(texto_inicial, "nomina")
+            # 2.5 Log de RFC y CURP extraídos
+            logger.info(f"Se extrajo el RFC: {rfc[-1] if rfc else None}")
+            logger.info(f"Se extrajo el CURP: {curp[-1] if curp else None}")
+
+            # 2. Generamos las imágenes para la IA (con loop executor para no bloquear el servidor)
+            loop = asyncio.get_running_loop()
+
+            imagen_buffers = await loop.run_in_executor(
+                None, convertir_pdf_a_imagenes, sesion, [1], PERFIL_NOMI
+            )
 
-        if not imagen_buffers:
-            raise ValueError("No se pudieron generar imágenes del PDF.")
+            if not imagen_buffers:
+                raise ValueError("No se pudieron generar imágenes del PDF.")
 
-        # 2.5 Leemos el QR de las imágenes (lógica condicional aquí)
-        datos_qr = await loop.run_in_executor(
-            None, leer_qr_de_imagenes, imagen_buffers
-        )
-        
-        # 3. Analizamos con la IA usando el prompt de nómina y las mismas imagenes
-        respuesta_gpt = await analizar_gpt_nomi(SEGUNDO_PROMPT_NOMINA, imagen_buffers)
-        datos_crudos = extraer_json_del_markdown(respuesta_gpt)
-        datos_listos = sanitizar_datos_ia(datos_crudos)
-
-        # --- Lógica de corrección específica para Nómina ---
-        # 3. Sobrescribimos los datos de la IA con los de la regex (más fiables)
-        if datos_qr:
-            datos_listos["datos_qr"] = datos_qr
-        if rfc:
-            datos_listos["rfc"] = rfc[-1]
-        if curp:
-            datos_listos["curp"] = curp[-1]
+            # 2.5 y 3. El QR se lee directo del PDF (imágenes incrustadas primero) en un hilo,
+            # mientras la IA analiza las imágenes con el prompt correspondiente
+            datos_qr, respuesta_gpt = await asyncio.gather(
+                loop.run_in_executor(None, leer_qr_de_pdf, sesion, [1]),
+                analizar_gpt_nomi(SEGUNDO_PROMPT_NOMINA, imagen_buffers)
+            )
+            datos_crudos = extraer_json_del_markdown(respuesta_gpt)
+            datos_listos = sanitizar_datos_ia(datos_crudos)
+
+            # --- Lógica de corrección específica para Nómina ---
+            # 3. Sobrescribimos los datos de la IA con los de la regex (más fiables)
+            if datos_qr:
+                datos_listos["datos_qr"] = datos_qr
+            if rfc:
+                datos_listos["rfc"] = rfc[-1]
+            if curp:
+                datos_listos["curp"] = curp[-1]
         
-        # Si todo fue exitoso, devuelve los datos.
-        return NomiFlash.SegundaRespuestaNomina(**datos_listos)
+            # Si todo fue exitoso, devuelve los datos.
+            return NomiFlash.SegundaRespuestaNomina(**datos_listos)
 
     except Exception as e:
         # Error por procesamiento
@@ -592,57 +716,57 @@ async def procesar_estado_cuenta(archivo: UploadFile) -> NomiFlash.RespuestaEsta
     try:
         pdf_bytes = await archivo.read()
 
-        # --- Lógica de negocio específica para Nómina ---
-        # 0. Extraemos texto para la validación con regex
-        texto_inicial = extraer_texto_de_pdf(pdf_bytes, num_paginas=2)
-        rfc, _ = extraer_rfc_curp_por_texto(texto_inicial, "estado")
-        logger.info(f"Se extrajo el RFC: {rfc[0] if rfc else None}")
+        # El PDF se abre UNA vez por petición (texto, imágenes y QR) y se cierra al terminar
+        with SesionDocumento(pdf_bytes) as sesion:
+            # --- Lógica de negocio específica para Nómina ---
+            # 0. Extraemos texto para la validación con regex
+            texto_inicial = extraer_texto_de_pdf(sesion, num_paginas=2)
+            rfc, _ = extraer_rfc_curp_por_texto(texto_inicial, "estado")
+            logger.info(f"Se extrajo el RFC: {rfc[0] if rfc else None}")
 
-        loop = asyncio.get_running_loop()
+            loop = asyncio.get_running_loop()
 
-        # --- 1. Determinar dinámicamente las páginas a procesar ---
-        paginas_a_procesar = []
-        try:
-            # Abrimos el PDF brevemente solo para contar las páginas
-            with fitz.open(stream=BytesIO(pdf_bytes), filetype="pdf") as doc:
-                total_paginas = len(doc)
+            # --- 1. Determinar dinámicamente las páginas a procesar ---
+            paginas_a_procesar = []
+            try:
+                # El conteo sale de la sesión ya abierta (no se vuelve a abrir el PDF)
+                total_paginas = sesion.total_paginas
             
-            # Creamos la lista: [1, 2, ultima_pagina]
-            # Usamos set para manejar PDFs cortos (ej. de 1 o 2 páginas) sin duplicados.
-            paginas_a_procesar = sorted(list(set([1, 2, total_paginas])))
-            logger.info(f"Procesando páginas {paginas_a_procesar} para '{archivo.filename}'")
+                # Creamos la lista: [1, 2, ultima_pagina]
+                # Usamos set para manejar PDFs cortos (ej. de 1 o 2 páginas) sin duplicados.
+                paginas_a_procesar = sorted(list(set([1, 2, total_paginas])))
+                logger.info(f"Procesando páginas {paginas_a_procesar} para '{archivo.filename}'")
             
-        except Exception as e:
-            # Si falla, usamos un valor seguro por defecto
-            logger.warning(f"No se pudo determinar el total de páginas para '{archivo.filename}': {e}. Usando páginas [1, 2].")
-            paginas_a_procesar = [1, 2]
-
-        # --- 2. Convertir solo las páginas necesarias a imágenes ---
-        imagen_buffers = await loop.run_in_executor(
-            None, convertir_pdf_a_imagenes, pdf_bytes, paginas_a_procesar
-        )
-        if not imagen_buffers:
-            raise ValueError("No se pudieron generar imágenes del PDF.")
+            except Exception as e:
+                # Si falla, usamos un valor seguro por defecto
+                logger.warning(f"No se pudo determinar el total de páginas para '{archivo.filename}': {e}. Usando páginas [1, 2].")
+                paginas_a_procesar = [1, 2]
 
-        # 2.5 Leemos el QR de las imágenes (lógica condicional aquí)
-        datos_qr = await loop.run_in_executor(
-            None, leer_qr_de_imagenes, imagen_buffers
-        )
-        
-        # 3. Analizamos con la IA usando el prompt de nómina y las mismas imagenes
-        respuesta_gpt = await analizar_gpt_nomi(PROMPT_ESTADO_CUENTA, imagen_buffers)
-        datos_crudos = extraer_json_del_markdown(respuesta_gpt)
-        datos_listos = sanitizar_datos_ia(datos_crudos)
+            # --- 2. Convertir solo las páginas necesarias a imágenes ---
+            imagen_buffers = await loop.run_in_executor(
+                None, convertir_pdf_a_imagenes, sesion, paginas_a_procesar, PERFIL_NOMI
+            )
+            if not imagen_buffers:
+                raise ValueError("No se pudieron generar imágenes del PDF.")
+
+            # 2.5 y 3. El QR se lee directo del PDF (imágenes incrustadas primero) en un hilo,
+            # mientras la IA analiza las imágenes con el prompt correspondiente
+            datos_qr, respuesta_gpt = await asyncio.gather(
+                loop.run_in_executor(None, leer_qr_de_pdf, sesion, paginas_a_procesar),
+                analizar_gpt_nomi(PROMPT_ESTADO_CUENTA, imagen_buffers)
+            )
+            datos_crudos = extraer_json_del_markdown(respuesta_gpt)
+            datos_listos = sanitizar_datos_ia(datos_crudos)
 
-        # --- Lógica de corrección específica para Nómina ---
-        if datos_qr:
-            datos_listos["datos_qr"] = datos_qr
-        if rfc:
-            logger.info(f"RFC extraído: {rfc[0]}")
-            datos_listos["rfc"] = rfc[0]
+            # --- Lógica de corrección específica para Nómina ---
+            if datos_qr:
+                datos_listos["datos_qr"] = datos_qr
+            if rfc:
+                logger.info(f"RFC extraído: {rfc[0]}")
+                datos_listos["rfc"] = rfc[0]
 
-        logger.debug(datos_listos)
-        return NomiFlash.RespuestaEstado(**datos_listos)
+            logger.debug(datos_listos)
+            return NomiFlash.RespuestaEstado(**datos_listos)
 
     except Exception as e:
         return NomiFlash.RespuestaEstado(error_lectura_estado=f"Error procesando '{archivo.filename}': {e}")
@@ -656,17 +780,19 @@ async def procesar_comprobante(archivo: UploadFile) -> NomiFlash.RespuestaCompro
     try:
         pdf_bytes = await archivo.read()
 
-        # 1. Convertimos los PDF a imagenes (con loop executor para no bloquear el servidor)
-        loop = asyncio.get_running_loop()
+        # El PDF se abre UNA vez por petición (texto, imágenes y QR) y se cierra al terminar
+        with SesionDocumento(pdf_bytes) as sesion:
+            # 1. Convertimos los PDF a imagenes (con loop executor para no bloquear el servidor)
+            loop = asyncio.get_running_loop()
 
-        imagen_buffers = await loop.run_in_executor(
-            None, convertir_pdf_a_imagenes, pdf_bytes
-        )
+            imagen_buffers = await loop.run_in_executor(
+                None, convertir_pdf_a_imagenes, sesion, [1], PERFIL_NOMI
+            )
 
-        respuesta_ia = await analizar_gpt_nomi(PROMPT_COMPROBANTE, imagen_buffers)
-        datos_crudos = extraer_json_del_markdown(respuesta_ia)
-        datos_listos = sanitizar_datos_ia(datos_crudos)
-        return NomiFlash.RespuestaComprobante(**datos_listos)
+            respuesta_ia = await analizar_gpt_nomi(PROMPT_COMPROBANTE, imagen_buffers)
+            datos_crudos = extraer_json_del_markdown(respuesta_ia)
+            datos_listos = sanitizar_datos_ia(datos_crudos)
+            return NomiFlash.RespuestaComprobante(**datos_listos)
     
     except Exception as e: 
         return NomiFlash.RespuestaComprobante(error_lectura_comprobante=f"Error procesando '{archivo.filename}': {e}")
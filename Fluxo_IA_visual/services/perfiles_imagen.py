@@ -0,0 +1,133 @@
+# Perfiles de codificación de las páginas que se suben a los modelos de visión
+# (formato, calidad, modo de color y escala por tipo de documento)
+from dataclasses import dataclass
+from io import BytesIO
+from typing import Any, Dict, List, Optional
+from PIL import Image
+import argparse
+import base64
+import time
+import fitz
+
+FORMATOS_SOPORTADOS = ("png", "jpeg", "webp")
+MODOS_SOPORTADOS = ("color", "gris", "bilevel")
+
+# Nombre del formato para Pillow
+_FORMATO_PIL = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+
+@dataclass(frozen=True)
+class PerfilImagen:
+    """
+    Cómo se rasteriza y codifica una página.
+    - modo 'gris' renderiza directo en escala de grises (1 canal en lugar de 3).
+    - modo 'bilevel' binariza con 'umbral' (texto negro sobre blanco).
+    - 'calidad' solo aplica a JPEG y WebP.
+    Es inmutable y hashable para poder usarse como parte de la llave de la cache de imágenes.
+    """
+    nombre: str
+    formato: str = "png"
+    modo: str = "color"
+    escala: float = 2
+    calidad: int = 85
+    umbral: int = 180
+
+    def __post_init__(self):
+        if self.formato not in FORMATOS_SOPORTADOS:
+            raise ValueError(f"Formato de imagen no soportado: '{self.formato}'. Opciones: {FORMATOS_SOPORTADOS}")
+        if self.modo not in MODOS_SOPORTADOS:
+            raise ValueError(f"Modo de imagen no soportado: '{self.modo}'. Opciones: {MODOS_SOPORTADOS}")
+        if not 1 <= self.calidad <= 100:
+            raise ValueError("La calidad debe estar entre 1 y 100.")
+
+# El comportamiento histórico: PNG a color con fitz.Matrix(2, 2)
+PERFIL_ORIGINAL = PerfilImagen(nombre="original")
+
+PERFILES_IMAGEN: Dict[str, PerfilImagen] = {
+    perfil.nombre: perfil for perfil in (
+        PERFIL_ORIGINAL,
+        # Estados de cuenta digitales: texto negro sobre blanco, el color no aporta nada y
+        # el PNG en grises de 1 canal pesa menos que un JPEG (que mete ruido en los bordes del texto)
+        PerfilImagen(nombre="estado_cuenta", formato="png", modo="gris", escala=2),
+        # Agente OCR-Visión: páginas escaneadas (con ruido de fondo), donde JPEG sí comprime mejor
+        PerfilImagen(nombre="ocr_vision", formato="jpeg", modo="gris", escala=2, calidad=85),
+        # Nómina y comprobantes: sin pérdida para no degradar la lectura del QR
+        PerfilImagen(nombre="nomina", formato="png", modo="gris", escala=2),
+        PerfilImagen(nombre="bilevel", formato="png", modo="bilevel", escala=2),
+        PerfilImagen(nombre="webp_gris", formato="webp", modo="gris", escala=2, calidad=80),
+    )
+}
+
+def obtener_perfil(nombre: str) -> PerfilImagen:
+    """Busca un perfil registrado por nombre. Lanza ValueError si no existe."""
+    try:
+        return PERFILES_IMAGEN[nombre]
+    except KeyError:
+        raise ValueError(f"Perfil de imagen desconocido: '{nombre}'. Opciones: {sorted(PERFILES_IMAGEN)}")
+
+def codificar_pagina(pagina: fitz.Page, perfil: PerfilImagen = PERFIL_ORIGINAL) -> bytes:
+    """Rasteriza una página con la escala del perfil y la codifica en su formato."""
+    colorspace = fitz.csRGB if perfil.modo == "color" else fitz.csGRAY
+    pix = pagina.get_pixmap(matrix=fitz.Matrix(perfil.escala, perfil.escala), colorspace=colorspace, alpha=False)
+
+    # PNG y JPEG los codifica fitz directamente (sin pasar por Pillow)
+    if perfil.modo != "bilevel" and perfil.formato in ("png", "jpeg"):
+        return pix.tobytes(perfil.formato, jpg_quality=perfil.calidad)
+
+    imagen = Image.frombytes("L" if pix.n == 1 else "RGB", (pix.width, pix.height), pix.samples)
+    if perfil.modo == "bilevel":
+        imagen = imagen.point(lambda v: 255 if v > perfil.umbral else 0, mode="1")
+        if perfil.formato != "png":
+            # JPEG y WebP no guardan imágenes de 1 bit
+            imagen = imagen.convert("L")
+
+    buffer = BytesIO()
+    opciones = {"optimize": True} if perfil.formato == "png" else {"quality": perfil.calidad}
+    imagen.save(buffer, format=_FORMATO_PIL[perfil.formato], **opciones)
+    return buffer.getvalue()
+
+def medir_perfiles(
+    pdf_bytes: bytes,
+    paginas: Optional[List[int]] = None,
+    perfiles: Optional[List[PerfilImagen]] = None
+) -> List[Dict[str, Any]]:
+    """
+    Benchmark: codifica las páginas con cada perfil y reporta el tamaño del payload
+    (bytes de imagen y de base64, que es lo que realmente se sube) y el tiempo de codificación.
+    """
+    perfiles = perfiles or list(PERFILES_IMAGEN.values())
+    resultados = []
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as documento:
+        paginas = paginas or list(range(1, len(documento) + 1))
+        for perfil in perfiles:
+            bytes_imagen = 0
+            bytes_base64 = 0
+            inicio = time.perf_counter()
+            for num_pagina in paginas:
+                contenido = codificar_pagina(documento.load_page(num_pagina - 1), perfil)
+                bytes_imagen += len(contenido)
+                bytes_base64 += len(base64.b64encode(contenido))
+            segundos = time.perf_counter() - inicio
+            resultados.append({
+                "perfil": perfil.nombre,
+                "paginas": len(paginas),
+                "bytes_imagen": bytes_imagen,
+                "bytes_base64": bytes_base64,
+                "ms_por_pagina": round(segundos * 1000 / max(len(paginas), 1), 2),
+            })
+    return resultados
+
+if __name__ == "__main__":
+    # Uso: python -m Fluxo_IA_visual.services.perfiles_imagen estado.pdf [--paginas 1 2 3]
+    parser = argparse.ArgumentParser(description="Compara el tamaño y tiempo de codificación de cada perfil de imagen.")
+    parser.add_argument("pdf", help="Ruta del PDF a medir")
+    parser.add_argument("--paginas", type=int, nargs="*", help="Páginas (1-indexadas); por defecto todas")
+    argumentos = parser.parse_args()
+
+    with open(argumentos.pdf, "rb") as archivo:
+        filas = medir_perfiles(archivo.read(), argumentos.paginas)
+
+    base = next((f["bytes_base64"] for f in filas if f["perfil"] == PERFIL_ORIGINAL.nombre), None)
+    print(f"{'perfil':<15}{'págs':>6}{'imagen (KB)':>14}{'base64 (KB)':>14}{'ms/pág':>10}{'vs original':>13}")
+    for f in filas:
+        relativo = f"{f['bytes_base64'] / base:.0%}" if base else "-"
+        print(f"{f['perfil']:<15}{f['paginas']:>6}{f['bytes_imagen'] / 1024:>14.1f}{f['bytes_base64'] / 1024:>14.1f}{f['ms_por_pagina']:>10}{relativo:>13}")
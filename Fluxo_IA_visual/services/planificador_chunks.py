@@ -0,0 +1,98 @@
+# Planificador de chunks para los agentes TPV: empaca páginas hasta un presupuesto de tokens
+# en lugar de un número fijo de páginas, y solo repite las últimas líneas de la página anterior
+from .llm_governor import CARACTERES_POR_TOKEN
+
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Iterator, List, Tuple
+import logging
+
+logger = logging.getLogger(__name__)
+
+def estimar_tokens_texto(texto: str) -> int:
+    """
+    Misma estimación barata que el gobernador (caracteres / 4), redondeada hacia arriba: una página
+    con texto cuesta al menos un token y nunca cabe "gratis" en un chunk que ya llenó su presupuesto.
+    """
+    return -(-len(texto) // CARACTERES_POR_TOKEN)
+
+def _ultimas_lineas(texto: str, cantidad: int) -> str:
+    if cantidad <= 0:
+        return ""
+    lineas = [linea for linea in texto.splitlines() if linea.strip()]
+    return "\n".join(lineas[-cantidad:])
+
+@dataclass
+class ChunkPlaneado:
+    texto: str
+    paginas: List[int]
+    tokens: int
+
+@dataclass
+class PlanChunks:
+    """
+    Chunks de una cuenta y su costo estimado. Se itera como una lista de (texto, páginas).
+    """
+    chunks: List[ChunkPlaneado] = field(default_factory=list)
+
+    @property
+    def tokens_planeados(self) -> int:
+        return sum(chunk.tokens for chunk in self.chunks)
+
+    def __len__(self) -> int:
+        return len(self.chunks)
+
+    def __iter__(self) -> Iterator[Tuple[str, List[int]]]:
+        for chunk in self.chunks:
+            yield chunk.texto, chunk.paginas
+
+def planificar_chunks(
+    texto_por_pagina: Dict[int, str],
+    paginas_con_movimientos: Iterable[int],
+    presupuesto_tokens: int,
+    lineas_superposicion: int = 0
+) -> PlanChunks:
+    """
+    Empaca las páginas con movimientos (en orden) mientras el chunk no pase 'presupuesto_tokens'.
+    Cada chunk después del primero empieza con las últimas 'lineas_superposicion' líneas de la
+    página anterior si es la contigua, para que una transacción partida entre páginas se lea completa;
+    el agente ya ignora el inicio incompleto y el consolidador deduplica lo repetido.
+    Una página que por sí sola pasa el presupuesto va sola en su chunk.
+    """
+    paginas_validas = set(paginas_con_movimientos)
+    paginas = sorted(p for p in texto_por_pagina if p in paginas_validas)
+    plan = PlanChunks()
+
+    partes: List[str] = []
+    paginas_chunk: List[int] = []
+    tokens_chunk = 0
+    pagina_anterior = None
+
+    def cerrar_chunk() -> None:
+        plan.chunks.append(ChunkPlaneado(texto="".join(partes), paginas=list(paginas_chunk), tokens=tokens_chunk))
+
+    for num_pagina in paginas:
+        texto = texto_por_pagina[num_pagina]
+        tokens_pagina = estimar_tokens_texto(texto)
+
+        if paginas_chunk and tokens_chunk + tokens_pagina > presupuesto_tokens:
+            cerrar_chunk()
+            partes, paginas_chunk, tokens_chunk = [], [], 0
+
+        # Tras un salto (portada o página sin movimientos de por medio) no hay transacción partida
+        if not paginas_chunk and pagina_anterior is not None and num_pagina == pagina_anterior + 1:
+            superposicion = _ultimas_lineas(texto_por_pagina[pagina_anterior], lineas_superposicion)
+            if superposicion:
+                partes.append(superposicion + "\n")
+                tokens_chunk += estimar_tokens_texto(superposicion)
+
+        if tokens_pagina > presupuesto_tokens:
+            logger.warning(f"La página {num_pagina} (~{tokens_pagina} tokens) pasa el presupuesto de {presupuesto_tokens}; va sola.")
+
+        partes.append(texto)
+        paginas_chunk.append(num_pagina)
+        tokens_chunk += tokens_pagina
+        pagina_anterior = num_pagina
+
+    if paginas_chunk:
+        cerrar_chunk()
+    return plan
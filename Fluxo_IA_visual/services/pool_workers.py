@@ -0,0 +1,140 @@
+# Pool de procesos worker de larga vida: lo crea el lifespan de la app y lo comparten todos los jobs
+from ..core.config import settings
+from ..core.exceptions import PoolWorkersCerradoError
+from .ia_extractor import contadores_job
+from .llm_resiliencia import EVENTO_BYTES_WORKERS
+
+from concurrent.futures import ProcessPoolExecutor, Future, wait
+from typing import Any, Callable, Optional, Set, Tuple
+import importlib
+import threading
+import asyncio
+import logging
+import time
+import os
+
+logger = logging.getLogger(__name__)
+
+# Módulos pesados que cada worker importa una sola vez al arrancar (fitz, PIL, openpyxl, pydantic,
+# plantillas y patrones compilados) en lugar de hacerlo en la primera tarea de cada job.
+# Los workers solo hacen CPU (rasterizar, Excel): las llamadas LLM corren en el event loop principal.
+MODULOS_PRECARGA = (
+    ".image_cache",
+    ".perfiles_imagen",
+    ".pdf_processor",
+    ".transacciones_locales",
+    "..utils.xlsx_converter",
+    "..models.responses",
+)
+
+def tamano_pool_workers() -> int:
+    """Tamaño configurado del pool (POOL_WORKERS_MAX) o el número de CPUs."""
+    return settings.POOL_WORKERS_MAX or os.cpu_count() or 1
+
+def _inicializar_worker() -> None:
+    """Initializer del pool: precarga los módulos que usan las tareas de CPU."""
+    for modulo in MODULOS_PRECARGA:
+        try:
+            importlib.import_module(modulo, package=__package__)
+        except Exception as e:
+            logger.warning(f"No se pudo precargar '{modulo}' en el worker {os.getpid()}: {e}")
+
+def tamano_aproximado(objeto: Any) -> int:
+    """
+    Bytes que cruzan el pipe del pool, sin serializar: cuenta bytes y textos (PDF, imágenes, Excel)
+    dentro de listas, tuplas y dicts. Lo demás (números, funciones) pesa poco y no se cuenta.
+    """
+    if isinstance(objeto, (bytes, bytearray, memoryview)):
+        return len(objeto)
+    if isinstance(objeto, str):
+        return len(objeto)
+    if isinstance(objeto, dict):
+        return sum(tamano_aproximado(valor) for valor in objeto.values())
+    if isinstance(objeto, (list, tuple)):
+        return sum(tamano_aproximado(valor) for valor in objeto)
+    return 0
+
+class PoolWorkers:
+    """
+    Un solo ProcessPoolExecutor para todos los jobs (antes cada job abría el suyo).
+    - Los workers arrancan una vez y conservan módulos y patrones compilados entre tareas.
+    - Argumentos y resultados viajan por el pipe del executor, que los serializa en su propio hilo
+      (nunca en el event loop); los bytes transferidos se suman al job del contexto (EVENTO_BYTES_WORKERS).
+      Con PDFs de hasta 8 MB la memoria compartida no resultó más rápida que el pipe, así que no se usa.
+    - 'cerrar' deja de aceptar tareas y espera a que terminen las que están en vuelo.
+    """
+    def __init__(self, max_workers: Optional[int] = None):
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._en_vuelo: Set[Future] = set()
+        self._cerrando = False
+        self._lock = threading.Lock()
+
+    def iniciar(self) -> None:
+        """Crea el pool (idempotente). El lifespan lo llama al arrancar para no pagar el spawn en el primer job."""
+        with self._lock:
+            self._cerrando = False
+            if self._executor is None:
+                procesos = self.max_workers or tamano_pool_workers()
+                self._executor = ProcessPoolExecutor(max_workers=procesos, initializer=_inicializar_worker)
+                logger.info(f"Pool de workers iniciado con {procesos} procesos.")
+
+    def _quitar(self, futuro: Future) -> None:
+        with self._lock:
+            self._en_vuelo.discard(futuro)
+
+    def enviar(self, funcion: Callable[..., Any], *args: Any) -> Tuple[Future, int]:
+        """
+        Manda una tarea al pool compartido y devuelve (futuro del resultado, bytes aproximados enviados).
+        Falla con PoolWorkersCerradoError si la app se está apagando.
+        """
+        if self._executor is None and not self._cerrando:
+            self.iniciar()
+        with self._lock:
+            if self._cerrando or self._executor is None:
+                raise PoolWorkersCerradoError("El pool de workers se está cerrando; no acepta tareas nuevas.")
+            futuro = self._executor.submit(funcion, *args)
+            self._en_vuelo.add(futuro)
+        futuro.add_done_callback(self._quitar)
+        return futuro, tamano_aproximado(args)
+
+    async def ejecutar(self, funcion: Callable[..., Any], *args: Any) -> Any:
+        """Equivalente a 'await loop.run_in_executor(pool, funcion, *args)' sobre el pool compartido."""
+        futuro, bytes_enviados = self.enviar(funcion, *args)
+        resultado = await asyncio.wrap_future(futuro)
+        contadores_job.incrementar(EVENTO_BYTES_WORKERS, bytes_enviados + tamano_aproximado(resultado))
+        return resultado
+
+    @property
+    def tareas_en_vuelo(self) -> int:
+        with self._lock:
+            return len(self._en_vuelo)
+
+    def cerrar(self, tiempo_drenado: Optional[float] = None) -> None:
+        """
+        Apagado ordenado: rechaza tareas nuevas, espera hasta 'tiempo_drenado' segundos a las que
+        están en vuelo y luego cancela lo que siga en cola. Es bloqueante (usar asyncio.to_thread).
+        """
+        if tiempo_drenado is None:
+            tiempo_drenado = settings.POOL_WORKERS_DRENADO_SEGUNDOS
+        with self._lock:
+            self._cerrando = True
+            executor = self._executor
+            pendientes = set(self._en_vuelo)
+        if executor is None:
+            return
+
+        if pendientes:
+            logger.info(f"Drenando el pool de workers: {len(pendientes)} tareas en vuelo (máx. {tiempo_drenado}s).")
+            inicio = time.monotonic()
+            _, sin_terminar = wait(pendientes, timeout=tiempo_drenado)
+            if sin_terminar:
+                logger.warning(f"{len(sin_terminar)} tareas no terminaron tras {time.monotonic() - inicio:.1f}s; se cancelan las que no empezaron.")
+
+        executor.shutdown(wait=True, cancel_futures=True)
+        with self._lock:
+            self._executor = None
+            self._en_vuelo.clear()
+        logger.info("Pool de workers cerrado.")
+
+pool_workers = PoolWorkers()
@@ -0,0 +1,172 @@
+# Motor de lectura de QR para NomiFlash: prueba primero lo barato y deja la página completa al final
+from .document_cache import FuenteDocumento, SesionDocumento, abrir_sesion, calcular_hash_documento
+
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from pyzbar.pyzbar import decode, ZBarSymbol
+from PIL import Image, ImageOps
+import threading
+import logging
+import fitz
+
+logger = logging.getLogger(__name__)
+
+MAX_DOCUMENTOS_QR_EN_CACHE = 256
+
+# Escala con la que se rasteriza la página (igual que convertir_pdf_a_imagenes)
+ESCALA_PAGINA = 2
+
+# Las imágenes incrustadas fuera de este rango (px) no pueden ser un QR legible
+LADO_MINIMO_IMAGEN = 40
+LADO_MAXIMO_IMAGEN = 4000
+# Los QR incrustados pequeños se amplían (sin interpolar) hasta este lado para zbar
+LADO_OBJETIVO_IMAGEN = 400
+# Los bitmaps de CFDI suelen venir sin margen blanco y zbar lo necesita
+MARGEN_SILENCIO = 16
+
+# Regiones (x0, y0, x1, y1) relativas al tamaño de la página, en el orden en que se prueban.
+# El QR del CFDI casi siempre está en la franja inferior.
+ESQUINAS = (
+    (0.0, 0.6, 0.45, 1.0),   # inferior izquierda
+    (0.55, 0.6, 1.0, 1.0),   # inferior derecha
+    (0.55, 0.0, 1.0, 0.4),   # superior derecha
+    (0.0, 0.0, 0.45, 0.4),   # superior izquierda
+)
+
+# Factores de reducción de la pirámide (de la más chica a la más grande)
+NIVELES_PIRAMIDE = (4, 2)
+
+Decodificador = Callable[..., list]
+
+def _con_margen(imagen: Image.Image) -> Image.Image:
+    return ImageOps.expand(imagen, border=MARGEN_SILENCIO, fill=255)
+
+def _extraer_imagen_incrustada(documento: fitz.Document, xref: int) -> Image.Image:
+    pix = fitz.Pixmap(documento, xref)
+    if pix.alpha:
+        pix = fitz.Pixmap(pix, 0)
+    if pix.n != 1:
+        pix = fitz.Pixmap(fitz.csGRAY, pix)
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def _imagenes_incrustadas(sesion: SesionDocumento, num_pagina: int) -> Iterator[Image.Image]:
+    """Imágenes incrustadas de la página en escala de grises, primero las más cuadradas."""
+    with sesion.usar() as documento:
+        informacion = documento.load_page(num_pagina - 1).get_images(full=True)
+
+    candidatas = []
+    for info in informacion:
+        xref, ancho, alto = info[0], info[2], info[3]
+        if not (LADO_MINIMO_IMAGEN <= min(ancho, alto) and max(ancho, alto) <= LADO_MAXIMO_IMAGEN):
+            continue
+        proporcion = min(ancho, alto) / max(ancho, alto)
+        candidatas.append((proporcion, xref))
+
+    for _, xref in sorted(candidatas, reverse=True):
+        try:
+            with sesion.usar() as documento:
+                imagen = _extraer_imagen_incrustada(documento, xref)
+        except Exception as e:
+            logger.debug(f"No se pudo extraer la imagen incrustada {xref}: {e}")
+            continue
+
+        lado = min(imagen.size)
+        if lado < LADO_OBJETIVO_IMAGEN:
+            factor = LADO_OBJETIVO_IMAGEN // lado + 1
+            imagen = imagen.resize((imagen.width * factor, imagen.height * factor), Image.NEAREST)
+        yield _con_margen(imagen)
+
+def _renderizar_gris(sesion: SesionDocumento, num_pagina: int) -> Image.Image:
+    with sesion.usar() as documento:
+        pix = documento.load_page(num_pagina - 1).get_pixmap(
+            matrix=fitz.Matrix(ESCALA_PAGINA, ESCALA_PAGINA), colorspace=fitz.csGRAY, alpha=False
+        )
+    return Image.frombytes("L", (pix.width, pix.height), pix.samples)
+
+def iterar_candidatos(sesion: SesionDocumento, paginas: List[int]) -> Iterator[Tuple[str, Image.Image]]:
+    """
+    Genera (etapa, imagen) en orden de costo:
+    1. imágenes incrustadas, 2. esquinas, 3. pirámide reducida, 4. página completa.
+    Cada página se rasteriza una sola vez y solo si las imágenes incrustadas no bastaron.
+    El documento solo se bloquea mientras fitz trabaja, no mientras zbar decodifica.
+    """
+    paginas_validas = [p for p in paginas if 1 <= p <= sesion.total_paginas]
+
+    for num_pagina in paginas_validas:
+        for imagen in _imagenes_incrustadas(sesion, num_pagina):
+            yield "imagen_incrustada", imagen
+
+    renders: Dict[int, Image.Image] = {}
+    def render(num_pagina: int) -> Image.Image:
+        if num_pagina not in renders:
+            renders[num_pagina] = _renderizar_gris(sesion, num_pagina)
+        return renders[num_pagina]
+
+    for num_pagina in paginas_validas:
+        imagen = render(num_pagina)
+        for x0, y0, x1, y1 in ESQUINAS:
+            caja = (int(x0 * imagen.width), int(y0 * imagen.height), int(x1 * imagen.width), int(y1 * imagen.height))
+            yield "esquina", imagen.crop(caja)
+
+    for num_pagina in paginas_validas:
+        imagen = render(num_pagina)
+        for factor in NIVELES_PIRAMIDE:
+            yield "piramide", imagen.reduce(factor)
+
+    for num_pagina in paginas_validas:
+        yield "pagina_completa", render(num_pagina)
+
+class MotorQR:
+    """
+    Lee el QR de un PDF probando candidatos de menor a mayor costo.
+    El resultado (incluso 'no hay QR') se cachea por hash del documento y páginas.
+    """
+    def __init__(self, decodificador: Decodificador = decode, max_documentos: int = MAX_DOCUMENTOS_QR_EN_CACHE):
+        self.decodificador = decodificador
+        self.max_documentos = max_documentos
+        self._cache: "OrderedDict[Tuple[str, Tuple[int, ...]], Optional[str]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _decodificar(self, imagen: Image.Image) -> Optional[str]:
+        codigos_encontrados = self.decodificador(imagen, symbols=[ZBarSymbol.QRCODE])
+        if codigos_encontrados:
+            return codigos_encontrados[0].data.decode("utf-8")
+        return None
+
+    def leer(self, fuente: FuenteDocumento, paginas: List[int] = [1]) -> Optional[str]:
+        """
+        Devuelve el contenido del primer QR encontrado en las páginas indicadas (1-indexadas) o None.
+        Lanza ValueError si el contenido no es un PDF válido (mismo contrato que convertir_pdf_a_imagenes).
+        """
+        hash_documento = fuente.hash_documento if isinstance(fuente, SesionDocumento) else calcular_hash_documento(fuente)
+        llave = (hash_documento, tuple(paginas))
+        with self._lock:
+            if llave in self._cache:
+                self._cache.move_to_end(llave)
+                return self._cache[llave]
+
+        contenido = None
+        try:
+            with abrir_sesion(fuente) as sesion:
+                for intentos, (etapa, imagen) in enumerate(iterar_candidatos(sesion, paginas), start=1):
+                    contenido = self._decodificar(imagen)
+                    if contenido:
+                        logger.info(f"QR encontrado en la etapa '{etapa}' (intento {intentos}).")
+                        break
+        except Exception as e:
+            raise ValueError(f"No se pudo procesar el archivo como PDF: {e}")
+
+        if contenido is None:
+            logger.error("No se encontró ningún código QR en las imágenes.")
+
+        with self._lock:
+            self._cache[llave] = contenido
+            while len(self._cache) > self.max_documentos:
+                self._cache.popitem(last=False)
+        return contenido
+
+    def limpiar(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+motor_qr = MotorQR()
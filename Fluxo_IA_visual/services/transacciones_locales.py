@@ -0,0 +1,235 @@
+# Motor local de transacciones: reconstruye las filas de los estados de cuenta digitales con las
+# coordenadas de las palabras y las columnas de cargos/abonos, sin llamar al LLM
+from ..utils.helpers_texto_fluxo import (
+    PLANTILLAS_TRANSACCIONES, TOLERANCIA_VERIFICACION_PORTADA, FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO, FECHA_SOLO_DIA
+)
+from ..utils.helpers import limpiar_monto
+from .montos_posicionales import MontosPagina, MONTO_REGEX, TIPOS_MONTO
+
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Tuple
+import logging
+import re
+
+logger = logging.getLogger(__name__)
+
+# Palabras cuyo centro vertical difiere menos que esto (pt) pertenecen al mismo renglón
+TOLERANCIA_RENGLON = 3.0
+# Un renglón sin monto solo continúa la descripción si está a menos de N alturas de renglón del anterior
+MAX_SALTO_CONTINUACION = 2.5
+MAX_RENGLONES_DESCRIPCION = 5
+# Las palabras a la izquierda de las columnas de montos (menos este margen) forman la descripción
+MARGEN_COLUMNAS = 5.0
+
+# Cualquier formato de fecha conocido; la plantilla del banco decide después cuál es válido
+FECHA_GENERICA = re.compile("|".join(f"(?:{p})" for p in (FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO, FECHA_SOLO_DIA)))
+# Sin el día suelto: un número al inicio de un renglón sin monto no abre ni cierra movimientos
+FECHA_COMPLETA = re.compile("|".join(f"(?:{p})" for p in (FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO)))
+
+@dataclass
+class FilaMovimiento:
+    """Un movimiento reconstruido: fecha, renglones de la descripción y el monto de su columna."""
+    fecha: str
+    lineas: List[str]
+    monto: float
+    tipo: str # "cargo" o "abono"
+
+    @property
+    def descripcion(self) -> str:
+        return " ".join(self.lineas)
+
+def _compilar(patrones: Optional[List[str]]) -> Optional[re.Pattern]:
+    return re.compile("|".join(f"(?:{p})" for p in patrones)) if patrones else None
+
+@dataclass(frozen=True)
+class PlantillaBanco:
+    """Formato de fecha y reglas TPV de un banco (ver PLANTILLAS_TRANSACCIONES)."""
+    fecha: re.Pattern
+    una_linea: Optional[re.Pattern] = None
+    primera_linea: Optional[re.Pattern] = None
+    demas_lineas: Optional[re.Pattern] = None
+
+    def es_tpv(self, fila: FilaMovimiento) -> bool:
+        # Las reglas están en minúsculas; la fila conserva el texto tal como viene en el PDF
+        if self.una_linea and self.una_linea.search(fila.descripcion.lower()):
+            return True
+        if self.primera_linea and self.demas_lineas and len(fila.lineas) > 1:
+            return bool(
+                self.primera_linea.search(fila.lineas[0].lower())
+                and self.demas_lineas.search(" ".join(fila.lineas[1:]).lower())
+            )
+        return False
+
+PLANTILLAS_COMPILADAS: Dict[str, PlantillaBanco] = {
+    banco: PlantillaBanco(
+        fecha=_compilar(config["fecha"]),
+        una_linea=_compilar(config.get("una_linea")),
+        primera_linea=_compilar(config.get("primera_linea")),
+        demas_lineas=_compilar(config.get("demas_lineas")),
+    )
+    for banco, config in PLANTILLAS_TRANSACCIONES.items()
+}
+
+def obtener_plantilla(banco: Optional[str]) -> Optional[PlantillaBanco]:
+    """Plantilla del banco o None si ese banco solo se puede extraer con el LLM."""
+    if not banco:
+        return None
+    return PLANTILLAS_COMPILADAS.get(banco.lower().strip())
+
+def _agrupar_renglones(words: List[Tuple]) -> Tuple[List[List[Tuple]], List[float]]:
+    """Agrupa las palabras en renglones visuales (por su centro vertical), cada uno ordenado por X."""
+    renglones: List[List[Tuple]] = []
+    centros: List[float] = []
+    for w in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        centro = (w[1] + w[3]) / 2
+        if renglones and centro - centros[-1] <= TOLERANCIA_RENGLON:
+            renglones[-1].append(w)
+        else:
+            renglones.append([w])
+            centros.append(centro)
+    return [sorted(renglon, key=lambda w: w[0]) for renglon in renglones], centros
+
+def _separar_fecha(textos: List[str], patron: re.Pattern = FECHA_GENERICA) -> Tuple[Optional[str], List[str]]:
+    """
+    Si el renglón empieza con una fecha (en una o dos palabras, p. ej. '01/ENE' o '1 ene') la separa
+    del resto. Una segunda fecha pegada (fecha de liquidación, como en BBVA) también se descarta.
+    """
+    for n in (2, 1):
+        candidato = " ".join(textos[:n])
+        if len(textos) >= n and patron.fullmatch(candidato.lower()):
+            resto = textos[n:]
+            for m in (2, 1):
+                if len(resto) >= m and FECHA_COMPLETA.fullmatch(" ".join(resto[:m]).lower()):
+                    resto = resto[m:]
+                    break
+            return candidato, resto
+    return None, textos
+
+def reconstruir_filas_pagina(words: List[Tuple], montos: MontosPagina) -> Optional[List[FilaMovimiento]]:
+    """
+    Reconstruye los movimientos de una página a partir de las palabras de fitz y de los montos
+    ya ubicados en columnas de cargos/abonos. Cada renglón con monto abre un movimiento (si no trae
+    fecha hereda la última de la página) y los renglones cercanos sin monto continúan su descripción.
+    Devuelve None si la página no se puede reconstruir con certeza:
+    - un renglón con más de un monto, o un monto sin fecha previa ni descripción;
+    - un monto con formato válido dentro de las columnas que no quedó clasificado.
+    """
+    if not montos:
+        return None
+
+    coords_montos = montos.coords.tolist()
+    montos_por_coords = {tuple(c): i for i, c in enumerate(coords_montos)}
+    limite_descripcion = min(c[0] for c in coords_montos) - MARGEN_COLUMNAS
+    columnas_min = min(c[0] for c in coords_montos)
+    columnas_max = max(c[2] for c in coords_montos)
+    lista_montos = montos.montos.tolist()
+    lista_tipos = montos.tipos.tolist()
+
+    renglones, centros = _agrupar_renglones(words)
+    alturas = sorted(w[3] - w[1] for w in words)
+    altura_renglon = alturas[len(alturas) // 2] if alturas else 10.0
+
+    filas: List[FilaMovimiento] = []
+    actual: Optional[FilaMovimiento] = None
+    ultima_fecha: Optional[str] = None
+    centro_anterior: Optional[float] = None
+
+    for renglon, centro in zip(renglones, centros):
+        indices = []
+        textos = []
+        for w in renglon:
+            indice = montos_por_coords.get(tuple(float(v) for v in w[:4]))
+            if indice is not None:
+                indices.append(indice)
+            elif w[2] <= limite_descripcion:
+                textos.append(w[4].strip())
+            elif columnas_min <= (w[0] + w[2]) / 2 <= columnas_max and MONTO_REGEX.fullmatch(w[4].strip()):
+                # Un monto en la zona de columnas que el extractor posicional no clasificó
+                return None
+        textos = [t for t in textos if t]
+
+        if len(indices) > 1:
+            return None
+
+        if indices:
+            fecha, resto = _separar_fecha(textos)
+            fecha = fecha or ultima_fecha
+            if fecha is None or not resto:
+                return None
+            actual = FilaMovimiento(
+                fecha=fecha, lineas=[" ".join(resto)], monto=lista_montos[indices[0]], tipo=TIPOS_MONTO[lista_tipos[indices[0]]]
+            )
+            filas.append(actual)
+            ultima_fecha = fecha
+        elif actual is not None and textos:
+            cerca = centro_anterior is not None and centro - centro_anterior <= MAX_SALTO_CONTINUACION * altura_renglon
+            fecha, _ = _separar_fecha(textos, FECHA_COMPLETA)
+            if cerca and fecha is None and len(actual.lineas) < MAX_RENGLONES_DESCRIPCION:
+                actual.lineas.append(" ".join(textos))
+            else:
+                actual = None
+        centro_anterior = centro
+
+    return filas if len(filas) == len(lista_montos) else None
+
+@dataclass
+class ResultadoLocal:
+    """Transacciones extraídas sin LLM y las páginas que se le tienen que mandar."""
+    transacciones: List[Dict[str, Any]] = field(default_factory=list)
+    paginas_locales: List[int] = field(default_factory=list)
+    paginas_pendientes: List[int] = field(default_factory=list)
+
+def _transacciones_de_filas(filas: Optional[List[FilaMovimiento]], plantilla: PlantillaBanco) -> Optional[List[Dict[str, Any]]]:
+    """
+    Filas -> transacciones con el formato de los agentes (parsear_linea_toon), o None si alguna no valida.
+    Texto con las mayúsculas del PDF y monto como '1,500.00', igual que las filas del LLM.
+    """
+    if not filas:
+        return None
+    transacciones = []
+    for fila in filas:
+        if not plantilla.fecha.fullmatch(fila.fecha.lower()):
+            return None
+        transacciones.append({
+            "fecha": fila.fecha,
+            "descripcion": fila.descripcion,
+            "monto": f"{fila.monto:,.2f}",
+            "tipo": fila.tipo,
+            "categoria": fila.tipo == "abono" and plantilla.es_tpv(fila)
+        })
+    return transacciones
+
+def extraer_transacciones_locales(
+    movimientos_por_pagina: Dict[int, MontosPagina],
+    banco: Optional[str],
+    depositos: Any = None
+) -> ResultadoLocal:
+    """
+    Extrae las transacciones de una cuenta con la plantilla de su banco, página por página.
+    Las páginas sin plantilla o que no validan quedan en 'paginas_pendientes' para el LLM.
+    Si todas salieron localmente y la portada trae 'depositos', la suma de abonos debe coincidir
+    (misma tolerancia que la verificación de portada); si no, toda la cuenta regresa al LLM.
+    """
+    paginas = sorted(p for p, m in movimientos_por_pagina.items() if m)
+    plantilla = obtener_plantilla(banco)
+    if plantilla is None:
+        return ResultadoLocal(paginas_pendientes=paginas)
+
+    resultado = ResultadoLocal()
+    for num_pagina in paginas:
+        transacciones = _transacciones_de_filas(getattr(movimientos_por_pagina[num_pagina], "filas", None), plantilla)
+        if transacciones is None:
+            resultado.paginas_pendientes.append(num_pagina)
+        else:
+            resultado.paginas_locales.append(num_pagina)
+            resultado.transacciones.extend(transacciones)
+
+    total_depositos = limpiar_monto(depositos)
+    if resultado.paginas_locales and not resultado.paginas_pendientes and total_depositos > 0:
+        total_abonos = sum(limpiar_monto(t["monto"]) for t in resultado.transacciones if t["tipo"] == "abono")
+        if abs(total_abonos - total_depositos) > TOLERANCIA_VERIFICACION_PORTADA * total_depositos:
+            logger.info(
+                f"Extracción local de {banco} descartada: abonos {total_abonos:,.2f} vs depósitos de portada {total_depositos:,.2f}."
+            )
+            return ResultadoLocal(paginas_pendientes=paginas)
+    return resultado
@@ -1,14 +1,54 @@
 import pytest
+import asyncio
 import re
+import time
+import shutil
+import os
+import sqlite3
+import fitz
 from fpdf import FPDF
 from datetime import datetime, timedelta
+from types import SimpleNamespace
 
 from Fluxo_IA_visual.models.responses import  AnalisisTPV
+from Fluxo_IA_visual.core.exceptions import PDFCifradoError, PoolWorkersCerradoError, OCRTiempoExcedidoError
+from Fluxo_IA_visual.services.ocr_engine import MotorOCR
+from Fluxo_IA_visual.services.image_cache import (
+    CacheImagenes, ImagenRenderizada, construir_data_url, renderizar_paginas_con_cache,
+    codificar_paginas_pdf, guardar_paginas_codificadas, paginas_sin_cache
+)
+from Fluxo_IA_visual.services.document_cache import (
+    CacheExtracciones, ExtraccionDocumento, SesionDocumento, abrir_sesion, cache_extracciones, calcular_hash_documento,
+    obtener_extraccion, iterar_paginas_extraidas, parsear_pagina
+)
+from Fluxo_IA_visual.services.montos_posicionales import MontosPagina, extraer_montos_pagina
+from Fluxo_IA_visual.services.transacciones_locales import extraer_transacciones_locales, reconstruir_filas_pagina
+from Fluxo_IA_visual.services.planificador_chunks import planificar_chunks
+from Fluxo_IA_visual.services.llm_clients import RegistroClientesLLM, CLIENTE_FLUXO, CLIENTE_NOMI, CLIENTE_OPENROUTER
+from Fluxo_IA_visual.services.llm_cache import CacheRespuestasLLM, calcular_llave
+from Fluxo_IA_visual.services.llm_governor import GobernadorLLM, LimitesProveedor, estimar_tokens, HOST, _arranque_proceso
+from Fluxo_IA_visual.services.llm_resiliencia import (
+    ContadoresJob, PoliticaReintentos, RegistroLatencias, ejecutar_con_cobertura, ejecutar_con_reintentos,
+    es_reintentable, job_actual, segundos_retry_after, transmitir_con_cobertura, transmitir_con_reintentos
+)
+from Fluxo_IA_visual.services.pool_workers import PoolWorkers
+from Fluxo_IA_visual.services.cola_trabajo import ColaTrabajo, EstadoUnidad, TIPO_CPU, TIPO_AGENTE_TPV
+from Fluxo_IA_visual import worker
+from Fluxo_IA_visual.services.job_store import (
+    EstadoJob, RegistroJobs, ETAPA_CHUNKS, ETAPA_DOCUMENTOS, EVENTO_CHUNK_TERMINADO, EVENTO_DOCUMENTOS_ACEPTADOS,
+    EVENTO_JOB_INICIADO, EVENTO_JOB_TERMINADO, EVENTO_CANCELACION_SOLICITADA
+)
+from Fluxo_IA_visual.services import ia_extractor
+from Fluxo_IA_visual.services.orchestators import (
+    _consumir_agentes, _error_chunks, _rasterizar_en_pool, _transmitir_agente_tpv, obtener_y_procesar_portada, recortar_rango
+)
+from Fluxo_IA_visual.services.perfiles_imagen import PERFIL_ORIGINAL, PerfilImagen, codificar_pagina, medir_perfiles, obtener_perfil
 
 from Fluxo_IA_visual.utils.helpers import ( # debemos hacer más test para este módulo
     construir_descripcion_optimizado, limpiar_monto, extraer_json_del_markdown, extraer_unico, extraer_datos_por_banco, sumar_lista_montos, es_escaneado_o_no,
     reconciliar_resultados_ia, sanitizar_datos_ia, total_depositos_verificacion, limpiar_y_normalizar_texto, crear_objeto_resultado, verificar_fecha_comprobante,
-    aplicar_reglas_de_negocio, detectar_tipo_contribuyente
+    aplicar_reglas_de_negocio, detectar_tipo_contribuyente, crear_prompt_campos_faltantes, campos_vacios, hay_desacuerdo_con_regex,
+    parsear_respuesta_toon, ParserToonIncremental, clasificar_transaccion, ConsolidadorTransacciones
 )
 
 pytest_plugins = ('pytest_asyncio',)
@@ -234,6 +274,92 @@ def test_sanitizar_datos_float(monkeypatch):
     assert resultado["saldo"] == 99.9
     assert resultado["depositos"] == 99.9  # incluso None pasa por limpiar_monto
 
+# ---- Pruebas para la portada adaptativa (campos faltantes y verificación contra regex) ----
+def test_crear_prompt_campos_faltantes_lista_solo_los_campos_pedidos():
+    prompt = crear_prompt_campos_faltantes("PROMPT BASE", ["nombre_cliente", "depositos"])
+
+    assert prompt.startswith("PROMPT BASE")
+    assert "ÚNICAMENTE estos campos: nombre_cliente, depositos." in prompt
+
+def test_campos_vacios_detecta_null_ausentes_y_cadenas_vacias():
+    datos = {"nombre_cliente": "JUAN", "clabe_interbancaria": " ", "periodo_inicio": None, "cargos": 0.0}
+
+    assert campos_vacios(datos, ["nombre_cliente", "clabe_interbancaria", "periodo_inicio", "periodo_fin", "cargos"]) == [
+        "clabe_interbancaria", "periodo_inicio", "periodo_fin"
+    ]
+
+@pytest.mark.parametrize("datos_ia, esperado", [
+    ({"depositos": "$100,500.00"}, False),   # Dentro del 1%
+    ({"depositos": 150000.0}, True),         # Monto distinto
+    ({"depositos": None}, False),            # Sin dato no hay desacuerdo (lo detecta campos_vacios)
+    ({"banco": "banorte"}, False),           # Texto igual sin importar mayúsculas
+    ({"banco": "BBVA"}, True),
+])
+def test_hay_desacuerdo_con_regex(datos_ia, esperado):
+    datos_regex = {"banco": "BANORTE", "depositos": 100000.0}
+
+    assert hay_desacuerdo_con_regex(datos_ia, datos_regex, ["banco", "depositos"]) is esperado
+
+# ---- Pruebas para el parseo TOON en streaming y la consolidación de transacciones ----
+RESPUESTA_TOON = "```\n01/01|VENTAS TPV|1,500.00|abono|TPV\n02/01|DEPOSITO EFECTIVO|200.00|abono|GENERAL\n03/01|COMISION|15.00|cargo|GENERAL\n```"
+
+@pytest.mark.parametrize("tamano_fragmento", [1, 3, 7, 1000])
+def test_parser_toon_incremental_coincide_con_el_parser_completo(tamano_fragmento):
+    parser = ParserToonIncremental()
+    transacciones = []
+    for i in range(0, len(RESPUESTA_TOON), tamano_fragmento):
+        transacciones.extend(parser.alimentar(RESPUESTA_TOON[i:i + tamano_fragmento]))
+    transacciones.extend(parser.terminar())
+
+    assert transacciones == parsear_respuesta_toon(RESPUESTA_TOON)
+    assert parser.total_transacciones == 3
+    assert not parser.sin_datos
+
+def test_parser_toon_incremental_entrega_cada_linea_al_completarse():
+    parser = ParserToonIncremental()
+
+    assert parser.alimentar("01/01|VENTAS TPV|1,500.00|abo") == []
+    assert len(parser.alimentar("no|TPV\n02/01|")) == 1
+
+def test_parser_toon_incremental_detecta_sin_datos_antes_del_fin():
+    parser = ParserToonIncremental()
+    parser.alimentar("SIN_DA")
+    parser.alimentar("TOS")
+
+    assert parser.sin_datos
+    assert parser.alimentar("\n01/01|VENTAS|10.00|abono|TPV\n") == []
+
+def test_parser_toon_incremental_ignora_sin_datos_tras_transacciones():
+    parser = ParserToonIncremental()
+    transacciones = parser.alimentar("01/01|VENTAS TPV|1,500.00|abono|TPV\nSIN_DATOS\n")
+
+    assert len(transacciones) == 1
+    assert not parser.sin_datos
+
+def test_clasificar_transaccion_tipo_exacto_y_flexible():
+    trx = {"fecha": "01/01", "descripcion": "DEPOSITO EFECTIVO", "monto": "1,000.00", "tipo": "Depósito"}
+
+    procesada, monto = clasificar_transaccion(trx)
+    assert (procesada["categoria"], monto) == ("GENERAL", 1000.0)
+
+    procesada, monto = clasificar_transaccion(trx, tipo_flexible=True)
+    assert (procesada["categoria"], procesada["monto"]) == ("EFECTIVO", "1,000.00")
+
+def test_consolidador_respeta_el_orden_de_los_chunks_aunque_lleguen_desordenados():
+    tpv = {"fecha": "01/01", "descripcion": "VENTAS TPV", "monto": 100.0, "tipo": "abono", "categoria": True}
+    efectivo = {"fecha": "02/01", "descripcion": "DEPOSITO EFECTIVO", "monto": 50.0, "tipo": "abono"}
+    consolidador = ConsolidadorTransacciones()
+
+    # El chunk 1 (superpuesto) llega antes que el chunk 0
+    assert consolidador.agregar((1, 0), efectivo)
+    assert consolidador.agregar((0, 0), tpv)
+    assert not consolidador.agregar((0, 1), efectivo)  # Duplicado: se queda con la posición menor
+
+    assert len(consolidador) == 2
+    assert [trx["categoria"] for trx in consolidador.transacciones()] == ["TPV", "EFECTIVO"]
+    totales = consolidador.totales()
+    assert (totales["entradas_TPV_bruto"], totales["depositos_en_efectivo"]) == (100.0, 50.0)
+
 # ---- Pruebas para total_depositos_verificacion ----
 def test_total_depositos_normal():
     resultados = [
@@ -659,6 +785,92 @@ def test_detectar_contribuyente_desconocido():
     assert detectar_tipo_contribuyente(texto) == "desconocido"
 
 # ---- Pruebas para services/orchestators.py ----
+def test_recortar_rango_solo_deja_las_paginas_de_la_cuenta():
+    por_pagina = {1: "a", 2: "b", 3: "c", 5: "e"}
+
+    assert recortar_rango(por_pagina, (2, 5)) == {2: "b", 3: "c", 5: "e"}
+    assert recortar_rango(por_pagina, (6, 8)) == {}
+
+@pytest.mark.asyncio
+async def test_obtener_y_procesar_portada_avisa_cada_cuenta_digital(fake_pdf, monkeypatch):
+    """Con el aviso, cada cuenta digital se entrega con su portada y solo las páginas de su rango."""
+    async def portada_falsa(prompt, sesion, inicio, fin, texto_por_pagina):
+        return {"banco": "banregio", "inicio": inicio}
+    monkeypatch.setattr("Fluxo_IA_visual.services.orchestators._analizar_rango_portada", portada_falsa)
+    monkeypatch.setattr("Fluxo_IA_visual.services.orchestators.es_escaneado_o_no", lambda texto: True)
+    avisos = []
+
+    resultado = await obtener_y_procesar_portada(
+        "prompt", bytes(fake_pdf), lambda indice, datos, rango, texto, movimientos: avisos.append((indice, datos, rango, sorted(texto)))
+    )
+
+    assert resultado[0] == [{"banco": "banregio", "inicio": 1}]
+    assert avisos == [(0, {"banco": "banregio", "inicio": 1}, (1, 2), [1, 2])]
+
+@pytest.mark.asyncio
+async def test_rasterizar_en_pool_deja_las_paginas_en_la_cache(fake_pdf, monkeypatch):
+    pool = PoolWorkers(max_workers=1)
+    monkeypatch.setattr("Fluxo_IA_visual.services.cola_trabajo.pool_workers", pool)
+    cache = CacheImagenes()
+    monkeypatch.setattr("Fluxo_IA_visual.services.orchestators.cache_imagenes", cache)
+
+    try:
+        with SesionDocumento(bytes(fake_pdf)) as sesion:
+            imagenes = await _rasterizar_en_pool(sesion, [1, 2], PERFIL_ORIGINAL)
+            assert sorted(imagenes) == [1, 2]
+            assert paginas_sin_cache(cache, sesion.hash_documento, [1, 2], PERFIL_ORIGINAL) == []
+            # Ya rasterizadas: no se vuelven a mandar al pool
+            assert await _rasterizar_en_pool(sesion, [1, 2], PERFIL_ORIGINAL) == {}
+    finally:
+        await asyncio.to_thread(pool.cerrar, 5)
+
+@pytest.mark.asyncio
+async def test_consumir_agentes_cuenta_las_transacciones_una_vez_por_chunk(monkeypatch):
+    llamadas = []
+    monkeypatch.setattr(
+        "Fluxo_IA_visual.services.orchestators.contadores_job.incrementar",
+        lambda evento, cantidad=1, job_id=None: llamadas.append((evento, cantidad))
+    )
+
+    async def agente(*lotes):
+        for lote in lotes:
+            yield lote
+
+    trx = lambda dia: {"fecha": f"0{dia}/01", "descripcion": "VENTAS TPV", "monto": 100.0, "tipo": "abono"}
+    consolidador = ConsolidadorTransacciones()
+    await _consumir_agentes(
+        [agente([trx(1)], [trx(2), trx(3)]), agente([trx(3)], [trx(4)])], consolidador, [[1, 2], [2, 3]]
+    )
+
+    assert len(consolidador) == 4
+    # Una escritura por chunk (no por lote) y las repetidas entre chunks no se cuentan dos veces
+    assert len(llamadas) == 2
+    assert sum(cantidad for _, cantidad in llamadas) == 4
+
+@pytest.mark.asyncio
+async def test_consumir_agentes_reporta_el_chunk_que_fallo_tras_agotar_reintentos(monkeypatch):
+    llamadas = []
+    monkeypatch.setattr(
+        "Fluxo_IA_visual.services.orchestators.contadores_job.incrementar",
+        lambda evento, cantidad=1, job_id=None: llamadas.append((evento, cantidad))
+    )
+
+    async def respuesta_cortada():
+        # El modelo alcanza a mandar una línea y luego el stream muere (reintentos y cobertura agotados)
+        yield "01/01|VENTAS TPV|1,500.00|abono|TPV\n"
+        raise _error_http(503)
+
+    consolidador = ConsolidadorTransacciones()
+    errores = await _consumir_agentes(
+        [ia_extractor._transmitir_transacciones("Agente TPV", respuesta_cortada())], consolidador, [[3, 4]]
+    )
+
+    assert len(consolidador) == 1  # Lo que llegó antes del error se conserva
+    assert len(errores) == 1 and errores[0].startswith("págs 3-4: APIStatusError")
+    assert ("chunks_fallidos", 1) in llamadas
+    assert _error_chunks(errores, 2).startswith("1 de 2 fragmentos fallaron")
+    assert _error_chunks([], 2) is None
+
 # --- Fixture para crear un PDF falso pero válido en memoria ---
 @pytest.fixture
 def fake_pdf():
@@ -692,6 +904,1155 @@ def small_fake_pdf():
     # Devolvemos el contenido del PDF como bytes
     return pdf.output()
 
+# ---- Pruebas para services/document_cache.py ----
+def test_obtener_extraccion_parsea_una_sola_vez(fake_pdf):
+    """La segunda llamada con el mismo contenido debe salir de la cache."""
+    cache_extracciones.limpiar()
+    pdf_bytes = bytes(fake_pdf)
+
+    primera = obtener_extraccion(pdf_bytes)
+    segunda = obtener_extraccion(pdf_bytes)
+
+    assert primera is segunda
+    assert primera.total_paginas == 2
+    assert primera.hash_documento == calcular_hash_documento(pdf_bytes)
+    assert "banregio" in primera.texto_por_pagina[1]
+    assert primera.palabras_por_pagina[1][0][4] == "Estado"
+
+def test_extraccion_texto_ordenado_limita_paginas(fake_pdf):
+    extraccion = obtener_extraccion(bytes(fake_pdf))
+
+    solo_primera = extraccion.texto_ordenado(num_paginas=1)
+    completo = extraccion.texto_ordenado()
+
+    assert "banregio" in solo_primera
+    assert "página 2" not in solo_primera
+    assert "página 2" in completo
+    assert completo == completo.lower()
+
+def test_parsear_pagina_coincide_con_get_text_sin_textpage():
+    """El TextPage compartido no debe cambiar espacios ni tabuladores respecto a las llamadas sueltas."""
+    documento = fitz.open()
+    pagina = documento.new_page()
+    pagina.insert_text((50, 72), "03/01 office\tDEPOSITOS    1,500.00")
+    pagina.insert_text((50, 100), "04/01 VENTAS TPV\t\t200.00")
+
+    texto, palabras, texto_ordenado = parsear_pagina(pagina)
+
+    assert texto == pagina.get_text("text").lower()
+    assert palabras == pagina.get_text("words")
+    assert texto_ordenado == pagina.get_text("text", sort=True).lower()
+    assert "\ufffd" not in texto
+    documento.close()
+
+def test_cache_extracciones_expulsa_la_menos_usada():
+    cache = CacheExtracciones(max_documentos=2)
+    for llave in ("a", "b", "c"):
+        cache.guardar(ExtraccionDocumento(hash_documento=llave, total_paginas=1))
+
+    assert len(cache) == 2
+    assert cache.obtener("a") is None
+    assert cache.obtener("c") is not None
+
+def test_iterar_paginas_extraidas_entrega_en_orden_y_llena_cache(fake_pdf):
+    """El recorrido en streaming entrega página por página y deja el documento en cache."""
+    cache_extracciones.limpiar()
+    pdf_bytes = bytes(fake_pdf)
+
+    paginas = [(num, total, texto) for num, total, texto, _ in iterar_paginas_extraidas(pdf_bytes)]
+
+    assert [num for num, _, _ in paginas] == [1, 2]
+    assert all(total == 2 for _, total, _ in paginas)
+    assert "banregio" in paginas[0][2]
+    assert len(cache_extracciones) == 1
+    assert list(iterar_paginas_extraidas(pdf_bytes))[1][2] == paginas[1][2]
+
+def test_obtener_extraccion_pdf_cifrado():
+    """Un PDF con contraseña debe lanzar PDFCifradoError."""
+    doc = fitz.open()
+    doc.new_page()
+    pdf_cifrado = doc.tobytes(encryption=fitz.PDF_ENCRYPT_AES_256, owner_pw="dueño", user_pw="usuario")
+
+    with pytest.raises(PDFCifradoError):
+        obtener_extraccion(pdf_cifrado)
+
+# ---- Pruebas para services/image_cache.py ----
+def test_sesion_documento_parsea_solo_lo_pedido_y_cierra(fake_pdf):
+    cache_extracciones.limpiar()
+    with SesionDocumento(bytes(fake_pdf)) as sesion:
+        assert sesion.total_paginas == 2
+        assert "banregio" in sesion.texto_ordenado(num_paginas=1)
+        assert list(sesion._paginas) == [1]  # la página 2 no se parseó
+        assert sesion.palabras_pagina(1)[0][4] == "Estado"
+
+    assert sesion.cerrada
+    with pytest.raises(ValueError):
+        sesion.codificar_pagina(1)
+
+def test_abrir_sesion_reutiliza_sin_cerrar(fake_pdf):
+    with SesionDocumento(bytes(fake_pdf)) as sesion:
+        with abrir_sesion(sesion) as misma:
+            assert misma is sesion
+        assert not sesion.cerrada
+
+    with abrir_sesion(bytes(fake_pdf)) as temporal:
+        assert temporal.total_paginas == 2
+    assert temporal.cerrada
+
+def test_sesion_documento_compartida_entre_hilos(fake_pdf):
+    """Varios hilos renderizando de la misma sesión obtienen el mismo resultado que en serie."""
+    from concurrent.futures import ThreadPoolExecutor
+
+    with SesionDocumento(bytes(fake_pdf)) as sesion:
+        esperado = [sesion.codificar_pagina(p) for p in (1, 2)]
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            resultados = list(executor.map(sesion.codificar_pagina, [1, 2] * 4))
+
+    assert resultados == esperado * 4
+
+def test_renderizar_paginas_con_cache_reutiliza_imagenes(fake_pdf):
+    """La misma página pedida dos veces solo se renderiza una vez."""
+    cache = CacheImagenes(max_bytes=50 * 1024 * 1024)
+    pdf_bytes = bytes(fake_pdf)
+
+    primeras = renderizar_paginas_con_cache(cache, pdf_bytes, [1, 2])
+    segundas = renderizar_paginas_con_cache(cache, pdf_bytes, [2, 1, 9])  # 9 está fuera de rango
+
+    assert len(primeras) == 2
+    assert [img.data_url for img in segundas] == [primeras[1].data_url, primeras[0].data_url]
+    assert primeras[0].data_url.startswith("data:image/png;base64,")
+    estadisticas = cache.estadisticas()
+    assert estadisticas["aciertos"] == 2
+    assert estadisticas["entradas"] == 2
+
+def test_cache_imagenes_respeta_presupuesto_de_bytes():
+    imagen = ImagenRenderizada(contenido=b"x" * 60, data_url="d" * 40)  # 100 bytes
+    cache = CacheImagenes(max_bytes=250)
+
+    for pagina in range(1, 4):
+        cache.guardar(("hash", pagina, 2, "png"), imagen)
+
+    estadisticas = cache.estadisticas()
+    assert estadisticas["bytes"] <= 250
+    assert estadisticas["expulsiones"] == 1
+    assert cache.obtener(("hash", 1, 2, "png")) is None
+    assert cache.obtener(("hash", 3, 2, "png")) is imagen
+
+def test_cache_imagenes_descarta_las_paginas_de_un_documento():
+    imagen = ImagenRenderizada(contenido=b"x" * 60, data_url="d" * 40)  # 100 bytes
+    cache = CacheImagenes()
+    cache.guardar(("doc-a", 1, PERFIL_ORIGINAL), imagen)
+    cache.guardar(("doc-a", 2, PERFIL_ORIGINAL), imagen)
+    cache.guardar(("doc-b", 1, PERFIL_ORIGINAL), imagen)
+
+    assert cache.descartar_documento("doc-a") == 200
+    assert cache.estadisticas()["bytes"] == 100
+    assert cache.obtener(("doc-a", 1, PERFIL_ORIGINAL)) is None
+    assert cache.obtener(("doc-b", 1, PERFIL_ORIGINAL)) is imagen
+
+def test_cache_imagenes_no_descarta_un_documento_que_otro_job_usa():
+    imagen = ImagenRenderizada(contenido=b"x" * 60, data_url="d" * 40)  # 100 bytes
+    cache = CacheImagenes()
+    cache.guardar(("doc-a", 1, PERFIL_ORIGINAL), imagen)
+    cache.reservar_documento("doc-a")  # job cancelado
+    cache.reservar_documento("doc-a")  # otro job con el mismo PDF
+
+    assert cache.descartar_documento("doc-a", reservas_propias=1) == 0
+    assert cache.obtener(("doc-a", 1, PERFIL_ORIGINAL)) is imagen
+
+    # Cuando el otro job suelta el documento, el cancelado ya puede liberarlo
+    cache.soltar_documento("doc-a")
+    assert cache.descartar_documento("doc-a", reservas_propias=1) == 100
+    assert cache.obtener(("doc-a", 1, PERFIL_ORIGINAL)) is None
+
+def test_paginas_sin_cache_no_altera_estadisticas_ni_orden_lru():
+    imagen = ImagenRenderizada(contenido=b"x" * 60, data_url="d" * 40)  # 100 bytes
+    cache = CacheImagenes(max_bytes=200)
+    cache.guardar(("doc", 1, PERFIL_ORIGINAL), imagen)
+    cache.guardar(("doc", 2, PERFIL_ORIGINAL), imagen)
+
+    assert paginas_sin_cache(cache, "doc", [1, 2, 3], PERFIL_ORIGINAL) == [3]
+    assert (cache.estadisticas()["aciertos"], cache.estadisticas()["fallos"]) == (0, 0)
+
+    # La página 1 sigue siendo la menos usada: es la que se expulsa
+    cache.guardar(("doc", 3, PERFIL_ORIGINAL), imagen)
+    assert not cache.contiene(("doc", 1, PERFIL_ORIGINAL))
+    assert cache.contiene(("doc", 2, PERFIL_ORIGINAL))
+
+def test_construir_data_url_usa_mime_del_formato():
+    assert construir_data_url(b"abc", "jpeg").startswith("data:image/jpeg;base64,")
+    assert construir_data_url(b"abc", "webp") == "data:image/webp;base64,YWJj"
+
+def test_renderizar_paginas_con_cache_separa_por_perfil(fake_pdf):
+    """La misma página con dos perfiles distintos son dos entradas distintas en la cache."""
+    cache = CacheImagenes()
+    pdf_bytes = bytes(fake_pdf)
+
+    png = renderizar_paginas_con_cache(cache, pdf_bytes, [1])[0]
+    jpeg = renderizar_paginas_con_cache(cache, pdf_bytes, [1], PerfilImagen(nombre="prueba", formato="jpeg", modo="gris"))[0]
+
+    assert png.data_url.startswith("data:image/png;base64,")
+    assert jpeg.data_url.startswith("data:image/jpeg;base64,")
+    assert cache.estadisticas()["entradas"] == 2
+
+def test_paginas_codificadas_en_otro_proceso_llenan_la_cache(fake_pdf):
+    """Lo que rasteriza el pool de procesos se guarda en la cache y ya no se vuelve a renderizar."""
+    cache = CacheImagenes()
+    pdf_bytes = bytes(fake_pdf)
+    hash_documento = calcular_hash_documento(pdf_bytes)
+
+    imagenes = codificar_paginas_pdf(pdf_bytes, [1, 2, 9], PERFIL_ORIGINAL)  # 9 está fuera de rango
+    guardar_paginas_codificadas(cache, hash_documento, PERFIL_ORIGINAL, imagenes)
+
+    assert sorted(imagenes) == [1, 2]
+    assert paginas_sin_cache(cache, hash_documento, [1, 2, 3], PERFIL_ORIGINAL) == [3]
+    assert renderizar_paginas_con_cache(cache, pdf_bytes, [1])[0].contenido == imagenes[1]
+
+# ---- Pruebas para services/perfiles_imagen.py ----
+@pytest.mark.parametrize("perfil, formato_pil, modo_pil", [
+    (PerfilImagen(nombre="a", formato="png", modo="color"), "PNG", "RGB"),
+    (PerfilImagen(nombre="b", formato="jpeg", modo="gris", calidad=70), "JPEG", "L"),
+    (PerfilImagen(nombre="c", formato="png", modo="bilevel"), "PNG", "1"),
+    (PerfilImagen(nombre="d", formato="webp", modo="gris"), "WEBP", "RGB"),  # WebP no tiene modo gris nativo
+])
+def test_codificar_pagina_respeta_perfil(fake_pdf, perfil, formato_pil, modo_pil):
+    from io import BytesIO
+    from PIL import Image
+
+    with fitz.open(stream=bytes(fake_pdf), filetype="pdf") as doc:
+        contenido = codificar_pagina(doc.load_page(0), perfil)
+        ancho_esperado = int(doc.load_page(0).rect.width * perfil.escala)
+
+    imagen = Image.open(BytesIO(contenido))
+    assert imagen.format == formato_pil
+    assert imagen.mode == modo_pil
+    assert abs(imagen.width - ancho_esperado) <= 1
+
+def test_perfil_imagen_invalido():
+    with pytest.raises(ValueError):
+        PerfilImagen(nombre="malo", formato="gif")
+    with pytest.raises(ValueError):
+        obtener_perfil("no_existe")
+
+def test_medir_perfiles_reporta_bytes_y_tiempo(fake_pdf):
+    filas = medir_perfiles(bytes(fake_pdf), perfiles=[obtener_perfil("original"), obtener_perfil("bilevel")])
+
+    assert [f["perfil"] for f in filas] == ["original", "bilevel"]
+    assert all(f["paginas"] == 2 and f["bytes_base64"] > f["bytes_imagen"] > 0 for f in filas)
+    # Texto negro sobre blanco: la versión binarizada debe pesar mucho menos que el PNG a color
+    assert filas[1]["bytes_base64"] < filas[0]["bytes_base64"]
+
+# ---- Pruebas para services/ocr_engine.py ----
+requiere_tesseract = pytest.mark.skipif(shutil.which("tesseract") is None, reason="Tesseract no está instalado")
+
+def _pdf_paginas_ocr(textos):
+    pdf = FPDF()
+    pdf.set_font("helvetica", size=36)
+    for texto in textos:
+        pdf.add_page()
+        pdf.cell(0, 30, text=texto)
+    return bytes(pdf.output())
+
+@requiere_tesseract
+def test_motor_ocr_devuelve_las_paginas_en_orden_y_reutiliza_el_pool():
+    motor = MotorOCR(max_workers=2)
+    try:
+        paginas = list(motor.iterar_paginas(_pdf_paginas_ocr(["ALFA", "BRAVO", "CHARLIE"]), dpi=100))
+        assert [num for num, _ in paginas] == [1, 2, 3]
+        assert "alfa" in paginas[0][1] and "bravo" in paginas[1][1] and "charlie" in paginas[2][1]
+
+        executor = motor._executor
+        list(motor.iterar_paginas(_pdf_paginas_ocr(["DELTA"]), dpi=100))
+        assert motor._executor is executor  # La segunda llamada no crea otro pool
+    finally:
+        motor.cerrar()
+
+@requiere_tesseract
+def test_motor_ocr_cancela_las_paginas_al_vencer_el_limite():
+    motor = MotorOCR(max_workers=1)
+    try:
+        with pytest.raises(OCRTiempoExcedidoError):
+            list(motor.iterar_paginas(_pdf_paginas_ocr(["PAGINA"] * 6), dpi=300, tiempo_limite=0.001))
+        # El pool sigue vivo para la siguiente llamada
+        assert [num for num, _ in motor.iterar_paginas(_pdf_paginas_ocr(["ECO"]), dpi=100)] == [1]
+    finally:
+        motor.cerrar()
+
+@requiere_tesseract
+def test_motor_ocr_el_timeout_de_un_documento_no_rompe_el_ocr_de_otro():
+    from concurrent.futures import ThreadPoolExecutor
+
+    motor = MotorOCR(max_workers=2)
+    try:
+        executor = motor._obtener_executor()
+        with ThreadPoolExecutor(max_workers=2) as hilos:
+            sin_limite = hilos.submit(
+                lambda: list(motor.iterar_paginas(_pdf_paginas_ocr(["ALFA", "BRAVO", "CHARLIE", "DELTA"]), dpi=200))
+            )
+            time.sleep(0.2)  # Que el primer documento ya tenga páginas en los workers
+            con_limite = hilos.submit(
+                lambda: list(motor.iterar_paginas(_pdf_paginas_ocr(["PAGINA"] * 6), dpi=300, tiempo_limite=0.001))
+            )
+            with pytest.raises(OCRTiempoExcedidoError):
+                con_limite.result()
+            paginas = sin_limite.result()
+
+        assert [num for num, _ in paginas] == [1, 2, 3, 4]
+        assert "alfa" in paginas[0][1] and "delta" in paginas[3][1]
+        assert motor._executor is executor
+    finally:
+        motor.cerrar()
+
+# ---- Pruebas para services/qr_engine.py ----
+# qr_engine importa pyzbar (requiere libzbar del sistema), por eso se importa dentro de cada prueba
+# y se omite la prueba si la librería no está instalada
+class _CodigoFalso:
+    def __init__(self, data):
+        self.data = data
+
+def _pdf_con_imagen_incrustada():
+    from io import BytesIO
+    from PIL import Image
+
+    doc = fitz.open()
+    pagina = doc.new_page()
+    pagina.insert_text((72, 72), "Recibo de nomina")
+    buffer = BytesIO()
+    Image.new("L", (120, 120), 0).save(buffer, format="PNG")
+    pagina.insert_image(fitz.Rect(40, 650, 160, 770), stream=buffer.getvalue())
+    return doc.tobytes()
+
+def test_motor_qr_prueba_primero_imagenes_incrustadas():
+    pytest.importorskip("pyzbar.pyzbar", exc_type=ImportError)
+    from Fluxo_IA_visual.services.qr_engine import MotorQR
+
+    llamadas = []
+    def decodificador(imagen, symbols=None):
+        llamadas.append(imagen.size)
+        return [_CodigoFalso(b"https://verificacfdi.facturaelectronica.sat.gob.mx/?id=1")]
+
+    motor = MotorQR(decodificador=decodificador)
+    pdf_bytes = _pdf_con_imagen_incrustada()
+
+    assert motor.leer(pdf_bytes).startswith("https://verificacfdi")
+    # Un solo intento: la imagen incrustada (ampliada y con margen), sin rasterizar la página
+    assert len(llamadas) == 1
+    assert llamadas[0][0] < 600
+
+def test_motor_qr_cachea_resultado_negativo(fake_pdf):
+    pytest.importorskip("pyzbar.pyzbar", exc_type=ImportError)
+    from Fluxo_IA_visual.services.qr_engine import ESQUINAS, MotorQR, NIVELES_PIRAMIDE
+
+    llamadas = []
+    def decodificador(imagen, symbols=None):
+        llamadas.append(imagen.size)
+        return []
+
+    motor = MotorQR(decodificador=decodificador)
+    pdf_bytes = bytes(fake_pdf)
+
+    assert motor.leer(pdf_bytes, [1]) is None
+    intentos = len(ESQUINAS) + len(NIVELES_PIRAMIDE) + 1
+    assert len(llamadas) == intentos
+    # El último intento es la página completa, el más grande de todos
+    assert llamadas[-1] == max(llamadas)
+
+    assert motor.leer(pdf_bytes, [1]) is None
+    assert len(llamadas) == intentos
+
+def test_motor_qr_pdf_invalido():
+    pytest.importorskip("pyzbar.pyzbar", exc_type=ImportError)
+    from Fluxo_IA_visual.services.qr_engine import MotorQR
+
+    with pytest.raises(ValueError):
+        MotorQR(decodificador=lambda imagen, symbols=None: []).leer(b"no es un pdf")
+
+# ---- Pruebas para services/montos_posicionales.py ----
+def _palabra(x_centro, y, texto):
+    """Simula una tupla de page.get_text("words") de fitz."""
+    return (x_centro - 10, y, x_centro + 10, y + 8, texto, 0, 0, 0)
+
+def test_extraer_montos_pagina_vincula_columnas_con_encabezados():
+    words = [_palabra(100, 10, "Cargos"), _palabra(300, 10, "Abonos:")]
+    for i in range(3):
+        words.append(_palabra(100 + i, 20 + i * 10, f"1,00{i}.50"))
+        words.append(_palabra(300 - i, 20 + i * 10, f"20{i}.00"))
+    # Columna sin encabezado y columna con menos de 3 montos se descartan
+    words += [_palabra(500, 20 + i * 10, "9.99") for i in range(3)]
+    words += [_palabra(200, 20, "7.00")]
+
+    resultado = extraer_montos_pagina(words)
+
+    assert isinstance(resultado, MontosPagina)
+    assert len(resultado) == 6
+    movimientos = resultado.a_lista()
+    assert [m["tipo"] for m in movimientos] == ["cargo"] * 3 + ["abono"] * 3
+    assert movimientos[0]["monto"] == 1000.50
+    assert movimientos[0]["coords"] == (90, 20, 110, 28)
+
+def test_extraer_montos_pagina_sin_encabezados_es_vacio():
+    words = [_palabra(100, 20 + i * 10, "10.00") for i in range(5)]
+
+    resultado = extraer_montos_pagina(words)
+
+    assert not resultado
+    assert resultado.a_lista() == []
+
+# ---- Pruebas para services/transacciones_locales.py ----
+def _pagina_estado_cuenta(filas_extra=()):
+    """Página con encabezados de cargos/abonos, descripción a la izquierda y una descripción de dos renglones."""
+    words = [_palabra(40, 10, "Fecha"), _palabra(120, 10, "Concepto"), _palabra(300, 10, "Cargos"), _palabra(400, 10, "Abonos")]
+    words += [_palabra(40, 30, "01/ENE"), _palabra(100, 30, "VENTA"), _palabra(130, 30, "TARJETAS"), _palabra(400, 30, "1,500.00")]
+    words += [_palabra(100, 40, "REF"), _palabra(130, 40, "123")]
+    words += [_palabra(40, 50, "02/ENE"), _palabra(100, 50, "COMISION"), _palabra(300, 50, "15.00")]
+    words += [_palabra(100, 60, "SPEI"), _palabra(400, 60, "200.00")] # Misma fecha que el renglón anterior
+    words += [_palabra(40, 70, "03/ENE"), _palabra(100, 70, "CHEQUE"), _palabra(300, 70, "300.00")]
+    words += [_palabra(40, 80, "04/ENE"), _palabra(100, 80, "DEPOSITO"), _palabra(400, 80, "50.00")]
+    words += [_palabra(40, 90, "05/ENE"), _palabra(100, 90, "RETIRO"), _palabra(300, 90, "20.00")]
+    words += list(filas_extra)
+    return words
+
+def test_reconstruir_filas_pagina_arma_movimientos_completos():
+    words = _pagina_estado_cuenta()
+
+    filas = reconstruir_filas_pagina(words, extraer_montos_pagina(words))
+
+    assert [(f.fecha, f.descripcion, f.monto, f.tipo) for f in filas] == [
+        ("01/ENE", "VENTA TARJETAS REF 123", 1500.0, "abono"),
+        ("02/ENE", "COMISION", 15.0, "cargo"),
+        ("02/ENE", "SPEI", 200.0, "abono"),
+        ("03/ENE", "CHEQUE", 300.0, "cargo"),
+        ("04/ENE", "DEPOSITO", 50.0, "abono"),
+        ("05/ENE", "RETIRO", 20.0, "cargo"),
+    ]
+
+def test_reconstruir_filas_pagina_falla_con_montos_sin_clasificar():
+    # Un monto en la zona de columnas que no quedó en ninguna columna válida
+    words = _pagina_estado_cuenta([_palabra(350, 100, "99.00")])
+
+    assert reconstruir_filas_pagina(words, extraer_montos_pagina(words)) is None
+
+def test_extraer_transacciones_locales_con_plantilla_y_sin_ella():
+    words = _pagina_estado_cuenta()
+    montos = extraer_montos_pagina(words)
+    montos.filas = reconstruir_filas_pagina(words, montos)
+    movimientos = {1: MontosPagina.vacio(), 2: montos}
+
+    resultado = extraer_transacciones_locales(movimientos, "BBVA", depositos=1750.0)
+    assert resultado.paginas_locales == [2] and resultado.paginas_pendientes == []
+    assert resultado.transacciones[0] == {
+        "fecha": "01/ENE", "descripcion": "VENTA TARJETAS REF 123", "monto": "1,500.00", "tipo": "abono", "categoria": True
+    }
+    assert [t["categoria"] for t in resultado.transacciones[1:]] == [False] * 5
+
+    # La misma fila contada por el LLM es un duplicado para el consolidador
+    consolidador = ConsolidadorTransacciones()
+    assert consolidador.agregar((0, 0), resultado.transacciones[0])
+    fila_llm = {**resultado.transacciones[0], "monto": "$1,500.00", "categoria": True}
+    assert not consolidador.agregar((1, 0), fila_llm)
+
+    # Banco sin plantilla o depósitos de portada que no cuadran: la página va al LLM
+    assert extraer_transacciones_locales(movimientos, "scotiabank").paginas_pendientes == [2]
+    descartado = extraer_transacciones_locales(movimientos, "bbva", depositos=9000.0)
+    assert descartado.transacciones == [] and descartado.paginas_pendientes == [2]
+
+# ---- Pruebas para services/planificador_chunks.py ----
+def test_planificar_chunks_empaca_por_presupuesto_de_tokens():
+    # ~100 tokens por página densa y ~10 por página ligera (4 caracteres por token)
+    texto_por_pagina = {1: "a" * 400, 2: "b" * 40, 3: "c" * 40, 4: "d" * 400, 5: "portada"}
+
+    plan = planificar_chunks(texto_por_pagina, [1, 2, 3, 4], presupuesto_tokens=130)
+
+    assert [paginas for _, paginas in plan] == [[1, 2, 3], [4]]
+    assert plan.tokens_planeados == 220
+
+def test_planificar_chunks_solo_superpone_las_ultimas_lineas():
+    texto_por_pagina = {1: "l1\nl2\nl3\n", 2: "m1\nm2\n"}
+
+    plan = planificar_chunks(texto_por_pagina, [1, 2], presupuesto_tokens=2, lineas_superposicion=1)
+
+    assert [chunk.paginas for chunk in plan.chunks] == [[1], [2]]
+    assert plan.chunks[1].texto == "l3\nm1\nm2\n"
+
+def test_planificar_chunks_no_superpone_paginas_que_no_son_contiguas():
+    texto_por_pagina = {1: "l1\nl2\n", 2: "portada\n", 3: "m1\n"}
+
+    plan = planificar_chunks(texto_por_pagina, [1, 3], presupuesto_tokens=1, lineas_superposicion=1)
+
+    assert [chunk.paginas for chunk in plan.chunks] == [[1], [3]]
+    assert plan.chunks[1].texto == "m1\n"
+
+# ---- Pruebas para services/pool_workers.py ----
+@pytest.mark.asyncio
+async def test_pool_workers_ejecuta_y_rechaza_tareas_al_cerrar():
+    pool = PoolWorkers(max_workers=1)
+    pool.iniciar()
+    try:
+        assert await pool.ejecutar(pow, 2, 10) == 1024
+        assert pool.tareas_en_vuelo == 0
+    finally:
+        await asyncio.to_thread(pool.cerrar, 5)
+
+    with pytest.raises(PoolWorkersCerradoError):
+        pool.enviar(pow, 2, 3)
+
+@pytest.mark.asyncio
+async def test_pool_workers_cuenta_los_bytes_transferidos(monkeypatch):
+    eventos = []
+    monkeypatch.setattr(
+        "Fluxo_IA_visual.services.pool_workers.contadores_job.incrementar",
+        lambda evento, cantidad=1, job_id=None: eventos.append(cantidad)
+    )
+    pool = PoolWorkers(max_workers=1)
+    try:
+        assert await pool.ejecutar(len, b"x" * 10_000) == 10_000
+        assert await pool.ejecutar(bytes, 5_000) == b"\x00" * 5_000
+    finally:
+        await asyncio.to_thread(pool.cerrar, 5)
+
+    assert eventos == [10_000, 5_000]
+
+# ---- Pruebas para services/cola_trabajo.py ----
+@pytest.mark.asyncio
+async def test_cola_trabajo_entrega_el_resultado_del_worker(tmp_path):
+    cola = ColaTrabajo(str(tmp_path / "cola.sqlite3"), habilitada=True, intervalo_sondeo=0.01)
+    espera = asyncio.create_task(cola.ejecutar(TIPO_CPU, sorted, [3, 1, 2]))
+
+    unidad = None
+    while unidad is None:
+        await asyncio.sleep(0.01)
+        unidad = cola.reclamar([TIPO_CPU], "worker-1")
+    assert cola.reclamar([TIPO_CPU], "worker-2") is None  # Ya tiene dueño
+
+    funcion, argumento = unidad.argumentos
+    cola.completar(unidad.id, "worker-1", funcion(argumento))
+    assert await asyncio.wait_for(espera, timeout=5) == [1, 2, 3]
+
+def test_cola_trabajo_retoma_unidades_con_lease_vencido(tmp_path):
+    cola = ColaTrabajo(str(tmp_path / "cola.sqlite3"), lease_segundos=0.05, max_intentos=2)
+    unidad_id = cola.encolar(TIPO_CPU, len, b"abc", job_id="job-1")
+
+    primera = cola.reclamar([TIPO_CPU], "worker-1")
+    assert primera.id == unidad_id and primera.job_id == "job-1"
+    time.sleep(0.1)  # worker-1 dejó de renovar
+    segunda = cola.reclamar([TIPO_CPU], "worker-2")
+    assert segunda.id == unidad_id and segunda.intentos == 2
+    assert not cola.renovar(unidad_id, "worker-1")
+
+    # El resultado tardío del worker anterior no pisa al dueño actual
+    cola.completar(unidad_id, "worker-1", 99)
+    time.sleep(0.1)
+    assert cola.reclamar([TIPO_CPU], "worker-3") is None  # Agotó sus intentos
+    estado, = cola._conexion().execute("SELECT estado FROM unidades WHERE id = ?", (unidad_id,)).fetchone()
+    assert estado == EstadoUnidad.FALLIDA.value
+
+def test_cola_trabajo_cancelar_borra_el_resultado_que_nadie_va_a_leer(tmp_path):
+    cola = ColaTrabajo(str(tmp_path / "cola.sqlite3"))
+    unidad_id = cola.encolar(TIPO_CPU, len, b"abc")
+    cola.reclamar([TIPO_CPU], "worker-1")
+    cola.completar(unidad_id, "worker-1", 3)
+
+    cola.cancelar(unidad_id)  # La API dejó de esperar justo después de que el worker terminó
+
+    assert cola._conexion().execute("SELECT COUNT(*) FROM unidades").fetchone()[0] == 0
+
+# ---- Pruebas para worker.py ----
+@pytest.fixture
+def cola_worker(tmp_path, monkeypatch):
+    cola = ColaTrabajo(str(tmp_path / "cola.sqlite3"), habilitada=True, lease_segundos=0.3, max_intentos=2, intervalo_sondeo=0.01)
+    monkeypatch.setattr(worker, "cola_trabajo", cola)
+    return cola
+
+async def _reclamar(cola, tipo, propietario):
+    unidad = None
+    while unidad is None:
+        await asyncio.sleep(0.01)
+        unidad = await asyncio.to_thread(cola.reclamar, [tipo], propietario)
+    return unidad
+
+@pytest.mark.asyncio
+async def test_ejecutar_unidad_renueva_el_lease_y_entrega_el_resultado(cola_worker, monkeypatch):
+    async def lento(valor):
+        await asyncio.sleep(0.5)  # Más que el lease: solo sigue siendo suya si lo renueva
+        return valor * 2
+    monkeypatch.setitem(worker.MANEJADORES, TIPO_CPU, lento)
+    espera = asyncio.create_task(cola_worker.ejecutar(TIPO_CPU, 21))
+
+    unidad = await _reclamar(cola_worker, TIPO_CPU, "worker-1")
+    tarea = asyncio.create_task(worker.ejecutar_unidad(unidad, "worker-1"))
+    await asyncio.sleep(0.4)
+    assert cola_worker.reclamar([TIPO_CPU], "worker-2") is None
+    await tarea
+
+    assert await asyncio.wait_for(espera, timeout=5) == 42
+
+@pytest.mark.asyncio
+async def test_ejecutar_unidad_reintenta_solo_los_errores_transitorios(cola_worker, monkeypatch):
+    llamadas = []
+    async def inestable(valor):
+        llamadas.append(valor)
+        if valor == "red" and len(llamadas) == 1:
+            raise asyncio.TimeoutError()
+        if valor == "dato":
+            raise ValueError("formato inválido")
+        return valor
+    monkeypatch.setitem(worker.MANEJADORES, TIPO_CPU, inestable)
+
+    transitoria = cola_worker.encolar(TIPO_CPU, "red")
+    await worker.ejecutar_unidad(await _reclamar(cola_worker, TIPO_CPU, "worker-1"), "worker-1")
+    reintento = await _reclamar(cola_worker, TIPO_CPU, "worker-2")  # Volvió a la cola
+    assert (reintento.id, reintento.intentos) == (transitoria, 2)
+    await worker.ejecutar_unidad(reintento, "worker-2")
+
+    permanente = cola_worker.encolar(TIPO_CPU, "dato")
+    await worker.ejecutar_unidad(await _reclamar(cola_worker, TIPO_CPU, "worker-1"), "worker-1")
+
+    filas = dict(cola_worker._conexion().execute("SELECT id, estado FROM unidades").fetchall())
+    assert filas == {transitoria: EstadoUnidad.HECHA.value, permanente: EstadoUnidad.FALLIDA.value}
+
+@pytest.mark.asyncio
+async def test_ejecutar_unidad_abandona_la_unidad_cancelada(cola_worker, monkeypatch):
+    cancelada = asyncio.Event()
+    async def eterno():
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelada.set()
+            raise
+    monkeypatch.setitem(worker.MANEJADORES, TIPO_CPU, eterno)
+    unidad_id = cola_worker.encolar(TIPO_CPU)
+    tarea = asyncio.create_task(worker.ejecutar_unidad(await _reclamar(cola_worker, TIPO_CPU, "worker-1"), "worker-1"))
+
+    await asyncio.sleep(0.05)
+    cola_worker.cancelar(unidad_id)
+
+    await asyncio.wait_for(tarea, timeout=2)
+    await asyncio.wait_for(cancelada.wait(), timeout=1)
+
+@pytest.mark.asyncio
+async def test_transmitir_agente_tpv_por_la_cola_entrega_los_lotes_del_worker(cola_worker, monkeypatch):
+    monkeypatch.setattr("Fluxo_IA_visual.services.orchestators.cola_trabajo", cola_worker)
+    async def agente(banco, texto_chunk, paginas):
+        return [[{"banco": banco, "pagina": p}] for p in paginas]
+    monkeypatch.setitem(worker.MANEJADORES, TIPO_AGENTE_TPV, agente)
+
+    async def un_worker():
+        await worker.ejecutar_unidad(await _reclamar(cola_worker, TIPO_AGENTE_TPV, "worker-1"), "worker-1")
+    tarea = asyncio.create_task(un_worker())
+    lotes = [lote async for lote in _transmitir_agente_tpv("bbva", "texto", [3, 4])]
+    await tarea
+
+    assert lotes == [[{"banco": "bbva", "pagina": 3}], [{"banco": "bbva", "pagina": 4}]]
+
+# ---- Pruebas para services/job_store.py ----
+def test_registro_jobs_guarda_estado_y_avance(tmp_path):
+    registro = RegistroJobs(str(tmp_path / "jobs.sqlite3"))
+    registro.crear("job-1", documentos=2)
+    assert registro.obtener("job-1").estado == EstadoJob.EN_COLA
+    assert registro.obtener("no-existe") is None
+
+    registro.iniciar("job-1")
+    registro.avanzar(ETAPA_CHUNKS, completados=0, total=3, job_id="job-1")
+    registro.avanzar(ETAPA_CHUNKS, job_id="job-1")
+    token = job_actual.set("job-1")
+    try:
+        registro.avanzar(ETAPA_DOCUMENTOS)  # Sin job_id usa el del contexto
+    finally:
+        job_actual.reset(token)
+    assert registro.vaciar()
+
+    info = registro.obtener("job-1")
+    assert info.estado == EstadoJob.PROCESANDO and info.iniciado is not None
+    assert info.progreso[ETAPA_CHUNKS] == {"completados": 1, "total": 3}
+    assert info.progreso[ETAPA_DOCUMENTOS] == {"completados": 1, "total": 2}
+
+    registro.terminar("job-1", EstadoJob.PARCIAL, "1 de 2 resultados con error.")
+    assert registro.vaciar()
+    info = registro.obtener("job-1")
+    assert info.estado == EstadoJob.PARCIAL and info.terminado is not None
+    assert info.error == "1 de 2 resultados con error."
+
+def test_registro_jobs_guarda_eventos_en_orden(tmp_path):
+    registro = RegistroJobs(str(tmp_path / "jobs.sqlite3"))
+    registro.crear("job-1", documentos=1, archivos=["a.pdf"])
+    registro.iniciar("job-1")
+    registro.evento(EVENTO_CHUNK_TERMINADO, {"paginas": [1, 2]}, job_id="job-1")
+    registro.evento(EVENTO_CHUNK_TERMINADO, {"paginas": [3]}, job_id="otro-job")
+    registro.terminar("job-1")
+    assert registro.vaciar()
+
+    eventos = registro.eventos("job-1")
+    assert [e.tipo for e in eventos] == [
+        EVENTO_DOCUMENTOS_ACEPTADOS, EVENTO_JOB_INICIADO, EVENTO_CHUNK_TERMINADO, EVENTO_JOB_TERMINADO
+    ]
+    assert eventos[0].datos == {"documentos": 1, "archivos": ["a.pdf"]}
+    assert eventos[-1].datos == {"estatus": "terminado", "error": None}
+    # Retomar desde un Last-Event-ID solo devuelve lo posterior
+    assert [e.id for e in registro.eventos("job-1", despues_de=eventos[1].id)] == [eventos[2].id, eventos[3].id]
+
+def test_registro_jobs_cancela_solo_jobs_activos(tmp_path):
+    registro = RegistroJobs(str(tmp_path / "jobs.sqlite3"))
+    registro.crear("job-1", documentos=1)
+    assert registro.cancelacion_solicitada("job-1") is None
+
+    assert registro.solicitar_cancelacion("job-1", "Ya no se necesita.")
+    # Cualquier proceso que ejecute el job ve la solicitud
+    assert RegistroJobs(registro.ruta).cancelacion_solicitada("job-1") == "Ya no se necesita."
+    assert registro.eventos("job-1")[-1].tipo == EVENTO_CANCELACION_SOLICITADA
+
+    registro.terminar("job-1", EstadoJob.CANCELADO, "Ya no se necesita.")
+    assert registro.vaciar()
+    assert registro.obtener("job-1").estado == EstadoJob.CANCELADO
+    assert not registro.solicitar_cancelacion("job-1")
+    assert not registro.solicitar_cancelacion("no-existe")
+
+def test_registro_jobs_marca_fallidos_los_interrumpidos(tmp_path):
+    ruta = str(tmp_path / "jobs.sqlite3")
+    registro = RegistroJobs(ruta)
+    registro.crear("activo", documentos=1)
+    registro.crear("terminado", documentos=1)
+    registro.terminar("terminado")
+    assert registro.vaciar()
+
+    # Un proceso nuevo sobre la misma base: el job que quedó en cola ya no tiene quién lo procese
+    assert RegistroJobs(ruta).recuperar_interrumpidos() == ["activo"]
+    assert registro.obtener("activo").estado == EstadoJob.FALLIDO
+    assert registro.eventos("activo")[-1].tipo == EVENTO_JOB_TERMINADO
+    assert registro.obtener("terminado").estado == EstadoJob.TERMINADO
+
+def test_registro_jobs_falla_los_jobs_de_un_pid_reutilizado(tmp_path):
+    ruta = str(tmp_path / "jobs.sqlite3")
+    registro = RegistroJobs(ruta)
+    registro.crear("vivo", documentos=1)
+    registro.crear("reutilizado", documentos=1)
+    padre = os.getppid()
+    conexion = sqlite3.connect(ruta)
+    with conexion:
+        # Mismo PID vivo (el proceso padre), pero uno de los jobs es de un arranque anterior
+        conexion.execute(
+            "UPDATE jobs SET propietario = ? WHERE job_id = ?", (f"{HOST}:{padre}:{_arranque_proceso(padre)}", "vivo")
+        )
+        conexion.execute(
+            "UPDATE jobs SET propietario = ? WHERE job_id = ?", (f"{HOST}:{padre}:arranque-anterior", "reutilizado")
+        )
+    conexion.close()
+
+    assert RegistroJobs(ruta).recuperar_interrumpidos() == ["reutilizado"]
+    assert registro.obtener("vivo").estado == EstadoJob.EN_COLA
+
+def test_registro_jobs_purga_los_jobs_terminados_viejos(tmp_path):
+    ruta = str(tmp_path / "jobs.sqlite3")
+    registro = RegistroJobs(ruta, retencion_segundos=60)
+    for job_id in ("viejo", "reciente", "activo-viejo"):
+        registro.crear(job_id, documentos=1)
+    registro.solicitar_cancelacion("viejo")
+    registro.terminar("viejo", EstadoJob.CANCELADO)
+    registro.terminar("reciente")
+    assert registro.vaciar()
+    conexion = sqlite3.connect(ruta)
+    with conexion:
+        conexion.execute("UPDATE jobs SET actualizado = ? WHERE job_id != 'reciente'", (time.time() - 120,))
+        conexion.execute("UPDATE eventos_job SET momento = ? WHERE job_id != 'reciente'", (time.time() - 120,))
+    conexion.close()
+
+    assert registro.purgar() == 1
+    assert registro.obtener("viejo") is None
+    assert registro.eventos("viejo") == []
+    assert registro.cancelacion_solicitada("viejo") is None
+    # Los activos los resuelve 'recuperar_interrumpidos', no la retención
+    assert registro.obtener("activo-viejo").estado == EstadoJob.EN_COLA
+    assert registro.obtener("reciente").progreso[ETAPA_DOCUMENTOS] == {"completados": 0, "total": 1}
+
+# ---- Pruebas para services/llm_clients.py ----
+def test_registro_clientes_llm_reutiliza_en_el_mismo_loop_y_recrea_en_otro(caplog):
+    registro = RegistroClientesLLM()
+
+    async def obtener_clientes(cerrar: bool):
+        fluxo = registro.obtener(CLIENTE_FLUXO)
+        assert registro.obtener(CLIENTE_FLUXO) is fluxo  # Mismo loop: mismos clientes
+        assert registro.obtener(CLIENTE_NOMI)._client is fluxo._client  # Un solo transporte compartido
+        if cerrar:
+            await registro.cerrar()
+        return fluxo
+
+    primero = asyncio.run(obtener_clientes(cerrar=False))
+    with caplog.at_level("WARNING"):
+        segundo = asyncio.run(obtener_clientes(cerrar=True))
+    assert segundo is not primero  # Otro loop: clientes nuevos
+    assert "se recrean los clientes LLM" in caplog.text
+
+# ---- Pruebas para services/llm_cache.py ----
+def _mensajes(sistema="Eres un agente", usuario="texto", imagenes=()):
+    contenido = [{"type": "text", "text": usuario}]
+    contenido += [{"type": "image_url", "image_url": {"url": url, "detail": "high"}} for url in imagenes]
+    return [{"role": "system", "content": sistema}, {"role": "user", "content": contenido}]
+
+def test_calcular_llave_cambia_con_modelo_prompt_contenido_e_imagenes():
+    base = calcular_llave("gpt-5", _mensajes(imagenes=["data:image/png;base64,AAA"]))
+
+    assert base == calcular_llave("gpt-5", _mensajes(imagenes=["data:image/png;base64,AAA"]), timeout=30)
+    assert base != calcular_llave("otro", _mensajes(imagenes=["data:image/png;base64,AAA"]))
+    assert base != calcular_llave("gpt-5", _mensajes(sistema="Prompt editado", imagenes=["data:image/png;base64,AAA"]))
+    assert base != calcular_llave("gpt-5", _mensajes(usuario="otro texto", imagenes=["data:image/png;base64,AAA"]))
+    assert base != calcular_llave("gpt-5", _mensajes(imagenes=["data:image/png;base64,BBB"]))
+    assert base != calcular_llave("gpt-5", _mensajes(imagenes=["data:image/png;base64,AAA"]), reasoning_effort="high")
+
+def test_cache_respuestas_llm_aciertos_fallos_y_ttl(tmp_path, monkeypatch):
+    cache = CacheRespuestasLLM(str(tmp_path / "llm.sqlite3"), ttl_segundos=60, max_bytes=1024)
+
+    assert cache.obtener("llave") is None
+    cache.guardar("llave", "gpt-5", "respuesta")
+    assert cache.obtener("llave") == "respuesta"
+
+    # La cache es persistente: otra instancia sobre el mismo archivo ve la entrada
+    assert CacheRespuestasLLM(str(tmp_path / "llm.sqlite3"), 60, 1024).obtener("llave") == "respuesta"
+
+    import Fluxo_IA_visual.services.llm_cache as llm_cache
+    ahora = llm_cache.time.time()
+    monkeypatch.setattr(llm_cache.time, "time", lambda: ahora + 61)
+    assert cache.obtener("llave") is None
+
+    estadisticas = cache.estadisticas()
+    assert (estadisticas["aciertos"], estadisticas["fallos"], estadisticas["entradas"]) == (1, 2, 0)
+
+def test_cache_respuestas_llm_expulsa_lo_menos_usado(tmp_path):
+    cache = CacheRespuestasLLM(str(tmp_path / "llm.sqlite3"), ttl_segundos=60, max_bytes=25)
+    cache.guardar("a", "m", "x" * 10)
+    cache.guardar("b", "m", "y" * 10)
+    cache.obtener("a")  # 'a' pasa a ser la más reciente
+    cache.guardar("c", "m", "z" * 10)
+
+    assert cache.obtener("b") is None
+    assert cache.obtener("a") == "x" * 10
+    assert cache.obtener("c") == "z" * 10
+    assert cache.estadisticas()["expulsiones"] == 1
+
+def test_cache_respuestas_llm_deshabilitada_no_guarda(tmp_path):
+    cache = CacheRespuestasLLM(str(tmp_path / "llm.sqlite3"), 60, 1024, habilitada=False)
+    cache.guardar("llave", "gpt-5", "respuesta")
+
+    assert cache.obtener("llave") is None
+    assert not (tmp_path / "llm.sqlite3").exists()
+
+# ---- Pruebas para services/llm_governor.py ----
+def test_estimar_tokens_cuenta_texto_imagenes_y_salida():
+    mensajes = _mensajes(sistema="a" * 40, usuario="b" * 40, imagenes=["data:1", "data:2"])
+
+    assert estimar_tokens(mensajes, max_tokens=100) == 20 + 2 * 1100 + 100
+
+@pytest.mark.asyncio
+async def test_gobernador_respeta_el_limite_de_concurrencia(tmp_path):
+    gobernador = GobernadorLLM(str(tmp_path / "gob.sqlite3"), {"p": LimitesProveedor(concurrentes=2, rpm=10000, tpm=10**6)})
+    en_vuelo = 0
+    maximo = 0
+
+    async def llamada():
+        nonlocal en_vuelo, maximo
+        async with gobernador.permiso("p", 1, 10):
+            en_vuelo += 1
+            maximo = max(maximo, en_vuelo)
+            await asyncio.sleep(0.05)
+            en_vuelo -= 1
+
+    await asyncio.gather(*(llamada() for _ in range(6)))
+
+    assert maximo == 2
+    assert gobernador.estado("p")["en_vuelo"] == 0
+
+@pytest.mark.asyncio
+async def test_gobernador_da_paso_primero_a_la_mejor_prioridad(tmp_path):
+    gobernador = GobernadorLLM(str(tmp_path / "gob.sqlite3"), {"p": LimitesProveedor(concurrentes=1, rpm=10000, tpm=10**6)})
+    orden = []
+
+    async def llamada(prioridad, etiqueta):
+        async with gobernador.permiso("p", prioridad, 10):
+            orden.append(etiqueta)
+            await asyncio.sleep(0.05)
+
+    bloqueo = asyncio.create_task(llamada(0, "primera"))
+    await asyncio.sleep(0.02)
+    masivas = [asyncio.create_task(llamada(2, f"ocr{i}")) for i in range(2)]
+    await asyncio.sleep(0.02)
+    interactiva = asyncio.create_task(llamada(0, "portada"))
+    await asyncio.gather(bloqueo, interactiva, *masivas)
+
+    assert orden[:2] == ["primera", "portada"]
+
+@pytest.mark.asyncio
+async def test_gobernador_limita_tokens_por_minuto_y_ajusta_con_el_uso_real(tmp_path):
+    # 6000 tokens/minuto = 100 tokens por segundo
+    gobernador = GobernadorLLM(str(tmp_path / "gob.sqlite3"), {"p": LimitesProveedor(concurrentes=10, rpm=10000, tpm=6000)})
+
+    async with gobernador.permiso("p", 1, 6000) as permiso:
+        permiso.registrar_uso(5980)  # Se gastó menos de lo estimado: se devuelven 20 tokens
+
+    async with gobernador.permiso("p", 1, 30) as permiso:
+        pass
+
+    assert 0.05 < permiso.segundos_espera < 1
+    assert gobernador.estado("p")["esperando"] == {}
+
+@pytest.mark.asyncio
+async def test_gobernador_deshabilitado_no_crea_la_base(tmp_path):
+    gobernador = GobernadorLLM(str(tmp_path / "gob.sqlite3"), {}, habilitado=False)
+
+    async with gobernador.permiso("p", 0, 10**9) as permiso:
+        assert permiso.id_permiso is None
+    assert not (tmp_path / "gob.sqlite3").exists()
+
+@pytest.mark.asyncio
+async def test_gobernador_descarta_permisos_de_un_arranque_anterior_con_el_mismo_pid(tmp_path):
+    ruta = str(tmp_path / "gob.sqlite3")
+    GobernadorLLM(ruta, {}).estado("p")
+    # Permiso que dejó otra ejecución cuyo PID reutiliza hoy este proceso (p. ej. tras reiniciar el contenedor)
+    with sqlite3.connect(ruta) as conexion:
+        conexion.execute(
+            "INSERT INTO permisos (proveedor, host, pid, arranque, prioridad, concedido) VALUES (?, ?, ?, ?, ?, ?)",
+            ("p", HOST, os.getpid(), "arranque-anterior", 1, time.time())
+        )
+
+    gobernador = GobernadorLLM(ruta, {"p": LimitesProveedor(concurrentes=1, rpm=10000, tpm=10**6)})
+    await asyncio.to_thread(gobernador.limpiar_arranques_anteriores)
+    assert gobernador.estado("p")["en_vuelo"] == 0
+
+    async with gobernador.permiso("p", 1, 10) as permiso:
+        assert permiso.segundos_espera < 1
+        assert gobernador.estado("p")["en_vuelo"] == 1
+
+# ---- Pruebas para services/llm_resiliencia.py ----
+def _error_http(estado, encabezados=None):
+    import httpx
+    import openai
+    respuesta = httpx.Response(estado, headers=encabezados or {}, request=httpx.Request("POST", "https://api.test"))
+    clase = openai.RateLimitError if estado == 429 else openai.APIStatusError
+    return clase("error", response=respuesta, body=None)
+
+def test_es_reintentable_segun_el_estado_http():
+    assert es_reintentable(_error_http(429))
+    assert es_reintentable(_error_http(503))
+    assert not es_reintentable(_error_http(400))
+    assert not es_reintentable(ValueError("respuesta inválida"))
+
+def test_segundos_retry_after_lee_segundos_y_milisegundos():
+    assert segundos_retry_after(_error_http(429, {"retry-after": "7"})) == 7
+    assert segundos_retry_after(_error_http(429, {"retry-after-ms": "1500"})) == 1.5
+    assert segundos_retry_after(_error_http(429)) is None
+
+def test_politica_reintentos_respeta_retry_after_y_el_tope():
+    politica = PoliticaReintentos(base_segundos=1, max_segundos=4, max_retry_after_segundos=10)
+
+    assert 30 > politica.espera(0, _error_http(429, {"retry-after": "5"})) >= 5
+    assert politica.espera(0, _error_http(429, {"retry-after": "999"})) <= 11
+    assert all(0 <= politica.espera(10, _error_http(503)) <= 4 for _ in range(20))
+
+@pytest.mark.asyncio
+async def test_ejecutar_con_reintentos_repite_solo_errores_transitorios():
+    politica = PoliticaReintentos(max_reintentos=3, base_segundos=0.001, max_segundos=0.001)
+    intentos = []
+
+    async def llamada():
+        intentos.append(1)
+        if len(intentos) < 3:
+            raise _error_http(429)
+        return "ok"
+
+    reintentos = []
+    assert await ejecutar_con_reintentos(llamada, politica, lambda i, e, s: reintentos.append(i)) == "ok"
+    assert reintentos == [1, 2]
+
+    async def falla_definitiva():
+        intentos.append(1)
+        raise _error_http(400)
+
+    intentos.clear()
+    with pytest.raises(Exception):
+        await ejecutar_con_reintentos(falla_definitiva, politica)
+    assert len(intentos) == 1
+
+@pytest.mark.asyncio
+async def test_ejecutar_con_cobertura_se_queda_con_la_primera_respuesta_valida():
+    async def lenta():
+        await asyncio.sleep(5)
+        return "principal"
+
+    async def rapida():
+        return "alterna"
+
+    coberturas = []
+    resultado, gano_alterna = await ejecutar_con_cobertura(lenta, rapida, 0.01, al_cubrir=lambda: coberturas.append(1))
+    assert (resultado, gano_alterna, coberturas) == ("alterna", True, [1])
+
+    resultado, gano_alterna = await ejecutar_con_cobertura(rapida, lenta, 1)
+    assert (resultado, gano_alterna) == ("alterna", False)
+
+@pytest.mark.asyncio
+async def test_ejecutar_con_cobertura_usa_la_alterna_si_la_principal_falla():
+    async def falla():
+        raise _error_http(400)
+
+    async def alterna():
+        return "respaldo"
+
+    assert await ejecutar_con_cobertura(falla, alterna, 10) == ("respaldo", True)
+
+def test_registro_latencias_p95_requiere_muestras_minimas():
+    registro = RegistroLatencias(min_muestras=20)
+    for segundos in range(19):
+        registro.registrar("fluxo", "gpt-5", segundos)
+    assert registro.p95("fluxo", "gpt-5") is None
+
+    registro.registrar("fluxo", "gpt-5", 100)
+    assert registro.p95("fluxo", "gpt-5") == 100
+    assert registro.p95("openrouter", "gpt-5") is None
+
+def test_contadores_job_usan_el_job_del_contexto(tmp_path):
+    contadores = ContadoresJob(str(tmp_path / "metricas.sqlite3"))
+    contadores.incrementar("reintentos")  # Sin job en el contexto no se cuenta
+
+    token = job_actual.set("job-1")
+    try:
+        contadores.incrementar("reintentos")
+        contadores.incrementar("reintentos", 2)
+        contadores.incrementar("coberturas")
+    finally:
+        job_actual.reset(token)
+    contadores.incrementar("fallos", job_id="job-2")
+
+    assert contadores.obtener("job-1") == {"coberturas": 1, "reintentos": 3}
+    assert contadores.obtener("job-2") == {"fallos": 1}
+
+def test_contadores_job_escriben_en_lote_y_purgan_los_jobs_viejos(tmp_path):
+    ruta = str(tmp_path / "metricas.sqlite3")
+    contadores = ContadoresJob(ruta, intervalo_segundos=3600, retencion_segundos=60)
+    with sqlite3.connect(ruta) as conexion:
+        contadores._conexion()
+        conexion.execute(
+            "INSERT INTO eventos_job (job_id, evento, total, actualizado) VALUES (?, ?, ?, ?)",
+            ("job-viejo", "llamadas", 5, time.time() - 120)
+        )
+    for _ in range(50):
+        contadores.incrementar("llamadas", job_id="job-1")
+
+    # Nada llega a disco hasta el volcado del hilo escritor
+    with sqlite3.connect(ruta) as conexion:
+        assert conexion.execute("SELECT COUNT(*) FROM eventos_job WHERE job_id = 'job-1'").fetchone()[0] == 0
+
+    contadores.vaciar()
+    assert contadores.obtener("job-1") == {"llamadas": 50}
+    assert contadores.obtener("job-viejo") == {}
+
+async def _flujo(*elementos, retraso=0.0, error=None):
+    await asyncio.sleep(retraso)
+    for elemento in elementos:
+        yield elemento
+    if error is not None:
+        raise error
+
+@pytest.mark.asyncio
+async def test_transmitir_con_reintentos_solo_reintenta_antes_del_primer_fragmento():
+    intentos = []
+
+    def fabrica():
+        intentos.append(1)
+        return _flujo(error=_error_http(503)) if len(intentos) == 1 else _flujo("a", "b")
+
+    politica = PoliticaReintentos(max_reintentos=3, base_segundos=0)
+    assert [x async for x in transmitir_con_reintentos(fabrica, politica)] == ["a", "b"]
+    assert len(intentos) == 2
+
+    # Con fragmentos ya entregados el error se propaga (no se puede repetir lo emitido)
+    recibidos = []
+    with pytest.raises(Exception):
+        async for x in transmitir_con_reintentos(lambda: _flujo("a", error=_error_http(503)), politica):
+            recibidos.append(x)
+    assert recibidos == ["a"]
+
+@pytest.mark.asyncio
+async def test_transmitir_con_cobertura_gana_el_primer_fragmento():
+    coberturas, ganadas = [], []
+    recibidos = [x async for x in transmitir_con_cobertura(
+        lambda: _flujo("p1", "p2", retraso=1), lambda: _flujo("a1", "a2"), 0.01,
+        al_cubrir=lambda: coberturas.append(1), al_ganar_alterna=lambda: ganadas.append(1)
+    )]
+    assert (recibidos, coberturas, ganadas) == (["a1", "a2"], [1], [1])
+
+    recibidos = [x async for x in transmitir_con_cobertura(lambda: _flujo("p1"), lambda: _flujo("a1"), 1)]
+    assert recibidos == ["p1"]
+
+@pytest.mark.asyncio
+async def test_transmitir_con_cobertura_propaga_el_error_si_ambas_fallan():
+    with pytest.raises(Exception):
+        async for _ in transmitir_con_cobertura(
+            lambda: _flujo(error=_error_http(400)), lambda: _flujo(error=_error_http(400)), 10
+        ):
+            pass
+
+# ---- Pruebas para services/ia_extractor.py ----
+class _ClienteLLMFalso:
+    """Registra los kwargs de cada chat.completions.create; sin 'respuesta' contesta 400 (no se reintenta)."""
+    def __init__(self, llamadas, respuesta=None):
+        self.llamadas = llamadas
+        self.respuesta = respuesta
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        self.llamadas.append(kwargs)
+        if self.respuesta is None:
+            raise _error_http(400)
+        mensaje = SimpleNamespace(content=self.respuesta)
+        return SimpleNamespace(choices=[SimpleNamespace(message=mensaje)], usage=None)
+
+@pytest.fixture
+def clientes_cobertura(tmp_path, monkeypatch):
+    """Llamadas registradas por cliente, sin cache ni gobernador de por medio."""
+    llamadas = {CLIENTE_FLUXO: [], CLIENTE_OPENROUTER: []}
+    monkeypatch.setattr(ia_extractor.settings, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(ia_extractor, "cache_respuestas_llm", CacheRespuestasLLM(
+        ruta=str(tmp_path / "cache.sqlite3"), ttl_segundos=60, max_bytes=1024 * 1024, habilitada=False
+    ))
+    monkeypatch.setattr(ia_extractor, "gobernador_llm", GobernadorLLM(
+        ruta=str(tmp_path / "gobernador.sqlite3"), limites={}, habilitado=False
+    ))
+    return llamadas
+
+@pytest.mark.asyncio
+async def test_cobertura_ocr_a_gpt5_no_manda_parametros_de_muestreo(clientes_cobertura, monkeypatch):
+    llamadas = clientes_cobertura
+    # Qwen falla con 400 y la cobertura va a GPT-5
+    monkeypatch.setattr(ia_extractor.registro_clientes_llm, "obtener", lambda nombre: (
+        _ClienteLLMFalso(llamadas[nombre]) if nombre == CLIENTE_OPENROUTER else _ClienteLLMFalso(llamadas[nombre], "ok")
+    ))
+    mensajes = [{"role": "user", "content": "página"}]
+
+    respuesta = await ia_extractor._completar_chat(
+        CLIENTE_OPENROUTER, 0, ia_extractor.ALTERNO_AGENTE_OCR,
+        model=ia_extractor.MODELO_QWEN_VL, messages=mensajes, timeout=5, temperature=0.1, max_tokens=4000
+    )
+
+    assert respuesta == "ok"
+    assert llamadas[CLIENTE_FLUXO] == [
+        {"model": ia_extractor.MODELO_GPT, "messages": mensajes, "timeout": 5, "max_completion_tokens": 4000}
+    ]
+
+@pytest.mark.asyncio
+async def test_cobertura_tpv_a_qwen_no_manda_reasoning_effort(clientes_cobertura, monkeypatch):
+    llamadas = clientes_cobertura
+    # GPT-5 falla con 400 y la cobertura va a Qwen
+    monkeypatch.setattr(ia_extractor.registro_clientes_llm, "obtener", lambda nombre: (
+        _ClienteLLMFalso(llamadas[nombre]) if nombre == CLIENTE_FLUXO else _ClienteLLMFalso(llamadas[nombre], "ok")
+    ))
+    mensajes = [{"role": "user", "content": "chunk"}]
+
+    respuesta = await ia_extractor._completar_chat(
+        CLIENTE_FLUXO, 0, ia_extractor.ALTERNO_AGENTE_TPV,
+        model=ia_extractor.MODELO_GPT, messages=mensajes, timeout=5, reasoning_effort="low", max_completion_tokens=2000
+    )
+
+    assert respuesta == "ok"
+    assert llamadas[CLIENTE_OPENROUTER] == [
+        {"model": ia_extractor.MODELO_QWEN_VL, "messages": mensajes, "timeout": 5, "max_tokens": 2000}
+    ]
+
 ### SOLO FUNCIONAN EN LOCAL
 # # ---- Pruebas para obtener_y_procesar_portada ----
 # @pytest.mark.asyncio
@@ -1,6 +1,8 @@
 from ..models.responses import AnalisisTPV, NomiFlash
 from .helpers_texto_fluxo import (
-    BANCO_DETECTION_REGEX, ALIAS_A_BANCO_MAP, PATRONES_COMPILADOS, PALABRAS_CLAVE_VERIFICACION, PROMPT_GENERICO, PROMPT_OCR_INSTRUCCIONES_BASE, PROMPT_TEXTO_INSTRUCCIONES_BASE, PROMPTS_POR_BANCO
+    BANCO_DETECTION_REGEX, ALIAS_A_BANCO_MAP, PATRONES_COMPILADOS, PALABRAS_CLAVE_VERIFICACION, PROMPT_GENERICO, PROMPT_OCR_INSTRUCCIONES_BASE, PROMPT_TEXTO_INSTRUCCIONES_BASE, PROMPTS_POR_BANCO,
+    PROMPT_CAMPOS_FALTANTES, TOLERANCIA_VERIFICACION_PORTADA,
+    PALABRAS_EXCLUIDAS, PALABRAS_EFECTIVO, PALABRAS_TRASPASO_ENTRE_CUENTAS, PALABRAS_TRASPASO_FINANCIAMIENTO, PALABRAS_BMRCASH
 )
 from .helpers_texto_nomi import CAMPOS_FLOAT, CAMPOS_STR, PATTERNS_COMPILADOS_RFC_CURP, RFCS_INSTITUCIONES_IGNORAR
 
@@ -176,63 +178,227 @@ def es_escaneado_o_no(texto_extraido: str, umbral: int = 50) -> bool:
 
     return pasa_longitud and pasa_contenido
 
+def parsear_linea_toon(linea: str) -> Optional[Dict[str, Any]]:
+    """
+    Convierte UNA línea TOON (FECHA | DESCRIPCION | MONTO | TIPO | ETIQUETA) en un diccionario.
+    Devuelve None para líneas vacías, encabezados o con formato incorrecto.
+    """
+    linea = linea.strip()
+    if not linea: return None # Saltar líneas vacías
+    
+    # Ignorar encabezados si el LLM los generó (ej. "Fecha | Desc...")
+    if "fecha" in linea.lower() and "monto" in linea.lower() and "|" in linea:
+        return None
+
+    partes = linea.split('|')
+    
+    # Esperamos 4 o 5 partes. Si hay más (ej. pipe en la descripción), intentamos unirlas
+    if len(partes) < 4: # Mínimo fecha, desc, monto
+        logger.debug(f"Línea TOON ignorada (formato incorrecto): {linea}")
+        return None
+        
+    try:
+        fecha = partes[0].strip()
+        
+        # El último es la etiqueta, el penúltimo el tipo
+        etiqueta_raw = partes[-1].strip().upper() # "TPV" o "GENERAL"
+        tipo_raw = partes[-2].strip().lower()
+        monto_str = partes[-3].strip()
+        
+        # Descripción es lo que sobra en medio
+        descripcion = " ".join(p.strip() for p in partes[1:-3])
+        
+        # Normalización de tipo
+        tipo = "abono" if "abono" in tipo_raw else "cargo" if "cargo" in tipo_raw else "indefinido"
+        
+        # Validación de etiqueta (fallback por seguridad)
+        es_tpv_ia = "TPV" in etiqueta_raw
+
+        return {
+            "fecha": fecha,
+            "descripcion": descripcion,
+            "monto": monto_str,
+            "tipo": tipo,
+            "categoria": es_tpv_ia
+        }
+        
+    except Exception as e:
+        logger.warning(f"Error parseando línea TOON: '{linea}' - {e}")
+        return None
+
 def parsear_respuesta_toon(texto_toon: str) -> List[Dict[str, Any]]:
     """
     Convierte el formato TOON (texto delimitado por pipes) a una lista de diccionarios.
     Formato esperado por línea: FECHA | DESCRIPCION | MONTO | TIPO
     """
-    transacciones = []
-    
     # Limpiamos bloques de código si el LLM los puso (```text ... ```)
     texto_limpio = re.sub(r'^```\w*\n|```$', '', texto_toon.strip(), flags=re.MULTILINE).strip()
     
-    lineas = texto_limpio.split('\n')
-    
-    for linea in lineas:
-        linea = linea.strip()
-        if not linea: continue # Saltar líneas vacías
-        
-        # Ignorar encabezados si el LLM los generó (ej. "Fecha | Desc...")
-        if "fecha" in linea.lower() and "monto" in linea.lower() and "|" in linea:
-            continue
+    transacciones = []
+    for linea in texto_limpio.split('\n'):
+        transaccion = parsear_linea_toon(linea)
+        if transaccion is not None:
+            transacciones.append(transaccion)
+    return transacciones
 
-        partes = linea.split('|')
-        
-        # Esperamos 4 o 5 partes. Si hay más (ej. pipe en la descripción), intentamos unirlas
-        if len(partes) < 4: # Mínimo fecha, desc, monto
-            logger.debug(f"Línea TOON ignorada (formato incorrecto): {linea}")
-            continue
-            
-        try:
-            fecha = partes[0].strip()
-            
-            # El último es la etiqueta, el penúltimo el tipo
-            etiqueta_raw = partes[-1].strip().upper() # "TPV" o "GENERAL"
-            tipo_raw = partes[-2].strip().lower()
-            monto_str = partes[-3].strip()
-            
-            # Descripción es lo que sobra en medio
-            descripcion = " ".join(p.strip() for p in partes[1:-3])
-            
-            # Normalización de tipo
-            tipo = "abono" if "abono" in tipo_raw else "cargo" if "cargo" in tipo_raw else "indefinido"
-            
-            # Validación de etiqueta (fallback por seguridad)
-            es_tpv_ia = "TPV" in etiqueta_raw
-
-            transacciones.append({
-                "fecha": fecha,
-                "descripcion": descripcion,
-                "monto": monto_str,
-                "tipo": tipo,
-                "categoria": es_tpv_ia
-            })
-            
-        except Exception as e:
-            logger.warning(f"Error parseando línea TOON: '{linea}' - {e}")
-            continue
+MARCADOR_SIN_DATOS = "SIN_DATOS"
+
+class ParserToonIncremental:
+    """
+    Parser TOON para respuestas en streaming: recibe fragmentos de texto tal como llegan
+    y devuelve las transacciones de cada línea en cuanto la línea se completa.
+    Si la respuesta empieza con SIN_DATOS se marca 'sin_datos' para cortar el stream.
+    """
+    def __init__(self):
+        self._pendiente = ""
+        self.total_transacciones = 0
+        self.sin_datos = False
+
+    def _procesar_linea(self, linea: str) -> Optional[Dict[str, Any]]:
+        if linea.strip().startswith("```"):
+            return None
+        if MARCADOR_SIN_DATOS in linea:
+            # Solo cuenta como "no hay datos" si aún no llegó ninguna transacción
+            self.sin_datos = self.total_transacciones == 0
+            return None
+        transaccion = parsear_linea_toon(linea)
+        if transaccion is not None:
+            self.total_transacciones += 1
+        return transaccion
+
+    def alimentar(self, fragmento: str) -> List[Dict[str, Any]]:
+        """Agrega un fragmento y devuelve las transacciones de las líneas que quedaron completas."""
+        if self.sin_datos:
+            return []
+        self._pendiente += fragmento
+        *lineas, self._pendiente = self._pendiente.split("\n")
+
+        transacciones = []
+        for linea in lineas:
+            transaccion = self._procesar_linea(linea)
+            if self.sin_datos:
+                return []
+            if transaccion is not None:
+                transacciones.append(transaccion)
+
+        # SIN_DATOS suele llegar sin salto de línea: se detecta sin esperar al final del stream
+        if not transacciones and self.total_transacciones == 0 and MARCADOR_SIN_DATOS in self._pendiente:
+            self.sin_datos = True
+        return transacciones
+
+    def terminar(self) -> List[Dict[str, Any]]:
+        """Procesa la última línea (la que no terminó en salto de línea)."""
+        linea, self._pendiente = self._pendiente, ""
+        if self.sin_datos or not linea:
+            return []
+        transaccion = self._procesar_linea(linea)
+        return [transaccion] if transaccion is not None and not self.sin_datos else []
+
+# Llave del total al que suma cada categoría de abono
+TOTAL_POR_CATEGORIA = {
+    "EFECTIVO": "depositos_en_efectivo",
+    "TRASPASO": "traspaso_entre_cuentas",
+    "FINANCIAMIENTO": "total_entradas_financiamiento",
+    "BMRCASH": "entradas_bmrcash",
+    "TPV": "entradas_TPV_bruto",
+}
 
-    return transacciones
+def clasificar_transaccion(trx: Dict[str, Any], tipo_flexible: bool = False) -> Tuple[Dict[str, Any], float]:
+    """
+    Clasificación de negocio POR DESCARTE de una transacción de los agentes.
+    Devuelve (transacción procesada, monto como float).
+    - tipo_flexible=False (agentes de texto): el tipo debe ser exactamente "abono" / "cargo".
+    - tipo_flexible=True (OCR): el tipo por defecto es "abono" y se aceptan "depósito" / "retiro".
+    """
+    monto_float = trx.get("monto", 0.0)
+    if not isinstance(monto_float, (int, float)):
+        monto_float = limpiar_monto(str(monto_float))
+
+    descripcion_limpia = trx.get("descripcion", "").lower()
+
+    # dependencia directa de la decisión de la IA para la categorización final
+    es_tpv_ia = trx.get("categoria", False)
+
+    trx_procesada = {
+        "fecha": trx.get("fecha"),
+        "descripcion": trx.get("descripcion"),
+        "monto": f"{monto_float:,.2f}",
+        "tipo": trx.get("tipo", "abono") if tipo_flexible else trx.get("tipo"),
+        "categoria": "GENERAL" # Por defecto
+    }
+
+    if tipo_flexible:
+        tipo_trx = trx.get("tipo", "abono").lower()
+        es_abono = "abono" in tipo_trx or "depósito" in tipo_trx
+        es_cargo = "cargo" in tipo_trx or "retiro" in tipo_trx
+    else:
+        es_abono = trx.get("tipo") == "abono"
+        es_cargo = trx.get("tipo") == "cargo"
+
+    if es_abono:
+        # 1. FILTRO DE EXCLUSIÓN: si encuentra CUALQUIER palabra prohibida, se queda como GENERAL
+        if any(p in descripcion_limpia for p in PALABRAS_EXCLUIDAS):
+            pass
+        # 2. FILTROS ESPECÍFICOS (Efectivo, Traspaso, BMR...)
+        elif any(p in descripcion_limpia for p in PALABRAS_EFECTIVO):
+            trx_procesada["categoria"] = "EFECTIVO"
+        elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_ENTRE_CUENTAS):
+            trx_procesada["categoria"] = "TRASPASO"
+        elif any(p in descripcion_limpia for p in PALABRAS_TRASPASO_FINANCIAMIENTO):
+            trx_procesada["categoria"] = "FINANCIAMIENTO"
+        elif any(p in descripcion_limpia for p in PALABRAS_BMRCASH):
+            trx_procesada["categoria"] = "BMRCASH"
+        # 3. DOBLE VALIDACIÓN (FILTRO NEGATIVO + IA POSITIVA); si la IA no está segura queda GENERAL
+        elif es_tpv_ia:
+            trx_procesada["categoria"] = "TPV"
+
+    elif es_cargo:
+        trx_procesada["categoria"] = "CARGO"
+
+    return trx_procesada, monto_float
+
+class ConsolidadorTransacciones:
+    """
+    Deduplica y clasifica las transacciones conforme llegan de los agentes (en cualquier orden).
+    Cada transacción trae su posición (índice de chunk, índice de línea): ante duplicados se
+    conserva la de menor posición, así el resultado es idéntico a consolidar los chunks en orden.
+    """
+    def __init__(self, tipo_flexible: bool = False):
+        self.tipo_flexible = tipo_flexible
+        self._por_id: Dict[str, Tuple[Tuple[int, int], Dict[str, Any], float]] = {}
+
+    @staticmethod
+    def id_transaccion(trx: Dict[str, Any]) -> str:
+        # Monto y mayúsculas normalizados: la misma fila del LLM ('$1,500.00') y del motor local ('1,500.00') coinciden
+        return f"{trx.get('fecha')}-{limpiar_monto(trx.get('monto')):.2f}-{(trx.get('descripcion') or '')[:15].lower()}"
+
+    def agregar(self, posicion: Tuple[int, int], trx: Dict[str, Any]) -> bool:
+        """Devuelve True si la transacción es nueva (no un duplicado de otro chunk)."""
+        id_trx = self.id_transaccion(trx)
+        existente = self._por_id.get(id_trx)
+        if existente is not None and existente[0] <= posicion:
+            return False
+        trx_procesada, monto = clasificar_transaccion(trx, self.tipo_flexible)
+        self._por_id[id_trx] = (posicion, trx_procesada, monto)
+        return existente is None
+
+    def __len__(self) -> int:
+        return len(self._por_id)
+
+    def _ordenadas(self) -> List[Tuple[Tuple[int, int], Dict[str, Any], float]]:
+        return sorted(self._por_id.values(), key=lambda entrada: entrada[0])
+
+    def transacciones(self) -> List[Dict[str, Any]]:
+        return [trx for _, trx, _ in self._ordenadas()]
+
+    def totales(self) -> Dict[str, float]:
+        """Totales por categoría, sumados en el orden de los chunks."""
+        totales = {llave: 0.0 for llave in TOTAL_POR_CATEGORIA.values()}
+        for _, trx, monto in self._ordenadas():
+            llave = TOTAL_POR_CATEGORIA.get(trx["categoria"])
+            if llave:
+                totales[llave] += monto
+        return totales
 
 # Funciones para procesar las descripciones de los bancos
 # fecha, descripción o parte de esta, monto
@@ -337,6 +503,48 @@ def reconciliar_resultados_ia(res_gpt: dict, res_gemini:dict) -> dict:
     
     return resultado_final
 
+def crear_prompt_campos_faltantes(prompt_base: str, campos: List[str]) -> str:
+    """
+    Agrega al prompt de portada la instrucción de extraer solo 'campos'
+    (el resto ya lo resolvió el regex).
+    """
+    return prompt_base + PROMPT_CAMPOS_FALTANTES.format(campos=", ".join(campos))
+
+def campos_vacios(datos_crudos: Dict[str, Any], campos: List[str]) -> List[str]:
+    """
+    Campos que la IA no devolvió o devolvió como null / cadena vacía.
+    Se evalúa ANTES de sanitizar (sanitizar_datos_ia convierte los montos faltantes en 0.0).
+    """
+    vacios = []
+    for campo in campos:
+        valor = datos_crudos.get(campo)
+        if valor is None or (isinstance(valor, str) and not valor.strip()):
+            vacios.append(campo)
+    return vacios
+
+def hay_desacuerdo_con_regex(
+    datos_ia: Dict[str, Any], 
+    datos_regex: Dict[str, Any], 
+    campos: List[str],
+    tolerancia: float = TOLERANCIA_VERIFICACION_PORTADA
+) -> bool:
+    """
+    True si para algún campo ambos tienen valor y no coinciden
+    (montos con una diferencia relativa mayor a 'tolerancia', textos distintos).
+    """
+    for campo in campos:
+        valor_ia = datos_ia.get(campo)
+        valor_regex = datos_regex.get(campo)
+        if valor_ia in (None, "") or valor_regex in (None, ""):
+            continue
+        if isinstance(valor_regex, (int, float)):
+            monto_ia = limpiar_monto(valor_ia)
+            if abs(monto_ia - valor_regex) > tolerancia * max(abs(valor_regex), 1.0):
+                return True
+        elif str(valor_ia).strip().upper() != str(valor_regex).strip().upper():
+            return True
+    return False
+
 def sanitizar_datos_ia(datos_crudos: Dict[str, Any]) -> Dict[str, Any]:
     """
     Toma el diccionario crudo de la IA y asegura que los tipos de datos
@@ -412,45 +620,6 @@ def limpiar_y_normalizar_texto(texto: str) -> str:
     texto_normalizado = re.sub(r'[ \t]{2,}', ' ', texto)
     return texto_normalizado.strip()
 
-def crear_chunks_con_superposicion(
-    texto_por_pagina: Dict[int, str], 
-    paginas_con_movimientos: List[int], 
-    tamano_chunk: int = 5, 
-    superposicion: int = 1
-) -> List[Tuple[str, List[int]]]:
-    """
-    Crea chunks de texto con superposición, usando solo las páginas que 
-    sabemos que tienen movimientos para no procesar portadas.
-    """
-    chunks = []
-    # Filtramos las páginas para procesar solo las que tienen movimientos
-    paginas_a_procesar = sorted([p_num for p_num in texto_por_pagina.keys() if p_num in paginas_con_movimientos])
-    
-    if not paginas_a_procesar:
-        return []
-
-    i = 0
-    while i < len(paginas_a_procesar):
-        # Define el inicio y fin del chunk
-        inicio_idx = i
-        fin_idx = i + tamano_chunk
-        
-        # Obtiene los números de página para este chunk
-        paginas_en_chunk = paginas_a_procesar[inicio_idx:fin_idx]
-        
-        if not paginas_en_chunk:
-            break
-            
-        # Crea el contenido de texto para el chunk
-        texto_chunk = "".join([texto_por_pagina[p_num] for p_num in paginas_en_chunk])
-        
-        chunks.append((texto_chunk, paginas_en_chunk))
-        
-        # Avanza para el siguiente chunk, retrocediendo la superposición
-        i += (tamano_chunk - superposicion)
-        
-    return chunks
-
 def _crear_prompt_agente_unificado(
         banco: str, 
         tipo: Literal["texto", "vision"]
@@ -246,6 +246,29 @@ REGLAS IMPORTANTES:
 - Si hay varios RFC, el válido es el que aparece junto al nombre y dirección del cliente.
 """
 
+# Campos que pide prompt_base_fluxo (en el orden del prompt)
+CAMPOS_PORTADA = [
+    "banco", "tipo_moneda", "nombre_cliente", "clabe_interbancaria", "rfc", "periodo_inicio", "periodo_fin",
+    "comisiones", "cargos", "depositos", "saldo_promedio"
+]
+
+# Campos que extraer_datos_por_banco puede resolver. Si el regex los trae todos, la portada
+# se resuelve con UN modelo pidiéndole solo lo que falta
+CAMPOS_CLAVE_REGEX = ["banco", "rfc", "comisiones", "depositos"]
+
+# Se le piden también al modelo único para contrastarlos con el regex (si no coinciden se escala)
+CAMPOS_VERIFICACION_PORTADA = ["depositos"]
+TOLERANCIA_VERIFICACION_PORTADA = 0.01 # 1% de diferencia relativa
+
+# Pueden venir vacíos sin escalar al segundo modelo (no todos los estados de cuenta los traen)
+CAMPOS_OPCIONALES_PORTADA = ["comisiones", "cargos", "saldo_promedio"]
+
+PROMPT_CAMPOS_FALTANTES = """
+ALCANCE DE ESTA CONSULTA:
+Los demás datos ya se obtuvieron del texto del documento. Extrae ÚNICAMENTE estos campos: {campos}.
+Devuelve el mismo formato JSON pero solo con esas llaves.
+"""
+
 PROMPT_TEXTO_INSTRUCCIONES_BASE = """
 INSTRUCCIONES DE FORMATO (TOON):
 1.  NO USES JSON. Genera una salida de texto plano ultra-compacta.
@@ -659,4 +682,83 @@ PROMPTS_POR_BANCO = {
             - 136180018635900157
     IMPORTANTE: Cualquier otro tipo de depósito SPEI, transferencias de otros bancos o pagos de nómina que no coincidan con las frases de arriba, son tratados como 'generales'.
     """,
-}
\ No newline at end of file
+}
+# --- PLANTILLAS DEL MOTOR LOCAL DE TRANSACCIONES (services/transacciones_locales.py) ---
+# Solo los bancos con plantilla se extraen sin LLM. 'fecha' es el formato que deben tener las fechas
+# de las filas reconstruidas y las reglas TPV replican los criterios de PROMPTS_POR_BANCO que se pueden
+# expresar como frases: 'una_linea' basta en cualquier parte de la descripción; 'primera_linea' y
+# 'demas_lineas' deben cumplirse AMBAS (la primera en el primer renglón y la otra en los siguientes).
+# Los bancos con reglas por posición de renglón (scotiabank, intercam, azteca...) se quedan con el LLM.
+FECHA_DIA_MES_TEXTO = r"\d{1,2}[/\- ]?(?:ene|feb|mar|abr|may|jun|jul|ago|sep|sept|oct|nov|dic)(?:[/\- ]?\d{2,4})?"
+FECHA_DIA_MES_NUMERO = r"\d{1,2}[/\-]\d{1,2}(?:[/\-]\d{2,4})?"
+FECHA_SOLO_DIA = r"\d{1,2}"
+
+PLANTILLAS_TRANSACCIONES = {
+    "bbva": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [
+            r"venta tarjetas", r"venta tdc inter", r"ventas cr[eé]dito", r"ventas d[eé]bito", r"ventas nal\. amex"
+        ],
+        "primera_linea": [
+            r"spei recibido", r"traspaso ntre cuentas", r"deposito de tercero", r"traspaso entre cuentas propias",
+            r"traspaso cuentas propias"
+        ],
+        "demas_lineas": [
+            r"deposito bpu", r"mp agregador s de rl de cv", r"anticipo rr belleza", r"haycash sapi de cv", r"gana",
+            r"0000001af", r"0000001sq", r"trans sr pago", r"dispersion sihay ref", r"net pay sapi de cv",
+            r"getnet mexico servicios de adquirencia s", r"payclip s de rl de cv", r"pocket de latinoamerica sapi de cv",
+            r"cobra online sapi de cv", r"kiwi bop sa de cv", r"kiwi international payment technologies",
+            r"deposito de tercero", r"zettle by paypal", r"pw online mexico sapi de cv", r"liquidacion wuzi"
+        ]
+    },
+    "banbajío": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"deposito negocios afiliados"]
+    },
+    "banorte": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"\b\d{8}[cd]\b"],
+        "primera_linea": [r"spei recibido", r"traspaso de cta", r"pago recibido de banorte por"],
+        "demas_lineas": [
+            r"ganancias clip", r"clip", r"amexco", r"orden de netpay sapi de cv", r"dal sapi de cv"
+        ]
+    },
+    "afirme": {
+        "fecha": [FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO],
+        "una_linea": [r"venta tpv ?cr", r"venta tpv ?db"]
+    },
+    "hsbc": {
+        "fecha": [FECHA_SOLO_DIA, FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"transf rec hsbcnet (?:tpv db|tpv cr|dep tpv)", r"deposito bpu ?\d{10}"]
+    },
+    "mifel": {
+        "fecha": [FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO],
+        "una_linea": [r"vta\.? (?:cre|deb) \d+ \d+"],
+        "primera_linea": [r"vta (?:deb|cre)", r"transferencia spei"],
+        "demas_lineas": [r"dispersion ed fondos", r"cuentas"]
+    },
+    "banregio": {
+        "fecha": [FECHA_SOLO_DIA, FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"abono ventas td[dc]"]
+    },
+    "santander": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"deposito ventas del dia afil"]
+    },
+    "multiva": {
+        "fecha": [FECHA_DIA_MES_TEXTO, FECHA_DIA_MES_NUMERO],
+        "una_linea": [
+            r"ventas tpvs", r"venta td[dc]", r"ventas tarjetas", r"ventas tdc inter", r"ventas credito", r"ventas debito"
+        ],
+        "primera_linea": [r"spei recibido stp"],
+        "demas_lineas": [r"latinoamerica sapi de cv", r"bpu2437419281"]
+    },
+    "banamex": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"deposito ventas netas", r"bn-nts029220"]
+    },
+    "citibanamex": {
+        "fecha": [FECHA_DIA_MES_TEXTO],
+        "una_linea": [r"deposito ventas netas"]
+    },
+}
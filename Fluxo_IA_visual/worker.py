@@ -0,0 +1,137 @@
+# Modo worker: ejecuta las unidades de trabajo que los nodos de la API encolan en la cola compartida
+# (ver services/cola_trabajo.py). Se levanta junto a 'main:app' con:
+#   python -m Fluxo_IA_visual.worker
+# y se pueden correr tantos procesos (o nodos) como se quiera sobre el mismo COLA_TRABAJO_PATH.
+from .core.config import settings
+from .core.exceptions import PoolWorkersCerradoError
+from .services.cola_trabajo import cola_trabajo, propietario_worker, UnidadTrabajo, TIPO_CPU, TIPO_AGENTE_TPV
+from .services.ia_extractor import contadores_job, gobernador_llm, transmitir_agente_tpv
+from .services.llm_clients import registro_clientes_llm
+from .services.llm_resiliencia import es_reintentable, job_actual
+from .services.pool_workers import pool_workers
+
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import aclosing
+from typing import Any, Awaitable, Callable, Dict, List
+import signal
+import sys
+import time
+import asyncio
+import logging
+
+LOGGING_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+logger = logging.getLogger(__name__)
+
+async def _ejecutar_cpu(funcion: Callable[..., Any], *args: Any) -> Any:
+    return await pool_workers.ejecutar(funcion, *args)
+
+async def _ejecutar_agente_tpv(banco: str, texto_chunk: str, paginas: List[int]) -> List[List[Dict[str, Any]]]:
+    """El chunk completo: la API recibe los lotes juntos y los consolida igual que con el stream local."""
+    lotes = []
+    async with aclosing(transmitir_agente_tpv(banco, texto_chunk, paginas)) as flujo:
+        async for lote in flujo:
+            lotes.append(lote)
+    return lotes
+
+MANEJADORES: Dict[str, Callable[..., Awaitable[Any]]] = {
+    TIPO_CPU: _ejecutar_cpu,
+    TIPO_AGENTE_TPV: _ejecutar_agente_tpv,
+}
+
+def es_transitorio(error: BaseException) -> bool:
+    """Fallas que otro intento (en este u otro worker) puede no repetir: LLM/red y un pool caído o cerrándose."""
+    return es_reintentable(error) or isinstance(error, (BrokenProcessPool, PoolWorkersCerradoError))
+
+async def ejecutar_unidad(unidad: UnidadTrabajo, propietario: str) -> None:
+    """Corre la unidad renovando su lease; si la API la canceló (o otro worker la retomó) se abandona."""
+    # Los eventos LLM y los bytes del pool se suman al job que originó la unidad
+    job_actual.set(unidad.job_id)
+    tarea = asyncio.create_task(MANEJADORES[unidad.tipo](*unidad.argumentos))
+    while True:
+        hechas, _ = await asyncio.wait({tarea}, timeout=cola_trabajo.lease_segundos / 3)
+        if hechas:
+            break
+        if not await asyncio.to_thread(cola_trabajo.renovar, unidad.id, propietario):
+            logger.info(f"Unidad {unidad.id} ({unidad.tipo}) cancelada o retomada por otro worker; se abandona.")
+            tarea.cancel()
+            return
+
+    try:
+        resultado = tarea.result()
+    except Exception as e:
+        # Las transitorias vuelven a la cola mientras queden intentos (COLA_MAX_INTENTOS); el resto falla ya
+        reintentar = es_transitorio(e)
+        logger.error(
+            f"Unidad {unidad.id} ({unidad.tipo}, intento {unidad.intentos}) falló"
+            f"{' (se reintenta si quedan intentos)' if reintentar else ''}: {e}", exc_info=True
+        )
+        await asyncio.to_thread(cola_trabajo.fallar, unidad.id, propietario, f"{type(e).__name__}: {e}", reintentar)
+        return
+    await asyncio.to_thread(cola_trabajo.completar, unidad.id, propietario, resultado)
+
+async def ejecutar_worker(detener: asyncio.Event) -> None:
+    """Reclama unidades mientras haya lugar (COLA_WORKER_CONCURRENCIA) hasta que se pida detener."""
+    propietario = propietario_worker()
+    tipos = list(MANEJADORES)
+    lugares = asyncio.Semaphore(settings.COLA_WORKER_CONCURRENCIA)
+    en_curso = set()
+    ultima_purga = time.monotonic()
+    logger.info(f"Worker {propietario} escuchando {cola_trabajo.ruta} (tipos: {', '.join(tipos)}).")
+
+    while not detener.is_set():
+        if time.monotonic() - ultima_purga >= settings.COLA_PURGA_INTERVALO_SEGUNDOS:
+            ultima_purga = time.monotonic()
+            try:
+                purgadas = await asyncio.to_thread(cola_trabajo.purgar)
+                if purgadas:
+                    logger.info(f"Cola de trabajo: {purgadas} unidades sin lector purgadas.")
+            except Exception as e:
+                logger.warning(f"No se pudo purgar la cola de trabajo: {e}")
+        await lugares.acquire()
+        try:
+            unidad = await asyncio.to_thread(cola_trabajo.reclamar, tipos, propietario)
+        except Exception as e:
+            logger.warning(f"No se pudo reclamar trabajo de la cola: {e}")
+            unidad = None
+        if unidad is None:
+            lugares.release()
+            try:
+                await asyncio.wait_for(detener.wait(), timeout=cola_trabajo.intervalo_sondeo)
+            except asyncio.TimeoutError:
+                pass
+            continue
+
+        tarea = asyncio.create_task(ejecutar_unidad(unidad, propietario))
+        en_curso.add(tarea)
+        tarea.add_done_callback(en_curso.discard)
+        tarea.add_done_callback(lambda _: lugares.release())
+
+    if en_curso:
+        # Apagado ordenado: lo que ya se reclamó termina; lo que no alcance lo retoma otro worker al vencer el lease
+        logger.info(f"Esperando {len(en_curso)} unidades en curso antes de salir.")
+        await asyncio.wait(en_curso, timeout=settings.POOL_WORKERS_DRENADO_SEGUNDOS)
+
+async def main() -> None:
+    detener = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for senal in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(senal, detener.set)
+        except NotImplementedError: # Windows
+            pass
+
+    registro_clientes_llm.iniciar()
+    pool_workers.iniciar()
+    await asyncio.to_thread(cola_trabajo.purgar)
+    await asyncio.to_thread(gobernador_llm.limpiar_arranques_anteriores)
+    try:
+        await ejecutar_worker(detener)
+    finally:
+        await asyncio.to_thread(pool_workers.cerrar)
+        await registro_clientes_llm.cerrar()
+        await asyncio.to_thread(contadores_job.vaciar)
+        logger.info("Worker detenido.")
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format=LOGGING_FORMAT, handlers=[logging.StreamHandler(sys.stdout)])
+    asyncio.run(main())